@@ -3,6 +3,16 @@ from . import context
 from . import traversal
 from . import cache
 from . import nodes
+from . import runner
+from . import worker
+from . import processpool
+from . import statistics
+from . import staging
+from . import watch as watch_
+from . import impact
+from . import remote
+from . import jobserver as jobserver_
+from . import util
 
 import tempfile
 import collections
@@ -12,131 +22,188 @@ import os
 import subprocess
 import sys
 import weakref
+import threading
+import time
+import gc
 import contextlib
 import concurrent.futures
 
-def connect(build_directory, force_restart):
+def connect(build_directory, force_restart, shared=False):
+    """ Return proxy of the backend for the build directory.
+    If shared is True, the backend runs in a service shared by all build
+    directories of the user (see SharedBackend). """
     try:
         build_directory.mkdir(parents=True)
     except FileExistsError:
         pass
+    if shared:
+        proxy = service.ServiceProxy(SharedBackend, shared_control_file(), force_restart)
+        return _BuildDirectoryProxy(proxy, util.make_absolute(build_directory))
     return service.ServiceProxy(Backend,
                                 build_directory / "backend_handle.json",
                                 force_restart)
 
-def _node_job(node, context):
-    """ Launched in another thread, updates a single node and submits jobs for
-    other nodes. """
-    try:
-        context.log(str(node))
-        if context.stop_flag:
-            return
+def shared_control_file():
+    directory = pathlib.Path.home() / ".cache" / "bs"
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / "backend_handle.json"
 
-        with context.backend._lock:
-            need_update = not node.dirty
-            #unlocked_nodes = self._set_node_clean(node) #!!!
+class _BuildDirectoryProxy:
+    """ Proxy of a Backend of a single build directory in SharedBackend. """
+    def __init__(self, proxy, build_directory):
+        self._proxy = proxy
+        self._build_directory = build_directory
 
-        if need_update:
-            node.update(context)
-
-        if context.stop_flag:
-            return
+    def __enter__(self):
+        self._proxy.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._proxy.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        def func(*args, **kwargs):
+            return self._proxy.call_backend(self._build_directory, name, *args, **kwargs)
+        return func
+
+class BackendResources:
+    """ Resources that can be shared by backends of several build directories:
+    threads updating the nodes, job tokens for external processes, persistent
+    workers, the process pool and source file nodes with their cached hashes.
+    BackendResources is a context manager. """
+
+    def __init__(self, jobs=4, background_jobs=1):
+        self.jobs = jobs
+        self.files = weakref.WeakValueDictionary() # Mapping of file paths to nodes.File instances
+        self.files_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        # Rebuilds of watched targets only get a few threads of their own
+        self.background_executor = concurrent.futures.ThreadPoolExecutor(background_jobs)
+        self.scheduler = traversal.Scheduler(self.executor, self.background_executor)
+        # Commands that run make (or other jobserver clients) share our job limit
+        self.jobserver = jobserver_.Server(jobs)
+        self.runner = runner.ProcessRunner(self.jobserver)
+        self.workers = worker.WorkerPool()
+        # Builds in the pool also take job tokens, the pool only has processes for all of them
+        self.process_pool = processpool.ProcessPool(jobs)
+        self.stack = contextlib.ExitStack()
 
-        with context.backend._lock:
-            for target in node.targets & context.targets:
-                target.submit_waiting_jobs(context)
-                # TODO: Avoid submiting the same node twice
+    def __enter__(self):
+        try:
+            self.stack.enter_context(self.jobserver)
+            self.stack.enter_context(self.executor)
+            self.stack.enter_context(self.background_executor)
+            self.stack.enter_context(self.runner)
+            self.stack.enter_context(self.workers)
+            self.stack.callback(self.process_pool.set_builders, self, [])
+        except:
+            self.stack.close()
+            raise
+        return self
 
-        if node in context.targets:
-            context.processed_targets.add(node)
-            self._link_output_file(node, output_directory)
-    except Exception as e:
-        context.exception(e)
+    def __exit__(self, *exc_info):
+        return self.stack.__exit__(*exc_info)
 
 class _TargetData:
     """ Represents target. """
-    def __init__(self, backend, target_node):
-        # Dirty nodes that are dirty, but don't have any dirty dependencies
-        self.waiting_nodes = weakref.WeakSet()
+    def __init__(self, backend, target_node, name):
+        self.name = name
+        self.version = 0 # Incremented when implicit dependencies of the nodes change
+        # Builders that need to be sent to the process pool
+        self.process_pool_builders = []
         self.node = self._process_nodes(backend, target_node)
 
-    def submit_waiting_jobs(self, context):
-        """ Submit update jobs for all nodes depended on by the target
-            that are currently waiting """
-        context.log("Submiting {} jobs", len(self.waiting_nodes))
-        for node in self.waiting_nodes:
-            context.backend.executor.submit(_node_job, node, context)
-
     def _process_nodes(self, backend, target_node):
         """ Visit all dependencies of the targets and prepare them. """
-        to_visit = collections.deque([target_node])
-        while to_visit:
-            node = to_visit.popleft()
-
-            # TODO: Maybe merge even non-file nodes
-            if isinstance(node, nodes.SourceFile):
-                assert len(node.dependencies) == 0
-                assert node is not target_node # TODO: Check this sooner with an understandable exception
-                if node.path in backend.files:
-                    old_node = node
-                    node = backend.files[node.path]
-
-                    for revdep in node.reverse_dependencies:
-                        revdep.remove_dependency(old_node)
-                        revdep.add_dependency(node) # TODO: Node names
-
-                    if old_node is target_node:
-                        # Edge case
-                        # The target node will always be visited first, so there
-                        # shouldn't be a problem with changing the node reference
-                        # while it's already stored in other nodes.
-                        # TODO: Write a test for this.
-                        target_node = node
-                else:
-                    backend.files[node.path] = node
-
-            if node.targets is None:
-                node.targets = weakref.WeakSet()
-
-            if self not in node.targets:
-                node.targets.add(self)
-                to_visit.extend(node.dependencies)
-
-            if node.reverse_dependencies is None:
-                node.reverse_dependencies = weakref.WeakSet()
-
-            # TODO: I don't like this part:
-            for dep in node.dependencies:
-                if dep.reverse_dependencies is None:
-                    dep.reverse_dependencies = weakref.WeakSet()
-                dep.reverse_dependencies.add(node)
-
-            # All nodes are initially dirty
-            node.dirty = True
-            if not node.dependencies:
-                self.waiting_nodes.add(node)
+        with backend._files_lock: # Files are shared with other backends and the watcher
+            target_node = self._merge_file(backend, target_node)
+            to_visit = collections.deque([target_node])
+            while to_visit:
+                node = to_visit.popleft()
+
+                # TODO: Maybe merge even non-file nodes
+                for dep in list(node.dependencies):
+                    merged = self._merge_file(backend, dep)
+                    if merged is not dep:
+                        node.replace_dependency(dep, merged)
+
+                if node.targets is None:
+                    node.targets = weakref.WeakSet()
+
+                if self not in node.targets:
+                    node.targets.add(self)
+                    to_visit.extend(node.dependencies)
+                    if isinstance(node, nodes.Builder) and node.use_process_pool:
+                        self.process_pool_builders.append(node)
+
+                if node.reverse_dependencies is None:
+                    node.reverse_dependencies = weakref.WeakSet()
+
+                # TODO: I don't like this part:
+                for dep in node.dependencies:
+                    if dep.reverse_dependencies is None:
+                        dep.reverse_dependencies = weakref.WeakSet()
+                    dep.reverse_dependencies.add(node)
+
+                # All nodes are initially dirty
+                node.dirty = True
 
         return target_node
 
+    @staticmethod
+    def _merge_file(backend, node):
+        """ Return the node of the backend for the same source file, the node
+        becomes the backend's node if there is none yet. """
+        if not isinstance(node, nodes.SourceFile):
+            return node
+        assert len(node.dependencies) == 0
+        return backend.files.setdefault(node.path, node)
+
 
 class Backend(service.Service):
     """ State of the build system itself. Holds the graph of dependencies.
     Intended to run as a service, but probably could also work directly. """
     _timeout = 20 * 60 # Shut down after 20 minutes of inactivity
-
-    def __init__(self, control_file):
+    _target_lifetime = 24 * 60 * 60 # Forget targets of build scripts unused for a day
+    _max_build_scripts = 16 # Keep targets of at most this many build scripts
+    _memory_limit = 4 * 1024**3 # Bytes, forget targets or shut down when exceeded; None to disable
+    _maintenance_interval = 60 # Seconds between checks of the limits above
+    _cache_disk_index = False # Keep cache items in memory mapped files, for caches with millions of items
+
+    def __init__(self, control_file, resources=None):
+        """ resources are BackendResources shared with other backends,
+        by default the backend creates its own. """
         self.stack = contextlib.ExitStack()
         enter_context = self.stack.enter_context
 
         try:
             self.build_directory = control_file.parent
-            self.temp_directory = self.build_directory / "tmp"
-            self.cache = cache.Cache(self.build_directory / "cache")
-
-            self.files = weakref.WeakValueDictionary() # Mapping of file paths to nodes.File instances
+            self.temp_directory = staging.scratch_directory(self.build_directory)
+            self.staging = staging.StagingArea(self.temp_directory)
+            self.cache = cache.Cache(self.build_directory / "cache", disk_index=self._cache_disk_index)
+            self.statistics = statistics.Statistics(self.build_directory / "statistics.pickle")
+
+            self._own_resources = resources is None
+            if resources is None:
+                resources = BackendResources() #TODO: Configurable number of workers
+            self.resources = resources
+
+            self.files = resources.files # Mapping of file paths to nodes.File instances
+            self._link_prefixes = {} # output directory -> path to the build directory used in links
+            self._files_lock = resources.files_lock
             self.target_data = {} # build script path -> [_TargetData]
 
-            self.executor = concurrent.futures.ThreadPoolExecutor(4) #TODO: Configurable number of workers
+            self.executor = resources.executor
+            self.scheduler = resources.scheduler
+            self.runner = resources.runner
+            self.workers = resources.workers
+            self.process_pool = resources.process_pool
+            self.watcher = None # Created by watch()
+            self._remote_executors = {} # tuple of control files of workers -> remote.RemoteExecutor
+            self._targets_generation = 0 # Incremented when targets change
+            self._impact_indexes = {} # build script -> (graph version, impact.ImpactIndex)
+            self._last_used = {} # build script -> time of last update
+            self._last_maintenance = time.monotonic()
 
             #self.monitor = monitor.Monitor()
         except:
@@ -146,7 +213,13 @@ class Backend(service.Service):
     def __enter__(self):
         try:
             self.stack.enter_context(self.cache)
-            self.stack.enter_context(self.executor)
+            self.stack.enter_context(self.statistics)
+            self.stack.enter_context(self.staging)
+            if self._own_resources:
+                self.stack.enter_context(self.resources)
+            self.stack.enter_context(self.process_pool)
+            self.stack.callback(self.unwatch)
+            self.stack.callback(self._close_remote_executors)
             #self.stack.enter_context(self.monitor)
         except:
             self.stack.close()
@@ -160,44 +233,217 @@ class Backend(service.Service):
     def need_run_config(build_script, self):
         return True
 
+    def has_targets(self, build_script):
+        """ Check if targets of the build script were uploaded. """
+        return build_script in self.target_data
+
     def set_targets(self, build_script, targets):
-        #TODO: Targets uploaded here should have limited life time
-        # else we would leak targets from unused build scripts
-        self.target_data[build_script] = [_TargetData(self, target) for target in targets]
+        """ Upload targets of a build script. Targets of scripts that are not used
+        for a long time are forgotten (see _expire_targets). """
+        self.target_data[build_script] = [_TargetData(self, target, name) for name, target in targets]
+        self._last_used[build_script] = time.monotonic()
+        self._targets_generation += 1
+        self._expire_targets()
+        self._update_process_pool()
+        self.statistics.decay_changes()
+
+    def _periodic(self):
+        now = time.monotonic()
+        if now < self._last_maintenance + self._maintenance_interval:
+            return
+        self._last_maintenance = now
+
+        if self._expire_targets(now):
+            self._update_process_pool()
+
+        if self._memory_limit is None or util.memory_usage() <= self._memory_limit:
+            return
 
-    def update(self, build_script, target_names, output_directory):
-        """ Update targets. Returns an iterator with progress messages. """
+        # Over the limit: keep only the most recently used build script
+        keep = max(self._last_used, key=self._last_used.get, default=None)
+        if self._forget_build_scripts([script for script in self.target_data if script != keep]):
+            self._update_process_pool()
+        gc.collect()
+        if util.memory_usage() > self._memory_limit:
+            # Memory is held by something else, a restarted backend will start clean
+            self._stop()
+
+    def _expire_targets(self, now=None):
+        """ Forget targets of build scripts that were not used for _target_lifetime
+        and of the least recently used scripts over _max_build_scripts.
+        Scripts that are watched are kept. Returns True if anything was removed. """
+        if now is None:
+            now = time.monotonic()
+        by_age = sorted(self.target_data, key=lambda script: self._last_used.get(script, 0),
+                        reverse=True)
+        expired = [script for i, script in enumerate(by_age)
+                   if i >= self._max_build_scripts or
+                      self._last_used.get(script, 0) + self._target_lifetime < now]
+        return self._forget_build_scripts(expired)
+
+    def _forget_build_scripts(self, build_scripts):
+        watched = self.watcher.build_scripts if self.watcher is not None else set()
+        removed = False
+        for build_script in build_scripts:
+            if build_script in watched:
+                continue
+            del self.target_data[build_script]
+            self._last_used.pop(build_script, None)
+            self._impact_indexes.pop(build_script, None)
+            removed = True
+        if removed:
+            self._targets_generation += 1
+        return removed
+
+    def _update_process_pool(self):
+        """ Pass the current generation of builders that use the process pool to it. """
+        builders = {}
+        for target_data in self.target_data.values():
+            for target in target_data:
+                for builder in target.process_pool_builders:
+                    if self._can_use_process_pool(builder):
+                        builders[id(builder)] = builder
+        self.process_pool.set_builders(self, builders.values())
+
+    @staticmethod
+    def _can_use_process_pool(builder):
+        """ Check if the builder can be loaded by the pool's worker processes.
+        Classes defined in the __main__ module of a build script can't,
+        the forkserver doesn't run the script. """
+        return type(builder).__module__ != "__main__"
+
+    def _submit_build(self, builder, input_paths, output_paths):
+        """ Run build of a builder with use_process_pool set in the process pool.
+        Returns a concurrent.futures.Future. """
+        return self.process_pool.submit(builder, self.cache.directory, self.temp_directory,
+                                        input_paths, output_paths)
+
+    def _get_remote_executor(self, control_files):
+        """ Return remote.RemoteExecutor for the workers with the given control files,
+        or None if the list is empty. Executors are kept for later updates, so that
+        their connections are reused. """
+        if not control_files:
+            return None
+        key = tuple(control_files)
+        executor = self._remote_executors.get(key)
+        if executor is None:
+            executor = self._remote_executors[key] = remote.RemoteExecutor(control_files, self.cache)
+        return executor
+
+    def _close_remote_executors(self):
+        for executor in self._remote_executors.values():
+            executor.close()
+        self._remote_executors = {}
+
+    def watch(self, build_script, debounce=0.5):
+        """ Keep rebuilding targets of the build script in background whenever
+        their source files change. The backend doesn't time out while watching. """
+        if self.watcher is None:
+            self.watcher = watch_.Watcher(self, debounce)
+            self.watcher.__enter__()
+        self.watcher.add(build_script)
+        self._timeout = None
+
+    def unwatch(self):
+        """ Stop the background rebuilds started by watch(). """
+        if self.watcher is not None:
+            self.watcher.__exit__(None, None, None)
+            self.watcher = None
+            self._timeout = type(self)._timeout
+
+    def affected(self, build_script, paths):
+        """ Return targets and applications of the build script affected by
+        changes of the given source files (absolute paths), as a tuple
+        (list of target names, list of application descriptions). """
+        version = (self._targets_generation,
+                   [target.version for target in self.target_data[build_script]])
+        cached = self._impact_indexes.get(build_script)
+        if cached is None or cached[0] != version:
+            cached = (version, impact.ImpactIndex(self.target_data[build_script]))
+            self._impact_indexes[build_script] = cached
+
+        targets, applications = cached[1].query(pathlib.Path(path) for path in paths)
+        return targets, [str(application) for application in applications]
+
+    def get_statistics(self, paths):
+        """ Return build time and change rate of source files, see statistics.Statistics.get. """
+        return self.statistics.get(paths)
+
+    def get_unity_batches(self, paths):
+        """ Return names of unity sources that built the source files, see statistics.Statistics.get_batches. """
+        return self.statistics.get_batches(paths)
+
+    def update(self, build_script, target_names, output_directory, jobserver=None,
+               remote_workers=None):
+        """ Update targets. Returns an iterator with progress messages.
+        target_names selects the targets to update (see _select_targets),
+        None means all targets. Only the dependencies of the selected targets
+        are updated.
+        jobserver is a tuple (pid, MAKEFLAGS) of a client running under make,
+        commands of the update then take job tokens from its jobserver.
+        remote_workers is a list of control files of workers (see remote.RemoteWorker)
+        that run actions of the builders (see Context.run_action) in this update. """
 
         available_targets = self.target_data[build_script]
+        self._last_used[build_script] = time.monotonic()
         if target_names is None:
             selected_targets = available_targets
         else:
-            selected_targets = (target for target
-                                in available_targes
-                                if target.name in targets)
+            selected_targets = self._select_targets(available_targets, target_names)
 
         #with open("/tmp/nodes", "w") as fp:
         #    self._dump_graph(fp)
 
-        c = context.Context(self, selected_targets, output_directory)
+        tokens = None
+        if jobserver is not None:
+            tokens = jobserver_.from_makeflags(jobserver[1], jobserver[0])
+        c = context.Context(self, selected_targets, output_directory, tokens=tokens,
+                            remote=self._get_remote_executor(remote_workers))
         # TODO: Stop context when connection from client is closed
 
-        for target in selected_targets:
-            target.submit_waiting_jobs(c)
-
-        c.log("Submitted initial targets")
-        c.log("X")
-
-        return service.IteratorWrapper(c.iterate_log_messages())
-
-    def _file_by_path(self, path):
-        #TODO: Is this one needed?
-        if path not in self.files:
-            node = nodes.SourceFile(path)
-            node.targets = weakref.WeakSet()
-            self.files[path] = node
-
-        return self.files[path]
+        targets_by_node = collections.defaultdict(list) # A node may have several names
+        for target in c.targets:
+            targets_by_node[target.node].append(target)
+
+        def target_done(node):
+            # Publish the target right away, without waiting for the rest of the build
+            for target in targets_by_node[node]:
+                if self._link_output(target, output_directory):
+                    c.log("Published {}", target.name)
+
+        self.scheduler.build(c, [target.node for target in c.targets], target_done)
+
+        return service.IteratorWrapper(c.iterate_progress())
+
+    @staticmethod
+    def _select_targets(available_targets, target_names):
+        """ Return targets matching the names. A name matches a target with
+        the same name, or all targets inside it if the target names are seen
+        as paths. Raises KeyError if any name doesn't match. """
+        selected = []
+        for name in target_names:
+            prefix = name.rstrip("/") + "/"
+            matching = [target for target in available_targets
+                        if target.name == name or target.name.startswith(prefix)]
+            if not matching:
+                raise KeyError("Unknown target {}".format(name))
+            selected.extend(target for target in matching if target not in selected)
+        return selected
+
+    def _files_by_paths(self, paths):
+        """ Return SourceFile nodes for a list of absolute paths, creating the
+        missing ones. """
+        ret = []
+        with self._files_lock:
+            for path in paths:
+                node = self.files.get(path)
+                if node is None:
+                    node = nodes.SourceFile(path)
+                    node.targets = weakref.WeakSet()
+                    node.reverse_dependencies = weakref.WeakSet()
+                    self.files[path] = node
+                ret.append(node)
+        return ret
 
 #    def _set_node_dirty(self, node, dirty):
 #        assert dirty != node.dirty
@@ -210,40 +456,61 @@ class Backend(service.Service):
 #        if not dirty 
 
     def _link_outputs(self, targets, output_directory):
-        """ Link the specified target files to the output directory. """
+        """ Link files of the specified targets (_TargetData) to the output directory. """
+        for target in targets:
+            self._link_output(target, output_directory)
+
+    def _link_output(self, target, output_directory):
+        """ Link file of a single target (_TargetData) to the output directory,
+        under the target's name. Names containing "/" are linked in subdirectories.
+        Links that already point to the right file are left alone, others are
+        replaced atomically, so that readers of the output directory never
+        see a missing file. Returns True if the link was changed. """
+        output_file = output_directory / target.name
+        prefix = self._get_link_prefix(output_file.parent)
+        cached_path = target.node.get_path(self)
+        try:
+            symlink_path = prefix / cached_path.relative_to(self.build_directory)
+        except ValueError:
+            symlink_path = cached_path.resolve() # Fallback if relative paths can't be used
+
+        try:
+            if os.readlink(str(output_file)) == str(symlink_path):
+                return False
+        except OSError:
+            pass # Missing or not a symlink
+
+        temp_file = output_file.parent / ".{}.{}.tmp".format(output_file.name, threading.get_ident())
         try:
-            output_directory.mkdir(parents=True)
-        except FileExistsError:
+            temp_file.unlink()
+        except FileNotFoundError:
             pass
+        try:
+            temp_file.symlink_to(symlink_path)
+        except FileNotFoundError:
+            # The output directory was removed while the backend was running
+            temp_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file.symlink_to(symlink_path)
+        os.replace(str(temp_file), str(output_file))
+        return True
 
+    def _get_link_prefix(self, output_directory):
+        """ Return path to the build directory as seen from the output directory
+        (relative if possible), creates the output directory when first used. """
+        try:
+            return self._link_prefixes[output_directory]
+        except KeyError:
+            pass
+
+        output_directory.mkdir(parents=True, exist_ok=True)
         try:
             relative_output_directory = output_directory.relative_to(self.build_directory)
         except ValueError:
-            relative_build_directory = None
+            prefix = self.build_directory.resolve()
         else:
-            relative_build_directory = pathlib.Path("..")
-            for _ in relative_output_directory.parts[1:]:
-                relative_build_directory = relative_build_directory / ".."
-
-        for target in targets:
-            cached_path = target.get_path(self)
-            output_file = self.output_directory / target.name
-
-            if output_file.exists() or output_file.is_symlink():
-                output_file.unlink()
-
-            symlink_path = cached_path.resolve() # Fallback if relatie paths can't be used
-            try:
-                relative_cached_file = cached_path.relative_to(self.build_directory)
-            except ValueError:
-                pass
-            else:
-                if relative_build_directory is not None:
-                    symlink_path = relative_build_directory / relative_cached_file
-
-            print("Symlinking", symlink_path, "to", output_file)
-
-            output_file.symlink_to(symlink_path)
+            prefix = pathlib.Path(*([".."] * len(relative_output_directory.parts)))
+        self._link_prefixes[output_directory] = prefix
+        return prefix
 
     def _dump_graph(self, fp):
         """ Write the graph in graphviz format """
@@ -274,3 +541,82 @@ class Backend(service.Service):
             fp.write('{}[label="{}"];\n'.format(id(node), str(node)))
         fp.write("}\n")
 
+
+class SharedBackend(service.Service):
+    """ Service hosting backends of all build directories of a user (see connect()).
+    Every build directory has its own Backend with a separate cache and graph,
+    the backends share BackendResources, so that builds in several checkouts
+    don't oversubscribe the machine and share hashes of source files.
+    Every backend has its own lock, calls for one directory don't wait for
+    another one. Backends of directories unused for Backend._timeout are closed. """
+    _timeout = Backend._timeout
+    _jobs = os.cpu_count() or 4
+    _unlocked_methods = frozenset(["call_backend"]) # Locks the backend instead
+
+    def __init__(self, control_file):
+        self.resources = BackendResources(self._jobs)
+        self.backends = {} # build directory -> Backend
+        self._last_used = {} # build directory -> time of last call
+        self._stopped = set() # Build directories whose backends asked to stop
+
+    def __enter__(self):
+        self.resources.__enter__()
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        for build_directory, backend in list(self.backends.items()):
+            with self._lock, backend._lock:
+                self._close_backend(build_directory)
+        self.resources.__exit__(ex_type, ex_value, ex_tb)
+        return ex_type == TimeoutError
+
+    def call_backend(self, build_directory, name, *args, **kwargs):
+        """ Call a method of the backend of the build directory, start it if necessary. """
+        if name.startswith("_"):
+            raise AttributeError("Private method {} can't be called".format(name))
+
+        build_directory = pathlib.Path(build_directory)
+        while True:
+            with self._lock:
+                backend = self.backends.get(build_directory)
+                if backend is None:
+                    backend = self._open_backend(build_directory)
+                self._last_used[build_directory] = time.monotonic()
+
+            with backend._lock:
+                if self.backends.get(build_directory) is backend: # Not closed meanwhile
+                    return getattr(backend, name)(*args, **kwargs)
+
+    def _open_backend(self, build_directory):
+        build_directory.mkdir(parents=True, exist_ok=True)
+        backend = Backend(build_directory / "backend_handle.json", self.resources)
+        backend._lock = threading.Lock()
+        # A backend over its memory limit only forgets its own state, other
+        # build directories keep running
+        backend._stop = lambda: self._stopped.add(build_directory)
+        backend.__enter__()
+        self.backends[build_directory] = backend
+        return backend
+
+    def _periodic(self):
+        now = time.monotonic()
+        for build_directory, backend in list(self.backends.items()):
+            if not backend._lock.acquire(blocking=False):
+                continue # Busy with a call, it will be checked next time
+            try:
+                backend._periodic()
+                if build_directory in self._stopped:
+                    self._close_backend(build_directory)
+                elif backend.watcher is not None:
+                    self._last_call_time = time.time() # Watching keeps the service running
+                elif backend._timeout is not None and \
+                     now > self._last_used[build_directory] + backend._timeout:
+                    self._close_backend(build_directory)
+            finally:
+                backend._lock.release()
+
+    def _close_backend(self, build_directory):
+        """ Must be called with locks of both the service and the backend held. """
+        backend = self.backends.pop(build_directory)
+        del self._last_used[build_directory]
+        self._stopped.discard(build_directory)
+        backend.__exit__(None, None, None)
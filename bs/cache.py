@@ -1,19 +1,161 @@
 import binascii
 import collections
+import contextlib
+import logging
+import os
+import pathlib
 import shutil
 import pickle
+import stat
+import tempfile
+import threading
+import time
 
-_Item = collections.namedtuple("_Item", "size partial_hash implicit_dependencies")
+from . import diskindex
+from . import util
+
+logger = logging.getLogger(__name__)
+
+_Item = collections.namedtuple("_Item", "size partial_hash dependency_set blobs")
+
+class _IndexNode:
+    """ Node of a trie of implicit dependency lists belonging to one partial hash.
+    Lists with a common prefix of (path, hash) pairs share nodes, so that
+    a mismatching file prunes all candidates containing it at once. """
+    __slots__ = ("children", "final_hashes")
+
+    def __init__(self):
+        self.children = {} # path -> {hash -> _IndexNode}
+        self.final_hashes = [] # Final hashes whose dependency list ends here
+
+    def insert(self, implicit_dependencies, final_hash):
+        node = self
+        for path, hash in implicit_dependencies:
+            by_hash = node.children.setdefault(path, {})
+            try:
+                node = by_hash[hash]
+            except KeyError:
+                node = by_hash[hash] = _IndexNode()
+        node.final_hashes.append(final_hash)
+
+    def search(self, get_hash):
+        """ Return final hash of a dependency list whose hashes all match
+        get_hash(path), or None. """
+        to_visit = [self]
+        while to_visit:
+            node = to_visit.pop()
+            if node.final_hashes:
+                return node.final_hashes[0]
+            for path, by_hash in node.children.items():
+                child = by_hash.get(get_hash(path))
+                if child is not None:
+                    to_visit.append(child)
+        return None
+
+class _IndexedItems:
+    """ Items of a cache stored in diskindex.DiskIndex, with the subset of
+    the OrderedDict interface that Cache uses for items kept in memory.
+    The least recently used item is only approximated by popitem. """
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, final_hash):
+        return final_hash in self._index
+
+    def __getitem__(self, final_hash):
+        record = self._index.get(final_hash)
+        if record is None:
+            raise KeyError(final_hash)
+        return self._item(record)
+
+    def __setitem__(self, final_hash, item):
+        self._index.put(final_hash, item.partial_hash, item.size, item.dependency_set, item.blobs)
+
+    def _item(self, record):
+        return _Item(record.size, record.partial_hash, record.dependency_set,
+                     self._index.blobs(record.final_hash))
+
+    def items(self):
+        for record in self._index:
+            yield record.final_hash, self._item(record)
+
+    def values(self):
+        for final_hash, item in self.items():
+            yield item
+
+    def move_to_end(self, final_hash):
+        self._index.accessed(final_hash)
+
+    def popitem(self, last=True):
+        assert not last
+        record = self._index.eviction_candidate()
+        if record is None:
+            raise KeyError("popitem(): no items")
+        item = self._item(record)
+        self._index.remove(record.final_hash)
+        return record.final_hash, item
+
+class _IndexedPartialHashes:
+    """ Read only view of the partial hashes in diskindex.DiskIndex, with the
+    interface of the dict that Cache uses without the index. """
+    def __init__(self, index):
+        self._index = index
+
+    def __contains__(self, partial_hash):
+        return bool(self._index.final_hashes(partial_hash))
+
+    def __getitem__(self, partial_hash):
+        final_hashes = self._index.final_hashes(partial_hash)
+        if not final_hashes:
+            raise KeyError(partial_hash)
+        return final_hashes
+
+    def get(self, partial_hash, default=None):
+        return self._index.final_hashes(partial_hash) or default
+
+    def items(self):
+        ret = {}
+        for record in self._index:
+            ret.setdefault(record.partial_hash, []).append(record.final_hash)
+        return ret.items()
+
+def _make_read_only(path):
+    """ Remove write permissions of a file. Blobs are hardlinked to every item
+    with the same content, writing to one of them would change all. """
+    mode = stat.S_IMODE(path.stat().st_mode)
+    os.chmod(str(path), mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
 
 class Cache:
     """ Caches all output files of a single application + its computed implicit
-    dependencies. """
+    dependencies.
+    With disk_index the items are kept in memory mapped files (diskindex.DiskIndex)
+    instead of dicts, so that memory used by the cache doesn't grow with
+    the number of items. Eviction then only approximates the LRU order.
+    Cache is thread safe, files are hashed outside of its lock. """
 
     _save_filename = "metadata.pickle"
+    _trash_dirname = "trash"
+    _blobs_dirname = "blobs"
+    _staging_dirname = "staging"
+    _index_dirname = "index"
 
-    def __init__(self, directory, size_limit = 1000000000):
+    def __init__(self, directory, size_limit = 1000000000, delete_rate = 256 * 1024 * 1024,
+                 disk_index = False):
         self.directory = directory
         self.size_limit = size_limit
+        self.delete_rate = delete_rate # Bytes per second deleted by the background thread, None for unlimited
+        self.disk_index = disk_index
+        self._index = None # diskindex.DiskIndex while entered with disk_index
+
+        self._lock = threading.RLock() # Protects the metadata and files of items
+        self.pending_free = 0 # Size of evicted items that were not deleted yet
+        self._trash_queue = collections.deque() # (directory, size) to delete
+        self._trash_condition = threading.Condition()
+        self._deleter = None
+
         self.clear(False)
 
     def __enter__(self):
@@ -21,15 +163,40 @@ class Cache:
         size_limit = self.size_limit
         self.size_limit = float("inf")
 
+        if self.disk_index:
+            self._open_index()
         if not self._load():
             self.clear()
         self.size_limit = size_limit
+
+        staging = self.directory / self._staging_dirname
+        if staging.exists():
+            self._move_to_trash([staging], 0)
+        self._trash_leftovers()
         return self
 
     def __exit__(self, *exc_info):
         self.save()
+        self.wait_for_deletion()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _open_index(self):
+        try:
+            self._index = diskindex.DiskIndex(self.directory / self._index_dirname)
+        except ValueError:
+            shutil.rmtree(str(self.directory / self._index_dirname))
+            self._index = diskindex.DiskIndex(self.directory / self._index_dirname)
+        self._data = _IndexedItems(self._index)
+        self._partial_hashes = _IndexedPartialHashes(self._index)
 
     def clear(self, delete_directory = True):
+        self.wait_for_deletion()
+        reopen_index = self._index is not None
+        if reopen_index:
+            self._index.close()
+            self._index = None
         self.size_used = 0
         self._data = collections.OrderedDict()
             # MRU order
@@ -40,46 +207,237 @@ class Cache:
             # Key: Partial hash
             # Value: list of full hashes
 
+        self._indexes = {}
+            # Key: Partial hash
+            # Value: _IndexNode, built when first needed
+
+        self._dependency_sets = {}
+            # Implicit dependency lists shared between items. Most items depend
+            # on the same headers, so each distinct list is stored only once.
+            # Key: dependency set id
+            # Value: [tuple of (path, hash) pairs, reference count]
+        self._dependency_set_ids = {}
+            # Key: tuple of (path, hash) pairs
+            # Value: dependency set id
+        self._dependency_pairs = {}
+            # Interned (path, hash) pairs, shared between dependency sets
+            # Key: (path, hash) pair
+            # Value: [the shared pair, number of dependency sets using it]
+        self._next_dependency_set_id = 0
+
+        self._blobs = {}
+            # Content of the cached files, every distinct content is stored once
+            # and hardlinked to directories of the items.
+            # size_used counts every blob once.
+            # Key: content hash
+            # Value: [size, reference count]
+
         if delete_directory:
             try:
                 shutil.rmtree(str(self.directory))
             except FileNotFoundError:
                 pass
+        if reopen_index:
+            self._open_index()
+
+    @contextlib.contextmanager
+    def staging_directory(self):
+        """ Context manager returning an empty directory on the cache's file system,
+        where builders can write their outputs.
+        If the files are put to the cache, the directory is moved to the cache
+        as a whole, otherwise it is deleted when the context manager ends. """
+        staging = self.directory / self._staging_dirname
+        staging.mkdir(parents=True, exist_ok=True)
+        path = pathlib.Path(tempfile.mkdtemp(prefix="", suffix="", dir=str(staging)))
+        try:
+            yield path
+        finally:
+            if path.exists():
+                shutil.rmtree(str(path))
+
+    def _is_staged(self, paths):
+        """ Check if the paths are exactly the files of one staging directory. """
+        if not paths:
+            return False
+        directory = paths[0].parent
+        if directory.parent != self.directory / self._staging_dirname:
+            return False
+        return sorted(directory.iterdir()) == sorted(paths)
 
     def put(self, final_hash, partial_hash, paths, implicit_dependencies):
         """ Add files to cache.
-        Moves the paths to the correct directory in cache. """
-
+        Moves the paths to the correct directory in cache. If the paths are all
+        files in a directory from staging_directory(), the directory becomes the
+        cache directory of the item with a single rename.
+        Concurrent builds may put the same item twice, the second one just
+        removes its paths. """
+
+        contents = [(util.sha1_file(path), path.stat().st_size) for path in paths]
+        with self._lock:
+            if final_hash in self._data:
+                for path in paths:
+                    path.unlink()
+                self.accessed(final_hash)
+                return
+            self._put(final_hash, partial_hash, paths, contents, implicit_dependencies)
+
+    def _put(self, final_hash, partial_hash, paths, contents, implicit_dependencies):
         assert final_hash not in self._data
         assert final_hash not in self._partial_hashes.get(partial_hash, [])
 
-        size = sum(path.stat().st_size for path in paths)
-
-        self._data[final_hash] = _Item(size, partial_hash, implicit_dependencies)
-        self._partial_hashes.setdefault(partial_hash, []).append(final_hash)
-
-        self._reserve_space(size)
+        size = 0
+        new_size = 0 # Size of contents not present in the cache yet
+        blobs = []
+        for content_hash, file_size in contents:
+            size += file_size
+            blob = self._blobs.get(content_hash)
+            if blob is None:
+                blob = self._blobs[content_hash] = [file_size, 0]
+                new_size += file_size
+            blob[1] += 1 # Referenced before reserving space, so that it can't get evicted
+            blobs.append(content_hash)
+
+        self._data[final_hash] = _Item(size, partial_hash,
+                                       self._intern_dependencies(implicit_dependencies),
+                                       tuple(blobs))
+        if self._index is None: # DiskIndex keeps its own table of partial hashes
+            self._partial_hashes.setdefault(partial_hash, []).append(final_hash)
+        self._indexes.pop(partial_hash, None)
+
+        self._reserve_space(new_size)
 
         directory = self.get_directory(final_hash)
         assert not directory.exists()
-        directory.mkdir(parents=True)
 
-        for path in paths:
-            path.rename(directory / path.name)
-        self.size_used += size
+        if self._is_staged(paths):
+            for path, content_hash in zip(paths, blobs):
+                blob_path = self.get_blob_path(content_hash)
+                if blob_path.exists():
+                    path.unlink()
+                    os.link(str(blob_path), str(path))
+                else:
+                    blob_path.parent.mkdir(parents=True, exist_ok=True)
+                    _make_read_only(path)
+                    os.link(str(path), str(blob_path))
+            directory.parent.mkdir(exist_ok=True)
+            paths[0].parent.rename(directory)
+            self.size_used += new_size
+            return
+
+        directory.mkdir(parents=True)
+        for path, content_hash in zip(paths, blobs):
+            blob_path = self.get_blob_path(content_hash)
+            if blob_path.exists():
+                path.unlink()
+            else:
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                _make_read_only(path)
+                path.rename(blob_path)
+            os.link(str(blob_path), str(directory / path.name))
+        self.size_used += new_size
+
+    def __contains__(self, final_hash):
+        with self._lock:
+            return final_hash in self._data
 
     def get_candidate_implicit_dependencies(self, partial_hash):
         """ Return list of possible implicit dependencies. """
+        with self._lock:
+            try:
+                candidate_hashes = self._partial_hashes[partial_hash]
+            except KeyError:
+                return []
+
+            return [self._get_dependencies(h) for h in candidate_hashes]
+
+    def find_implicit_dependencies(self, partial_hash, get_hash):
+        """ Return stored implicit dependencies for the partial hash that match
+        current hashes of the files, or None if there are none.
+        get_hash(path) returns the current hash of a file, it is called at most
+        once for each path. """
+        with self._lock:
+            if partial_hash not in self._partial_hashes:
+                return None
+
+            index = self._indexes.get(partial_hash)
+            if index is None:
+                index = _IndexNode()
+                for final_hash in self._partial_hashes[partial_hash]:
+                    item = self._data[final_hash]
+                    index.insert(self._dependency_sets[item.dependency_set][0], final_hash)
+                # Published complete, the search runs without the lock
+                # and indexes are never modified, only replaced
+                self._indexes[partial_hash] = index
+
+        hashes = {}
+        def cached_get_hash(path):
+            try:
+                return hashes[path]
+            except KeyError:
+                h = hashes[path] = get_hash(path)
+                return h
+
+        final_hash = index.search(cached_get_hash)
+        if final_hash is None:
+            return None
+        with self._lock:
+            if final_hash not in self._data:
+                return None # Evicted during the search
+            return self._get_dependencies(final_hash)
+
+    def _get_dependencies(self, final_hash):
+        return list(self._dependency_sets[self._data[final_hash].dependency_set][0])
+
+    def _intern_dependencies(self, implicit_dependencies):
+        """ Return id of the shared dependency set equal to the list of
+        (path, hash) pairs, create it if necessary. """
+        key = tuple(map(tuple, implicit_dependencies))
         try:
-            candidate_hashes = self._partial_hashes[partial_hash]
+            set_id = self._dependency_set_ids[key]
         except KeyError:
-            return []
-
-        return [self._data[h].implicit_dependencies for h in candidate_hashes]
+            key = tuple(self._intern_pair(pair) for pair in key)
+            set_id = self._next_dependency_set_id
+            self._next_dependency_set_id += 1
+            self._dependency_set_ids[key] = set_id
+            self._dependency_sets[set_id] = [key, 0]
+        self._dependency_sets[set_id][1] += 1
+        return set_id
+
+    def _release_dependencies(self, set_id):
+        record = self._dependency_sets[set_id]
+        record[1] -= 1
+        if record[1] == 0:
+            del self._dependency_sets[set_id]
+            del self._dependency_set_ids[record[0]]
+            for pair in record[0]:
+                pair_record = self._dependency_pairs[pair]
+                pair_record[1] -= 1
+                if pair_record[1] == 0:
+                    del self._dependency_pairs[pair]
+
+    def _intern_pair(self, pair):
+        """ Return the shared (path, hash) pair equal to pair, counting its uses
+        by dependency sets. """
+        record = self._dependency_pairs.get(pair)
+        if record is None:
+            record = self._dependency_pairs[pair] = [pair, 0]
+        record[1] += 1
+        return record[0]
+
+    def _rebuild_dependency_tables(self):
+        """ Recreate the lookup tables for dependency sets after loading. """
+        self._dependency_set_ids = {}
+        self._dependency_pairs = {}
+        for set_id, (pairs, refcount) in self._dependency_sets.items():
+            pairs = tuple(self._intern_pair(pair) for pair in pairs)
+            self._dependency_sets[set_id] = [pairs, refcount]
+            self._dependency_set_ids[pairs] = set_id
+        self._next_dependency_set_id = max(self._dependency_sets, default=-1) + 1
 
     def accessed(self, final_hash):
-        assert final_hash in self._data
-        self._data.move_to_end(final_hash)
+        with self._lock:
+            if final_hash in self._data: # May have been evicted by another thread
+                self._data.move_to_end(final_hash)
 
     def _reserve_space(self, size):
         """ Make sure there is at least size space in the cache available """
@@ -90,12 +448,118 @@ class Cache:
 
     def _discard_one(self):
         final_hash, item = self._data.popitem(last=False)
-        self._partial_hashes[item.partial_hash].remove(final_hash)
-        if not self._partial_hashes[item.partial_hash]:
-            del self._partial_hashes[item.partial_hash]
+        self._indexes.pop(item.partial_hash, None)
+        if self._index is None:
+            self._partial_hashes[item.partial_hash].remove(final_hash)
+            if not self._partial_hashes[item.partial_hash]:
+                del self._partial_hashes[item.partial_hash]
+        self._release_dependencies(item.dependency_set)
+
+        to_delete = [self.get_directory(final_hash)]
+        freed = 0
+        for content_hash in item.blobs:
+            blob = self._blobs[content_hash]
+            blob[1] -= 1
+            if blob[1] == 0:
+                del self._blobs[content_hash]
+                to_delete.append(self.get_blob_path(content_hash))
+                freed += blob[0]
+
+        self._move_to_trash(to_delete, freed)
+        self.size_used -= freed
+
+    def _move_to_trash(self, paths, size):
+        """ Atomically remove the paths from the cache and schedule
+        their deletion in a background thread. """
+        trash = self.directory / self._trash_dirname
+        trash.mkdir(exist_ok=True)
+        container = pathlib.Path(tempfile.mkdtemp(dir=str(trash)))
+        for i, path in enumerate(paths):
+            path.rename(container / str(i))
+            try:
+                path.parent.rmdir() # Remove the prefix directory if it became empty
+            except OSError:
+                pass
+        self._schedule_deletion(container, size)
 
-        shutil.rmtree(str(self.get_directory(final_hash)))
-        self.size_used -= item.size
+    def _trash_leftovers(self):
+        """ Schedule deletion of items that were evicted but not deleted
+        before the previous exit. """
+        trash = self.directory / self._trash_dirname
+        try:
+            leftovers = list(trash.iterdir())
+        except FileNotFoundError:
+            return
+        for path in leftovers:
+            self._schedule_deletion(path, 0)
+
+    def _schedule_deletion(self, path, size):
+        with self._trash_condition:
+            self._trash_queue.append((path, size))
+            self.pending_free += size
+            if self._deleter is None:
+                self._deleter = threading.Thread(target=self._deleter_thread,
+                                                 name="cache deleter",
+                                                 daemon=True)
+                self._deleter.start()
+
+    def wait_for_deletion(self):
+        """ Block until all evicted items are deleted from the disk. """
+        with self._trash_condition:
+            while self._deleter is not None:
+                self._trash_condition.wait()
+
+    def _deleter_thread(self):
+        """ Delete directories from the trash queue one by one, keeping
+        the deletion speed under delete_rate. Exits when the queue is empty.
+        Entries that fail to delete are left in the trash for the next start. """
+        start = time.monotonic()
+        deleted = 0
+        def throttle(size):
+            nonlocal deleted
+            deleted += size
+            if self.delete_rate:
+                delay = start + deleted / self.delete_rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        try:
+            while True:
+                with self._trash_condition:
+                    if not self._trash_queue:
+                        self._deleter = None
+                        self._trash_condition.notify_all()
+                        return
+                    path, size = self._trash_queue[0]
+
+                try:
+                    self._delete(path, throttle)
+                except Exception:
+                    logger.exception("Failed to delete %s from the cache trash", path)
+                finally:
+                    with self._trash_condition:
+                        self._trash_queue.popleft()
+                        self.pending_free -= size
+        finally:
+            with self._trash_condition:
+                if self._deleter is threading.current_thread():
+                    self._deleter = None # Don't leave wait_for_deletion hanging
+                    self._trash_condition.notify_all()
+
+    def _delete(self, path, throttle):
+        """ Delete a directory tree, calling throttle(size) after every file. """
+        for root, dirs, files in os.walk(str(path), topdown=False):
+            for name in files:
+                file_path = os.path.join(root, name)
+                try:
+                    size = os.stat(file_path).st_size
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    continue
+                throttle(size)
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        shutil.rmtree(str(path), ignore_errors=True)
 
     def get_directory(self, final_hash):
         h = binascii.hexlify(final_hash).decode("ascii")
@@ -103,8 +567,16 @@ class Cache:
         # but hey, git does it too :-)
         return self.directory / h[:2] / h[2:]
 
+    def get_blob_path(self, content_hash):
+        h = binascii.hexlify(content_hash).decode("ascii")
+        return self.directory / self._blobs_dirname / h[:2] / h[2:]
+
     def save(self):
         """ Save cache metadata to a file in the cache directory. """
+        with self._lock:
+            self._save()
+
+    def _save(self):
         if len(self._data) == 0:
             # There is no point in saving empty cache and we could get an error
             # because of nonexistent cache directory
@@ -112,10 +584,17 @@ class Cache:
 
         with (self.directory / self._save_filename).open("wb") as fp:
             pickler = pickle.Pickler(fp)
-            pickler.dump(1), # Version
+            pickler.dump(3), # Version
             pickler.dump(self.size_used)
-            pickler.dump(self._data)
-            pickler.dump(self._partial_hashes)
+            if self._index is None:
+                pickler.dump(self._data)
+                pickler.dump(self._partial_hashes)
+            else:
+                self._index.flush()
+                pickler.dump(None) # Items are in the index
+                pickler.dump(None)
+            pickler.dump(self._dependency_sets)
+            pickler.dump(self._blobs)
 
     def _load(self):
         """ Try to load metadata from a file in the cache directory.
@@ -130,9 +609,20 @@ class Cache:
             try:
                 unpickler = pickle.Unpickler(fp)
                 version = unpickler.load()
+                if version != 3:
+                    return False
                 self.size_used = unpickler.load()
-                self._data = unpickler.load()
-                self._partial_hashes = unpickler.load()
+                data = unpickler.load()
+                partial_hashes = unpickler.load()
+                if (data is None) != (self._index is not None):
+                    return False # Saved with the other kind of item storage
+                if data is not None:
+                    self._data = data
+                    self._partial_hashes = partial_hashes
+                self._dependency_sets = unpickler.load()
+                self._blobs = unpickler.load()
+                self._rebuild_dependency_tables()
+                self._indexes = {}
             except pickle.PickleError:
                 return False
             finally:
@@ -165,18 +655,49 @@ class Cache:
                 accessible_full_hashes[full_hash] = partial_hash
 
         owned_directories = set()
+        dependency_set_references = collections.Counter()
+        blob_references = collections.Counter()
         for full_hash, item in self._data.items():
             if full_hash not in accessible_full_hashes:
                 #print(5)
                 return False # Every full hash has at least one partial hash pointing to it
 
             owned_directories.add(self.get_directory(full_hash))
+            dependency_set_references[item.dependency_set] += 1
+            blob_references.update(item.blobs)
+
+        for set_id, (pairs, refcount) in self._dependency_sets.items():
+            if dependency_set_references[set_id] != refcount:
+                return False # Reference count of a dependency set must match its users
+
+            if self._dependency_set_ids.get(pairs) != set_id:
+                return False # Dependency set must be reachable by its contents
+
+        if len(dependency_set_references) != len(self._dependency_sets) or \
+           len(self._dependency_set_ids) != len(self._dependency_sets):
+            return False # Every item must use an existing dependency set
+
+        if blob_references != {content_hash: refcount
+                               for content_hash, (size, refcount) in self._blobs.items()}:
+            return False # Reference counts of blobs must match the items
+
+        owned_blobs = {self.get_blob_path(content_hash) for content_hash in self._blobs}
+        found_blobs = set()
+        seen_inodes = set()
+        trash = self.directory / self._trash_dirname
+        blobs_directory = self.directory / self._blobs_dirname
+        staging = self.directory / self._staging_dirname
+        index = self.directory / self._index_dirname
 
         def check_paths(root, in_cache):
+            if root == trash or root == staging or root == index:
+                return True, 0 # Items waiting for deletion and unfinished builds are not counted
+
             if root in owned_directories:
                 in_cache = True
 
             have_subdir = False
+            have_blobs = False
             size = 0
 
             for p in root.iterdir():
@@ -186,12 +707,19 @@ class Cache:
                         return False, 0
                     size += child_size
                     have_subdir = True
-                elif in_cache:
-                    size += p.stat().st_size
+                elif in_cache or p in owned_blobs:
+                    if p in owned_blobs:
+                        found_blobs.add(p)
+                        have_blobs = True
+                    stat = p.stat()
+                    if (stat.st_dev, stat.st_ino) not in seen_inodes:
+                        # Files of items are hardlinks to blobs, count each only once
+                        seen_inodes.add((stat.st_dev, stat.st_ino))
+                        size += stat.st_size
                 else:
                     return False, 0
 
-            return (in_cache or have_subdir), size
+            return (in_cache or have_subdir or have_blobs or root == blobs_directory), size
 
         if self.directory.exists():
             valid, size = check_paths(self.directory, False)
@@ -201,6 +729,9 @@ class Cache:
         else:
             size = 0
 
+        if found_blobs != owned_blobs:
+            return False # Every blob must exist
+
         if size != self.size_used:
             #print(7)
             return False # Calculated size must be equal to real file size
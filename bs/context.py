@@ -1,69 +1,216 @@
 from . import nodes
 from . import cache
 from . import traversal
+from . import progress
 
-import queue
+import concurrent.futures
 import contextlib
+import tempfile
+import pathlib
+import os
 
 class Context:
     """ State of single update.
     Used by the nodes' update methods as an interface to backend and
-    to give reports trough the shared queue. """
+    to give reports trough the progress channel. """
 
-    def __init__(self, backend, targets, output_directory):
+    _batch_size = 256 # Maximal number of events sent to the client at once
+
+    def __init__(self, backend, targets, output_directory, niceness=0, tokens=None, remote=None,
+                 background=False):
         self.stop_flag = False
+        self.niceness = niceness # Added to priority of the commands run
+        self.background = background # Jobs of other updates go first
+        self.tokens = tokens # Job tokens of the commands if not the backend's (jobserver.Client)
+        self.remote = remote # remote.RemoteExecutor running the actions, None to run them locally
 
         self.backend = backend
-        self._queue = queue.Queue()
+        self.cache = backend.cache
+        self.temp_directory = backend.temp_directory
+        self.staging = backend.staging
+        self.progress = progress.Channel()
         self._finished = False
         self._exception = None
-        self.targets = targets
+        self.targets = list(targets)
+        self.output_directory = output_directory
 
     def log(self, fmt, *args, **kwargs):\
         #TODO: Convert this to use logging
-        self._queue.put(fmt.format(*args, **kwargs))
+        self.progress.put(progress.Log(fmt.format(*args, **kwargs)), important=True)
+
+    def status(self, running, done, remaining):
+        """ Report numbers of jobs, only the latest status is sent to the client. """
+        self.progress.set_status(progress.Status(running, done, remaining))
 
     def finish(self):
         self._finished = True
+        self.progress.close() # Wake up iterate_progress
 
     def exception(self, e):
-        self._finished = True
         self.stop_flag = True
         self._exception = e
+        self.finish()
 
-    def iterate_log_messages(self):
-        """ Go through the logged messages.
+    def iterate_progress(self):
+        """ Go through the progress events, yields lists of events (see progress module).
         This is intended to be called from a different thread than writing the messages.
-        Iteration stops if the future associated with this context is not running
-        and will raise any exceptions raised inside the future. """
+        Iteration stops when the update finishes and raises the exception
+        the update failed with. """
 
-        while not (self._finished and self._queue.empty()):
-            item = self._queue.get()
-            yield item
+        try:
+            while True:
+                batch = self.progress.get_batch(self._batch_size)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            if not self._finished:
+                self.stop_flag = True # Nobody is listening anymore
+                self.progress.close() # Don't block the writers
+            if self.tokens is not None:
+                self.tokens.close() # The client that lent us the tokens is done
 
         if self._exception:
             raise self._exception
 
-    def run_command(self, command, timeout=600): #TODO: Somehow set default timeout
-        command = [str(x) for x in command]
+    def run_command(self, command, timeout=600, limits=None, cwd=None): #TODO: Somehow set default timeout
+        """ Run an external command, wait for it to finish and return its stdout.
+        Output of the command is streamed to the log while it runs.
+        cwd is the working directory of the command, the backend's working
+        directory is not meaningful for builds.
+        Raises exception if the command fails. """
+        return self.submit_command(command, timeout, limits, cwd).result()
+
+    def submit_command(self, command, timeout=600, limits=None, cwd=None):
+        """ Start an external command without waiting for it.
+        Returns a concurrent.futures.Future with stdout of the command. """
         #if self.verbose: TODO: Client has to run the build steps !!!
             #print(command)
-
-        with subprocess.Popen(command,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True) as p:
+        return self.backend.runner.submit(command,
+                                          log=self._log_command_output,
+                                          timeout=timeout,
+                                          limits=limits,
+                                          cwd=cwd,
+                                          niceness=self.niceness,
+                                          tokens=self.tokens,
+                                          background=self.background)
+
+    def run_action(self, command, input_paths, output_paths, timeout=600, cwd=None):
+        """ Run a command that reads only the given input files and writes only
+        the given output files (absolute paths), on a remote worker if the update
+        has any. Arguments of the command that are equal to one of the paths are
+        replaced by paths valid on the worker, and back to the local paths in stdout.
+        cwd is used for local runs, remote commands run in their action directory.
+        Returns stdout of the command, stderr is logged. """
+        return self.submit_action(command, input_paths, output_paths, timeout, cwd).result()
+
+    def submit_action(self, command, input_paths, output_paths, timeout=600, cwd=None):
+        """ Like run_action, but returns a concurrent.futures.Future with the stdout.
+        Only local commands run without waiting, remote actions are done when
+        this returns. """
+        if self.remote is None:
+            return self.submit_command(command, timeout, cwd=cwd)
+
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(self._run_remote_action(command, input_paths, output_paths, timeout))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _run_remote_action(self, command, input_paths, output_paths, timeout):
+        remote = self.remote
+
+        mapping = {}
+        remote_inputs = {}
+        remote_outputs = {}
+        for prefix, paths, remote_paths in (("in", input_paths, remote_inputs),
+                                            ("out", output_paths, remote_outputs)):
+            for i, path in enumerate(paths):
+                path = pathlib.Path(path)
+                remote_path = "{}/{}/{}".format(prefix, i, path.name)
+                mapping[str(path)] = remote_path
+                remote_paths[remote_path] = path
+
+        stdout, stderr = remote.execute([mapping.get(str(arg), str(arg)) for arg in command],
+                                        remote_inputs, remote_outputs, timeout)
+        for line in stderr.splitlines():
+            self._log_command_output("stderr", line)
+        for local_path, remote_path in mapping.items():
+            stdout = stdout.replace(remote_path, local_path)
+        return stdout
+
+    def file_by_path(self, path):
+        """ Return SourceFile node for an absolute path. """
+        return self.backend._files_by_paths([path])[0]
+
+    def files_by_paths(self, paths):
+        """ Return list of SourceFile nodes for a list of absolute paths. """
+        return self.backend._files_by_paths(paths)
+
+    def record_statistics(self, application, elapsed):
+        """ Record build time and changes of source files used by a built application. """
+        statistics = self.backend.statistics
+        builder = application.builder
+        sources = [input for input in application.inputs if isinstance(input, nodes.SourceFile)]
+        for source in sources:
+            statistics.record(source.path,
+                              None if builder.transparent else elapsed / len(application.inputs),
+                              source.get_hash())
+
+        if builder.transparent:
+            return
+        for input in application.inputs:
+            if isinstance(input, nodes.GeneratedFile) and input.application.builder.transparent:
+                members = [member for member in input.application.inputs
+                           if isinstance(member, nodes.SourceFile)]
+                for member in members:
+                    statistics.record(member.path, elapsed / len(members), batch=input.name)
+
+    def build_in_processes(self, builder, jobs):
+        """ Run builder.build for all jobs ((input_paths, output_paths) tuples)
+        in the backend's process pool, return list of their implicit dependencies.
+        Builders the pool can't load are built in this process instead. """
+        if not self.backend._can_use_process_pool(builder):
+            self.log("{} is defined in __main__ and can't be loaded by the process pool, "
+                     "building in the backend process. Move it to a module to use the pool.",
+                     type(builder).__name__)
+            return [builder.build(self, input_paths, output_paths)
+                    for input_paths, output_paths in jobs]
+
+        # Every build in the pool holds a job token, like an external command
+        runner = self.backend.runner
+        futures = []
+        for input_paths, output_paths in jobs:
+            runner.acquire_token()
             try:
-                stdout, stderr = p.communicate(timeout=timeout)
+                future = self.backend._submit_build(builder, input_paths, output_paths)
             except:
-                p.kill()
-                p.wait()
+                runner.release_token()
                 raise
+            future.add_done_callback(lambda future: runner.release_token())
+            futures.append(future)
 
-            if p.returncode != 0:
-                raise Exception("Command failed", command, stdout, stderr, p.returncode)
+        ret = []
+        for future in futures:
+            dependencies, messages = future.result()
+            for message in messages:
+                self.log("{}", message)
+            ret.append(dependencies)
+        return ret
 
-            return stdout
+    @contextlib.contextmanager
+    def worker(self, command):
+        """ Context manager returning a persistent worker started with the given
+        command (see worker.PersistentWorker). The worker holds a job token
+        while it is in use. """
+        with self.backend.runner.token(), \
+             self.backend.workers.worker(command, self._log_command_output) as worker:
+            yield worker
+
+    def _log_command_output(self, stream_name, line):
+        # Commands can be very verbose, their output is dropped if the client can't keep up
+        self.progress.put(progress.Log("{}: {}".format(stream_name, line)))
 
     @contextlib.contextmanager
     def tempfile(self, filename=""):
@@ -92,20 +239,14 @@ class Context:
             if path.exists():
                 path.unlink()
 
-    @contextlib.contextmanager
     def tempdir(self):
-        """ Context manager returning a path to a temporary directory in the build directory.
-        The directory is deleted when the context manager ends. """
-
-        try:
-            self.temp_directory.mkdir(parents=True)
-        except FileExistsError:
-            pass
-        path = tempfile.mkdtemp(prefix="", suffix="",
-                                dir=str(self.temp_directory))
-        path = pathlib.Path(path)
-
-        try:
-            yield path
-        finally:
-            shutil.rmtree(str(path))
+        """ Context manager returning a path to an empty temporary directory
+        (on tmpfs, if possible). The directory is emptied and recycled when
+        the context manager ends. """
+        return self.staging.tempdir()
+
+    def staging_directory(self):
+        """ Context manager returning a path to an empty directory for outputs of a build.
+        The directory is on the same file system as the cache, so that the outputs
+        can be moved to cache as a whole. """
+        return self.cache.staging_directory()
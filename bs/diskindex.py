@@ -0,0 +1,297 @@
+import collections
+import mmap
+import os
+import random
+import struct
+
+Record = collections.namedtuple("Record", "final_hash partial_hash size dependency_set stamp")
+
+_EMPTY = 0
+_USED = 1
+_DELETED = 2
+
+class _Table:
+    """ Open addressing hash table with fixed size records in a memory mapped file.
+    Record starts with a state byte followed by the key at offset 8, slot of a record
+    is selected by the first 8 bytes of the key (keys are hashes already), collisions
+    are resolved by linear probing.
+    Only the pages touched by the probe sequence are read from the disk. """
+
+    _header = struct.Struct("<8sQQQQ") # magic, capacity, count, deleted, clock
+    _header_size = 64
+    _max_load = 0.7
+
+    def __init__(self, path, magic, record_size, key_size, initial_capacity):
+        self.path = path
+        self._magic = magic
+        self._record_size = record_size
+        self._key_size = key_size
+
+        try:
+            fd = os.open(str(path), os.O_RDWR)
+        except FileNotFoundError:
+            self._create(path, initial_capacity)
+            fd = os.open(str(path), os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        magic, self.capacity, self.count, self._deleted, self.clock = \
+            self._header.unpack_from(self._map, 0)
+        if magic != self._magic or \
+           len(self._map) != self._header_size + self.capacity * self._record_size:
+            self._map.close()
+            raise ValueError("Invalid index file", path)
+
+    def _create(self, path, capacity):
+        tmp_path = path.with_name(path.name + ".new")
+        with tmp_path.open("wb") as fp:
+            fp.write(self._header.pack(self._magic, capacity, 0, 0, 0).ljust(self._header_size, b"\0"))
+            fp.truncate(self._header_size + capacity * self._record_size)
+        os.replace(str(tmp_path), str(path))
+
+    def close(self):
+        self._write_header()
+        self._map.close()
+
+    def flush(self):
+        self._write_header()
+        self._map.flush()
+
+    def _write_header(self):
+        self._header.pack_into(self._map, 0, self._magic, self.capacity,
+                               self.count, self._deleted, self.clock)
+
+    def _offset(self, slot):
+        return self._header_size + slot * self._record_size
+
+    def _probe(self, key_prefix):
+        """ Iterate over (offset, state) of slots in the probe sequence for the key prefix,
+        ends at the first empty slot. """
+        slot = int.from_bytes(key_prefix[:8], "little") % self.capacity
+        for i in range(self.capacity):
+            offset = self._offset((slot + i) % self.capacity)
+            state = self._map[offset]
+            yield offset, state
+            if state == _EMPTY:
+                return
+
+    def _key_at(self, offset):
+        return self._map[offset + 8:offset + 8 + self._key_size]
+
+    def find(self, key):
+        """ Return offset of the record with given key, or None. """
+        for offset, state in self._probe(key):
+            if state == _USED and self._key_at(offset) == key:
+                return offset
+        return None
+
+    def find_prefix(self, prefix):
+        """ Iterate over offsets of records whose key starts with the prefix.
+        Prefix must be at least 8 bytes long, because it selects the slot. """
+        for offset, state in self._probe(prefix):
+            if state == _USED and self._key_at(offset).startswith(prefix):
+                yield offset
+
+    def insert(self, key, record):
+        """ Store a new record (bytes without the state byte), key must not be present yet. """
+        if (self.count + self._deleted + 1) > self.capacity * self._max_load:
+            self._rehash()
+
+        for offset, state in self._probe(key):
+            if state != _USED:
+                if state == _DELETED:
+                    self._deleted -= 1
+                self._map[offset + 1:offset + self._record_size] = record
+                self._map[offset] = _USED
+                self.count += 1
+                return offset
+        raise AssertionError("Index full") # Can't happen thanks to the load limit
+
+    def delete(self, offset):
+        self._map[offset] = _DELETED
+        self.count -= 1
+        self._deleted += 1
+
+    def records(self):
+        """ Iterate over offsets of all records. """
+        for slot in range(self.capacity):
+            offset = self._offset(slot)
+            if self._map[offset] == _USED:
+                yield offset
+
+    def random_records(self, n, rng=random):
+        """ Return offsets of up to n randomly selected records. """
+        ret = []
+        if not self.count:
+            return ret
+        while len(ret) < min(n, self.count):
+            offset = self._offset(rng.randrange(self.capacity))
+            if self._map[offset] == _USED and offset not in ret:
+                ret.append(offset)
+        return ret
+
+    def _rehash(self):
+        """ Copy all records to a new file, twice as large if the table is
+        filled by records rather than by deleted slots. """
+        capacity = self.capacity
+        if (self.count + 1) * 2 > capacity * self._max_load:
+            capacity *= 2
+
+        old_map = self._map
+        old_offsets = list(self.records())
+        clock = self.clock
+
+        tmp_path = self.path.with_name(self.path.name + ".rehash")
+        self._create(tmp_path, capacity)
+        fd = os.open(str(tmp_path), os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+        self.count = 0
+        self._deleted = 0
+        self.clock = clock
+
+        for offset in old_offsets:
+            record = old_map[offset + 1:offset + self._record_size]
+            self.insert(record[7:7 + self._key_size], record)
+
+        self._write_header()
+        os.replace(str(tmp_path), str(self.path))
+        old_map.close()
+
+class DiskIndex:
+    """ Index of cache items stored in memory mapped files, an alternative to keeping
+    the metadata of every item in Python dicts (used by cache.Cache with disk_index).
+    Every item has a fixed size record with final hash, partial hash, size,
+    id of its dependency set and LRU stamp, a second table maps partial hashes
+    to final hashes and a third one lists content hashes of the item's files.
+    Memory used by the index doesn't depend on number of items, only pages
+    touched by lookups are loaded.
+    Intended for use from a single thread at a time. """
+
+    _final_record = struct.Struct("<7x20s20sQQQ") # final hash, partial hash, size, dependency set, stamp
+    _partial_record = struct.Struct("<7x20s20s") # partial hash, final hash
+    _blob_record = struct.Struct("<7x20sI20s") # final hash, position, content hash
+    _stamp_offset = 1 + 7 + 20 + 20 + 8 + 8 # Offset of the stamp in a record of the final table
+    hash_size = 20
+
+    def __init__(self, directory, initial_capacity=1024):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._final = _Table(directory / "final.index", b"bsfinal1",
+                             1 + self._final_record.size, self.hash_size, initial_capacity)
+        self._partial = None
+        self._blobs = None
+        try:
+            self._partial = _Table(directory / "partial.index", b"bspartl1",
+                                   1 + self._partial_record.size, 2 * self.hash_size, initial_capacity)
+            self._blobs = _Table(directory / "blobs.index", b"bsblobs1",
+                                 1 + self._blob_record.size, self.hash_size + 4, initial_capacity)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for table in (self._final, self._partial, self._blobs):
+            if table is not None:
+                table.close()
+
+    def flush(self):
+        self._final.flush()
+        self._partial.flush()
+        self._blobs.flush()
+
+    def __len__(self):
+        return self._final.count
+
+    def __contains__(self, final_hash):
+        return self._final.find(final_hash) is not None
+
+    def _check_hash(self, h):
+        if len(h) != self.hash_size:
+            raise ValueError("Hash must have {} bytes".format(self.hash_size), h)
+
+    def _read(self, offset):
+        return Record(*self._final_record.unpack_from(self._final._map, offset + 1))
+
+    def _tick(self):
+        self._final.clock += 1
+        return self._final.clock
+
+    def get(self, final_hash):
+        """ Return Record for the final hash, or None. """
+        offset = self._final.find(final_hash)
+        if offset is None:
+            return None
+        return self._read(offset)
+
+    def put(self, final_hash, partial_hash, size, dependency_set=0, blobs=()):
+        """ Add a new item as the most recently used one.
+        blobs are content hashes of the item's files. """
+        self._check_hash(final_hash)
+        self._check_hash(partial_hash)
+        for content_hash in blobs:
+            self._check_hash(content_hash)
+        if final_hash in self:
+            raise KeyError("Final hash already present", final_hash)
+
+        self._final.insert(final_hash, self._final_record.pack(final_hash, partial_hash, size,
+                                                               dependency_set, self._tick()))
+        self._partial.insert(partial_hash + final_hash,
+                             self._partial_record.pack(partial_hash, final_hash))
+        for i, content_hash in enumerate(blobs):
+            self._blobs.insert(final_hash + struct.pack("<I", i),
+                               self._blob_record.pack(final_hash, i, content_hash))
+
+    def accessed(self, final_hash):
+        """ Mark the item as the most recently used one. """
+        offset = self._final.find(final_hash)
+        if offset is None:
+            raise KeyError(final_hash)
+        struct.pack_into("<Q", self._final._map, offset + self._stamp_offset, self._tick())
+
+    def remove(self, final_hash):
+        """ Remove an item, return its Record. """
+        offset = self._final.find(final_hash)
+        if offset is None:
+            raise KeyError(final_hash)
+        record = self._read(offset)
+        self._final.delete(offset)
+        self._partial.delete(self._partial.find(record.partial_hash + final_hash))
+        for offset in list(self._blobs.find_prefix(final_hash)):
+            self._blobs.delete(offset)
+        return record
+
+    def blobs(self, final_hash):
+        """ Return tuple of content hashes of the item's files, in the order given to put. """
+        records = (self._blob_record.unpack_from(self._blobs._map, offset + 1)
+                   for offset in self._blobs.find_prefix(final_hash))
+        return tuple(content_hash for final, i, content_hash in sorted(records, key=lambda r: r[1]))
+
+    def final_hashes(self, partial_hash):
+        """ Return list of final hashes stored for the partial hash. """
+        return [self._partial._key_at(offset)[self.hash_size:]
+                for offset in self._partial.find_prefix(partial_hash)]
+
+    def __iter__(self):
+        """ Iterate over all records in no particular order. """
+        for offset in self._final.records():
+            yield self._read(offset)
+
+    def eviction_candidate(self, samples=16, rng=random):
+        """ Approximate the least recently used item by the oldest one of randomly
+        sampled records, without keeping any ordering of the whole index.
+        Returns its Record, or None if the index is empty. """
+        offsets = self._final.random_records(samples, rng)
+        if not offsets:
+            return None
+        return min((self._read(offset) for offset in offsets), key=lambda record: record.stamp)
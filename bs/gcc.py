@@ -1,8 +1,105 @@
 from . import nodes
 from . import util
 
+import collections
+import contextlib
+import hashlib
+import pathlib
+import re
 import subprocess
-import shlex
+
+_depfile_token = re.compile(r"(?:\\.|[^\s\\])+")
+_depfile_escape = re.compile(r"\\([ #\\])")
+
+def parse_depfile(text):
+    """ Parse makefile rules generated by gcc -MD.
+    Returns list of prerequisites of all rules, without duplicates and in order
+    of their first appearance. Handles line continuations and escaped
+    spaces, hashes and dollars. """
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+    simple = "\\" not in text and "$" not in text
+
+    ret = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        # The target ends at the first colon followed by whitespace
+        # (this skips drive letters and escaped colons).
+        colon = line.find(": ")
+        if colon < 0:
+            if not line.rstrip().endswith(":"):
+                raise Exception("Unexpected dependencies string.")
+            continue # Rule without prerequisites (generated by -MP)
+
+        prerequisites = line[colon + 2:]
+        if simple:
+            tokens = prerequisites.split()
+        else:
+            tokens = (_depfile_escape.sub(r"\1", token).replace("$$", "$")
+                      for token in _depfile_token.findall(prerequisites))
+        for token in tokens:
+            ret[token] = None
+    return list(ret)
+
+# gcc executable -> bool, whether its linker supports --dependency-file
+_dependency_file_support = {}
+
+def parse_linker_trace(text):
+    """ Parse output of ld --trace, return list of files used by the linker
+    without duplicates and in order of their first appearance.
+    Handles both plain paths and the "-lname (path)" and "archive(member)" forms
+    printed by older versions of ld. """
+    ret = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or ": mode " in line:
+            continue
+
+        if line.startswith("-l") and line.endswith(")") and " (" in line:
+            line = line[line.index(" (") + 2:-1]
+        elif line.endswith(")") and "(" in line:
+            line = line[:line.index("(")]
+        ret[line] = None
+    return list(ret)
+
+# Source suffix -> suffix of preprocessed file
+_preprocessed_suffixes = {".c": ".i",
+                          ".cc": ".ii", ".cp": ".ii", ".cxx": ".ii", ".cpp": ".ii",
+                          ".CPP": ".ii", ".c++": ".ii", ".C": ".ii"}
+
+# Source suffix -> language of the source
+_source_languages = {suffix: "c" if preprocessed == ".i" else "c++"
+                     for suffix, preprocessed in _preprocessed_suffixes.items()}
+
+def hash_preprocessed(path, keep_lines=False, strip=False, keep_names=False):
+    """ Hash preprocessor output, ignoring the file names in line markers
+    unless keep_names is True (together with keep_lines).
+    If keep_lines is False, line markers and empty lines are skipped completely,
+    so edits that only move code around (comments, empty lines) don't change the hash.
+    This should be only used when no debug info is generated.
+    If strip is True leading and trailing whitespace of lines is ignored too
+    (not safe for C++, where raw string literals can span lines). """
+    hasher = hashlib.sha1()
+    with path.open("rb") as fp:
+        for line in fp:
+            if line.startswith(b"# ") and line[2:3].isdigit():
+                if keep_names:
+                    hasher.update(line.rstrip(b"\r\n"))
+                    hasher.update(b"\n")
+                elif keep_lines:
+                    hasher.update(line.split(b" ", 2)[1])
+                    hasher.update(b"\n")
+                continue
+
+            if not keep_lines:
+                if strip:
+                    line = line.strip()
+                if not line.strip():
+                    continue
+            hasher.update(line.rstrip(b"\r\n"))
+            hasher.update(b"\n")
+    return hasher.digest()
 
 class GccCompiler(nodes.Builder):
     def __init__(self):
@@ -10,24 +107,120 @@ class GccCompiler(nodes.Builder):
         self.executable = "gcc"
         self.cflags = []
 
+        # Use hash of the preprocessed source as a cache key (like ccache).
+        # Costs running the preprocessor for every update, but edits of headers
+        # that don't change the preprocessed output (comments, whitespace, and
+        # without debug info also moved lines) can be served from the cache.
+        # Ignored when a precompiled header is used.
+        self.preprocessor_mode = False
+
     def build(self, context, input_paths, output_paths):
         """ Build input_paths is a list of pathlib.Path objects that should be
         compiled into list of patlib.Path objects output_paths. """
+        return self.submit_build(context, input_paths, output_paths).result()
 
-        with context.tempfile() as depfile:
-            commandline = [self.executable]
-            commandline.extend(self.cflags)
-            commandline = [self.expand_variables(context, x) for x in commandline]
+    def submit_build(self, context, input_paths, output_paths):
+        """ Start the compiler, see Builder.submit_build. """
+        if self._uses_preprocessor():
+            # Input was created by preprocess(), which also found the dependencies.
+            # It doesn't need any other files and can be compiled remotely, unless
+            # the debug info would get the worker's directory.
+            commandline = self._get_commandline(context)
+            commandline.extend(["-c",
+                                "-o", str(output_paths[0]),
+                                str(input_paths[0])])
+            if self._has_debug_info():
+                # The original source follows, debug info records its directory
+                pending = context.submit_command(commandline, cwd=input_paths[1].parent)
+            else:
+                pending = context.submit_action(commandline, input_paths[:1], output_paths)
 
+            def check_result(future):
+                future.result() # Raises if the compiler failed
+                return []
+            return util.map_future(pending, check_result)
+
+        with contextlib.ExitStack() as stack:
+            depfile = stack.enter_context(context.tempfile())
+            commandline = self._get_commandline(context)
+            commandline.extend(self._get_extra_flags(context, input_paths[0]))
             commandline.extend(["-c",
                                 "-MD",
                                 "-MF", str(depfile),
                                 "-o", str(output_paths[0]),
                                 str(input_paths[0])])
-            context.run_command(commandline)
+            pending = context.submit_command(commandline)
+            stack = stack.pop_all() # The depfile is removed after reading it
+
+        def read_dependencies(future):
+            with stack:
+                future.result()
+                with depfile.open("r") as fp:
+                    return self._parse_dependencies(fp.read())
+        return util.map_future(pending, read_dependencies)
+
+    def _uses_preprocessor(self):
+        """ Check if preprocess() runs, build then gets its output. """
+        return self.preprocessor_mode and "precompiled_header" not in self.named_dependencies
+
+    def preprocess(self, context, input_paths, temp_directory):
+        """ Run only the preprocessor in preprocessor mode, see Builder.preprocess. """
+        if not self._uses_preprocessor():
+            return None
+
+        input_path = input_paths[0]
+        suffix = _preprocessed_suffixes.get(input_path.suffix, ".i")
+        preprocessed_path = temp_directory / (input_path.stem + suffix)
+
+        with context.tempfile() as depfile:
+            commandline = self._get_commandline(context)
+            commandline.extend(["-E",
+                                "-MD",
+                                "-MF", str(depfile),
+                                "-o", str(preprocessed_path),
+                                str(input_path)])
+            # With debug info the working directory is written to a line marker
+            context.run_command(commandline, cwd=input_path.parent)
 
             with depfile.open("r") as fp:
-                return self._parse_dependencies(fp.read())
+                dependencies = self._parse_dependencies(fp.read())
+
+        if not self._has_debug_info():
+            content_hash = hash_preprocessed(preprocessed_path, strip=(suffix == ".i"))
+            return content_hash, [preprocessed_path], dependencies
+
+        # Debug info contains the source paths and the compilation directory,
+        # which is the directory of the source (not of the backend, that is "/")
+        content_hash = hash_preprocessed(preprocessed_path, keep_lines=True, keep_names=True,
+                                         strip=(suffix == ".i"))
+        content_hash = util.sha1_iterable([content_hash, str(input_path.parent)])
+        return content_hash, [preprocessed_path, input_path], dependencies
+
+    def _has_debug_info(self):
+        debug = False
+        for flag in self.cflags:
+            if flag.startswith("-g"):
+                debug = flag != "-g0"
+        return debug
+
+    def _get_commandline(self, context):
+        commandline = [self.executable]
+        commandline.extend(self.cflags)
+        return [self.expand_variables(context, x) for x in commandline]
+
+    def _get_extra_flags(self, context, input_path):
+        precompiled_header = self.named_dependencies.get("precompiled_header")
+        if precompiled_header is None:
+            return []
+
+        language = _source_languages.get(input_path.suffix)
+        if language is not None and language != precompiled_header.application.builder.language:
+            return [] # Can't be used, the source includes the header itself
+
+        # gcc looks for the .gch file next to the included header first,
+        # the header itself doesn't have to exist.
+        gch_path = str(precompiled_header.get_path(context))
+        return ["-Winvalid-pch", "-include", gch_path[:-len(".gch")]]
 
     def get_output_count(self, input_count):
         """ Return how many files will be generated by this build step.
@@ -38,7 +231,13 @@ class GccCompiler(nodes.Builder):
         return 1
 
     def get_hash(self):
-        return util.sha1_iterable([self.executable], self.cflags)
+        precompiled_header = self.named_dependencies.get("precompiled_header")
+        if precompiled_header is None:
+            return util.sha1_iterable([self.executable], self.cflags)
+        # Headers included by the precompiled header are not listed in the
+        # depfiles, they are covered by the hash of the .gch file.
+        return util.sha1_iterable([self.executable], self.cflags,
+                                  [precompiled_header.get_hash()])
 
     def create_associated_linker(self):
         """ Returns a linker that uses the same gcc executable as this compiler
@@ -47,23 +246,65 @@ class GccCompiler(nodes.Builder):
         linker.executable = self.executable
         linker.cflags = self.cflags[:]
 
-        for name, dep in self.named_dependencies.items():
-            assert dep not in linker.dependencies
-            linker.add_dependency(dep, name)
-
+        self._copy_named_dependencies(linker)
         return linker
 
+    def create_precompiled_header_builder(self, language):
+        """ Returns a builder that precompiles headers of the language ("c" or "c++")
+        using the same gcc executable and cflags as this compiler. """
+        builder = GccPrecompiledHeader(language)
+        builder.executable = self.executable
+        builder.cflags = self.cflags[:]
+        self._copy_named_dependencies(builder)
+        return builder
+
+    def add_precompiled_header(self, user_context, header, language=None):
+        """ Precompile header and include it in every file compiled by this compiler
+        (using -include). The header must be protected by include guards,
+        so that it can also be included from the sources as usual.
+        language ("c" or "c++") must match the sources, by default it is c++
+        for g++ like executables and c otherwise. Sources of the other language
+        are compiled without the precompiled header.
+        The compiler must not be modified (cflags, dependencies) after this call.
+        Returns the generated .gch file. """
+        if "precompiled_header" in self.named_dependencies:
+            raise RuntimeError("Compiler already has a precompiled header")
+        if language is None:
+            language = "c++" if pathlib.Path(self.executable).name.endswith("++") else "c"
+
+        name = pathlib.Path(str(getattr(header, "name", header))).name + ".gch"
+        gch_file, = user_context.apply(self.create_precompiled_header_builder(language),
+                                       header, name)
+        self.add_dependency(gch_file, "precompiled_header")
+        return gch_file
+
+    def _copy_named_dependencies(self, builder):
+        for name, dep in self.named_dependencies.items():
+            if name == "precompiled_header":
+                continue
+            assert dep not in builder.dependencies
+            builder.add_dependency(dep, name)
+
     @staticmethod
     def _parse_dependencies(dependencies):
-        split = shlex.split(dependencies)
+        # Headers shared by many translation units end up as a single SourceFile
+        # node (see Context.files_by_paths), a path is only needed once per parse
+        return [pathlib.Path(path) for path in sorted(set(parse_depfile(dependencies)))]
 
-        if not len(split):
-            return []
+class GccPrecompiledHeader(GccCompiler):
+    """ Compiles a header into a precompiled header (.gch file).
+    Use GccCompiler.add_precompiled_header to create it. """
+
+    def __init__(self, language="c"):
+        super().__init__()
+        self.language = language
 
-        if not split[0].endswith(":"):
-            raise Exception("Unexpected dependencies string.")
+    def _get_extra_flags(self, context, input_path):
+        return ["-x", self.language + "-header"]
 
-        return sorted(set(x for x in split[1:] if x.strip()))
+    def get_hash(self):
+        return util.sha1_iterable([self.executable], self.cflags,
+                                  ["precompiled header", self.language])
 
 class GccLinker(nodes.Builder):
     def __init__(self):
@@ -74,18 +315,60 @@ class GccLinker(nodes.Builder):
     def build(self, context, input_paths, output_paths):
         """ Build input_paths is a list of pathlib.Path objects that should be
         compiled into list of patlib.Path objects output_paths. """
+        return self.submit_build(context, input_paths, output_paths).result()
+
+    def submit_build(self, context, input_paths, output_paths):
+        """ Start the linker, see Builder.submit_build. """
+        # Remote links report the libraries only in the trace, where run_action
+        # translates paths of the inputs back
+        use_dependency_file = context.remote is None and self._supports_dependency_file(context)
+        # Relative paths in the trace are relative to the linker's working directory
+        cwd = output_paths[0].parent
 
-        with context.tempfile("dep") as depfile:
+        with contextlib.ExitStack() as stack:
+            depfile = stack.enter_context(context.tempfile("dep"))
             commandline = [self.executable]
             commandline.extend(self.cflags)
             commandline = [self.expand_variables(context, x) for x in commandline]
 
-            commandline.extend(["-Wl,--trace",
-                                "-o", str(output_paths[0])])
+            if use_dependency_file:
+                commandline.append("-Wl,--dependency-file=" + str(depfile))
+            else:
+                commandline.append("-Wl,--trace")
+            commandline.extend(["-o", str(output_paths[0])])
             commandline.extend(str(f) for f in input_paths)
-            context.run_command(commandline)
+            pending = context.submit_action(commandline, input_paths, output_paths, cwd=cwd)
+            stack = stack.pop_all() # The depfile is removed after reading it
+
+        def read_dependencies(future):
+            with stack:
+                stdout = future.result()
+                if use_dependency_file:
+                    with depfile.open("r") as fp:
+                        paths = parse_depfile(fp.read())
+                else:
+                    paths = parse_linker_trace(stdout)
+
+            # Libraries, startup files and linker scripts become implicit dependencies,
+            # the explicit inputs are already tracked.
+            explicit = set(str(path) for path in input_paths)
+            paths = set(str(cwd / path) for path in paths)
+            return [pathlib.Path(path) for path in sorted(paths - explicit)]
+        return util.map_future(pending, read_dependencies)
 
-            #TODO: return dependencies;
+    def _supports_dependency_file(self, context):
+        """ Check if the linker used by our gcc supports --dependency-file (binutils >= 2.35). """
+        try:
+            return _dependency_file_support[self.executable]
+        except KeyError:
+            pass
+
+        try:
+            supported = "--dependency-file" in context.run_command([self.executable, "-Wl,--help"])
+        except Exception:
+            supported = False
+        _dependency_file_support[self.executable] = supported
+        return supported
 
     def get_output_count(self, input_count):
         """ Return how many files will be generated by this build step.
@@ -97,3 +380,112 @@ class GccLinker(nodes.Builder):
 
     def get_hash(self):
         return self.hash_helper([self.executable], self.cflags)
+
+class UnityGenerator(nodes.Builder):
+    """ Generates a single source file that includes all of its inputs
+    (a unity or jumbo translation unit). """
+    transparent = True
+
+    def build(self, context, input_paths, output_paths):
+        with output_paths[0].open("w") as fp:
+            for path in input_paths:
+                fp.write('#include "{}"\n'.format(str(path).replace("\\", "\\\\").replace('"', '\\"')))
+        return []
+
+    def get_output_count(self, input_count):
+        if input_count < 1:
+            raise RuntimeError("There must be at least one input file")
+        return 1
+
+    def get_hash(self):
+        return self.hash_helper([])
+
+def unity_build(user_context, compiler, sources,
+                batch_time=10.0, max_batch_size=32,
+                default_time=1.0, max_change_rate=1.0, max_overrun=2.0):
+    """ Compile sources with compiler, grouping them into unity translation units.
+    Sources are packed into batches in order of their paths, build time of every
+    batch is estimated from the previous builds to be at most batch_time seconds
+    (default_time is used for sources without history).
+    Batches of the previous builds are kept while their estimate stays under
+    max_overrun * batch_time, so that noise in the measured times doesn't move
+    sources between batches (and rebuild them). Only new sources and sources
+    of split batches are packed again.
+    Sources that changed frequently in the recent builds (change rate over
+    max_change_rate) are compiled separately, so that editing them doesn't
+    trigger rebuild of whole batches.
+    Sources must be ready for unity builds (no conflicting static symbols or macros).
+    Returns list of object files. """
+
+    def source_path(source):
+        if isinstance(source, nodes.SourceFile):
+            return str(source.path)
+        elif isinstance(source, nodes.Node):
+            return None # Generated sources don't have any history
+        else:
+            return str(util.make_absolute(pathlib.Path(source)))
+
+    sources = [(source_path(source), source) for source in util.maybe_iterable(sources)]
+    paths = [path for path, source in sources if path is not None]
+    statistics = user_context.get_statistics(paths)
+    previous = user_context.get_unity_batches(paths)
+
+    separate = []
+    kept = collections.defaultdict(list) # Name of a previous batch -> [(path, time, source)]
+    loose = []
+    for path, source in sources:
+        time, change_rate = statistics.get(path, (None, None))
+        if change_rate is not None and change_rate > max_change_rate:
+            separate.append(source)
+            continue
+        item = (path or "", time if time is not None else default_time, source)
+        if path in previous:
+            kept[previous[path]].append(item)
+        else:
+            loose.append(item)
+
+    batches = [] # (name or None, [(path, source)])
+    for name, items in kept.items():
+        if 1 < len(items) <= max_batch_size and \
+                sum(time for path, time, source in items) <= max_overrun * batch_time:
+            items.sort(key=lambda x: x[0])
+            batches.append((name, [(path, source) for path, time, source in items]))
+        else:
+            loose.extend(items)
+    loose.sort(key=lambda x: x[0])
+
+    batch = []
+    time_sum = 0
+    for path, time, source in loose:
+        if batch and (time_sum + time > batch_time or len(batch) >= max_batch_size):
+            batches.append((None, batch))
+            batch = []
+            time_sum = 0
+        batch.append((path, source))
+        time_sum += time
+    if batch:
+        batches.append((None, batch))
+    batches.sort(key=lambda x: x[1][0][0])
+
+    generator = UnityGenerator()
+    names = set(name for name, batch in batches)
+    ret = []
+    for source in separate:
+        ret.extend(user_context.apply(compiler, source))
+    for name, batch in batches:
+        if len(batch) == 1:
+            ret.extend(user_context.apply(compiler, batch[0][1]))
+            continue
+        if name is None:
+            # Named after the first source, not the position, so that the names
+            # (a part of the cache keys) don't change with other batches
+            suffix = pathlib.Path(batch[0][0]).suffix or ".c"
+            digest = hashlib.sha1(batch[0][0].encode("utf-8")).hexdigest()
+            name = "unity-{}{}".format(digest[:8], suffix)
+            while name in names:
+                digest = hashlib.sha1(digest.encode("ascii")).hexdigest()
+                name = "unity-{}{}".format(digest[:8], suffix)
+            names.add(name)
+        unity_source, = user_context.apply(generator, [source for path, source in batch], name)
+        ret.extend(user_context.apply(compiler, unity_source))
+    return ret
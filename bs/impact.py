@@ -0,0 +1,84 @@
+from . import nodes
+
+import collections
+
+class ImpactIndex:
+    """ Precomputed reverse reachability of the dependency graph.
+    For every source file holds the sets of applications and targets that
+    depend on it (directly or transitively), stored as bit sets in Python ints,
+    so that a query only ORs a few integers. """
+
+    def __init__(self, targets):
+        """ targets is a list of objects with attributes `name` and `node`. """
+        self.targets = [target.name for target in targets]
+        self.applications = [] # index -> Application
+
+        order, dependents = self._visit([target.node for target in targets])
+
+        application_ids = {}
+        application_bits = {} # node -> bits of applications depending on it
+        target_bits = collections.defaultdict(int)
+        for i, target in enumerate(targets):
+            target_bits[target.node] |= 1 << i
+
+        # Dependents are always processed before their dependencies
+        for node in reversed(order):
+            own = 0
+            if isinstance(node, nodes.Application):
+                application_ids[node] = len(self.applications)
+                own = 1 << len(self.applications)
+                self.applications.append(node)
+
+            a = own
+            t = target_bits[node]
+            for dependent in dependents[node]:
+                a |= application_bits[dependent]
+                t |= target_bits[dependent]
+            application_bits[node] = a
+            target_bits[node] = t
+
+        self._by_path = {node.path: (application_bits[node], target_bits[node])
+                         for node in order if isinstance(node, nodes.SourceFile)}
+
+    @staticmethod
+    def _visit(roots):
+        """ Return list of nodes reachable from the roots in post order
+        (dependencies before dependents) and a dict with dependents of every node. """
+        order = []
+        dependents = collections.defaultdict(list)
+        visited = set()
+        for root in roots:
+            if root in visited:
+                continue
+            visited.add(root)
+            stack = [(root, iter(root.dependencies))]
+            while stack:
+                node, it = stack[-1]
+                for dep in it:
+                    dependents[dep].append(node)
+                    if dep not in visited:
+                        visited.add(dep)
+                        stack.append((dep, iter(dep.dependencies)))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+        return order, dependents
+
+    def query(self, paths):
+        """ Return tuple (list of target names, list of applications) affected
+        by changes of the files. Unknown paths are ignored. """
+        application_bits = 0
+        target_bits = 0
+        for path in paths:
+            a, t = self._by_path.get(path, (0, 0))
+            application_bits |= a
+            target_bits |= t
+        return ([self.targets[i] for i in _bit_indices(target_bits)],
+                [self.applications[i] for i in _bit_indices(application_bits)])
+
+def _bit_indices(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
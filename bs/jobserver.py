@@ -0,0 +1,156 @@
+import os
+import select
+import stat
+import tempfile
+import threading
+
+class Client:
+    """ Client of a GNU make compatible jobserver, usable as job tokens of
+    runner.ProcessRunner (methods acquire(blocking) and release()).
+
+    Every process of the jobserver owns one implicit token, the other tokens
+    are bytes in a pipe, read to acquire a token and written back to release it.
+    The pipe is opened by path (a fifo, or /proc/pid/fd/N of the process that
+    inherited it), so that our non blocking reads don't affect other processes.
+    Commands get the jobserver passed in MAKEFLAGS (see share_with_child).
+
+    Client is a context manager, see close() for what happens on exit. """
+
+    _poll_interval = 1 # Seconds between checks for a token in blocking acquire
+
+    def __init__(self, read_path, write_path):
+        self._read_fd = os.open(str(read_path), os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            self._write_fd = os.open(str(write_path), os.O_WRONLY)
+            # Blocking end for the commands, a writer exists now, so this doesn't block
+            self._child_read_fd = os.open(str(read_path), os.O_RDONLY)
+        except:
+            os.close(self._read_fd)
+            raise
+        self._lock = threading.Lock()
+        self._implicit = True # The implicit token is free
+        self._tokens = [] # Bytes read from the pipe, they must be written back
+        self._uncounted = 0 # Jobs started after close
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stop taking tokens from the pipe. Tokens of jobs that are still
+        running are returned when the jobs release them, jobs started after
+        this are not counted anymore. """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for fd in (self._read_fd, self._child_read_fd):
+                os.close(fd)
+            self._close_write_end()
+
+    def _close_write_end(self):
+        """ Close the pipe once all tokens are returned. Must be called with the lock held. """
+        if self._closed and not self._tokens and self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def acquire(self, blocking=True):
+        while True:
+            with self._lock:
+                if self._closed:
+                    self._uncounted += 1
+                    return True
+                if self._implicit:
+                    self._implicit = False
+                    return True
+                try:
+                    token = os.read(self._read_fd, 1)
+                except BlockingIOError:
+                    token = None
+                if token == b"":
+                    raise Exception("Jobserver pipe was closed")
+                if token is not None:
+                    self._tokens.append(token)
+                    return True
+            if not blocking:
+                return False
+            select.select([self._read_fd], [], [], self._poll_interval)
+
+    def release(self):
+        with self._lock:
+            if self._uncounted:
+                self._uncounted -= 1 # Keep the tokens as long as possible
+            elif self._tokens:
+                os.write(self._write_fd, self._tokens.pop())
+                self._close_write_end()
+            else:
+                self._implicit = True
+
+    def share_with_child(self, env):
+        """ Return tuple (environment, file descriptors to pass) for a command
+        that should use this jobserver. env is None for the current environment.
+        Commands started after close don't get the jobserver. """
+        env = dict(os.environ if env is None else env)
+        if self._closed:
+            return env, ()
+        auth = "{},{}".format(self._child_read_fd, self._write_fd)
+        flags = [flag for flag in env.get("MAKEFLAGS", "").split()
+                 if not flag.startswith(("--jobserver-auth=", "--jobserver-fds=", "-j"))]
+        # -fds is understood by make older than 4.2
+        flags += ["-j", "--jobserver-fds=" + auth, "--jobserver-auth=" + auth]
+        env["MAKEFLAGS"] = " ".join(flags)
+        return env, (self._child_read_fd, self._write_fd)
+
+
+class Server(Client):
+    """ A new jobserver with the given number of tokens. """
+
+    def __init__(self, jobs):
+        directory = tempfile.mkdtemp(prefix="bs-jobserver-")
+        path = os.path.join(directory, "fifo")
+        os.mkfifo(path, 0o600)
+        try:
+            super().__init__(path, path)
+        finally:
+            # Opened file descriptors keep working
+            os.unlink(path)
+            os.rmdir(directory)
+        os.write(self._write_fd, b"+" * (jobs - 1))
+
+
+def from_makeflags(makeflags, pid="self"):
+    """ Return Client of the jobserver in MAKEFLAGS of a process, or None
+    if there is none or it is not accessible (the file descriptors are only
+    inherited by recipes that make considers recursive). """
+    #TODO: The /proc part is linux only
+    auth = None
+    for flag in (makeflags or "").split():
+        for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+            if flag.startswith(prefix):
+                auth = flag[len(prefix):]
+
+    if auth is None:
+        return None
+    if auth.startswith("fifo:"):
+        paths = (auth[len("fifo:"):],) * 2
+    else:
+        try:
+            fds = [int(fd) for fd in auth.split(",")]
+        except ValueError:
+            return None # Windows semaphore
+        if len(fds) != 2 or min(fds) < 0:
+            return None # Jobserver disabled
+        paths = ["/proc/{}/fd/{}".format(pid, fd) for fd in fds]
+
+    try:
+        client = Client(*paths)
+    except OSError:
+        return None
+    # The descriptors may have been reused for something else than the jobserver pipe
+    if not all(stat.S_ISFIFO(os.fstat(fd).st_mode) for fd in (client._read_fd, client._write_fd)):
+        client.close()
+        return None
+    return client
@@ -8,10 +8,15 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 class Monitor:
-    def __init__(self):
+    """ Watches files for changes of their content.
+    callback is called without arguments (from the observer thread) whenever
+    a changed file is found, update() then returns the changed paths. """
+    def __init__(self, callback=None):
+        self._callback = callback
         self._observer = Observer()
         self._handler = _EventHandler(self)
         self._watches = []
+        self._lock = threading.Lock()
 
         self._old_state = {}
         self._changed = {}
@@ -24,34 +29,41 @@ class Monitor:
         self._observer.stop()
         self._observer.join()
 
-    @util.synchronized
     def _examine_path(self, path):
-        try:
-            path = pathlib.Path(path).resolve()
-        except FileNotFoundError:
-            hash = None
-        else:
-            hash = util.sha1_file(path)
+        if self._examine_path_locked(path) and self._callback is not None:
+            self._callback()
+
+    @util.synchronized
+    def _examine_path_locked(self, path):
+        """ Returns True if the path is changed. """
+        path = pathlib.Path(path).resolve()
+        hash = _hash_file(path)
 
         if hash == self._old_state.get(path, None):
             if path in self._changed:
                 del self._changed[path]
+            return False
         else:
             self._changed[path] = hash
+            return True
 
     @util.synchronized
     def watch(self, path, recursive = False):
-        self._observer.schedule(self._handler, path, recursive)
+        """ Start watching a directory (non recursively, unless recursive is set)
+        or a single file. """
+        self._observer.schedule(self._handler, str(path), recursive=recursive)
 
         path = pathlib.Path(path).resolve()
 
-        if not recursive:
-            self._old_state[path] = util.sha1_file(path)
+        if not path.is_dir():
+            self._old_state[path] = _hash_file(path)
         else:
             for (dirpath, dirnames, filenames) in os.walk(str(path)):
                 for filename in filenames:
                     fullpath = pathlib.Path(dirpath) / filename
-                    self._old_state[fullpath] = util.sha1_file(fullpath)
+                    self._old_state[fullpath] = _hash_file(fullpath)
+                if not recursive:
+                    break
 
     @util.synchronized
     def update(self):
@@ -63,6 +75,12 @@ class Monitor:
 
         return ret
 
+def _hash_file(path):
+    try:
+        return util.sha1_file(path)
+    except (FileNotFoundError, IsADirectoryError, PermissionError):
+        return None
+
 class _EventHandler(FileSystemEventHandler):
     def __init__(self, monitor):
         self._monitor = monitor
@@ -70,6 +88,8 @@ class _EventHandler(FileSystemEventHandler):
     def on_any_event(self, event):
         if event.is_directory:
             return
+        if event.event_type in ("opened", "closed_no_write"):
+            return # Reported by newer watchdog, we open the files ourselves when hashing them
         self._monitor._examine_path(event.src_path)
         try:
             dest_path = event.dest_path
@@ -78,10 +98,3 @@ class _EventHandler(FileSystemEventHandler):
         else:
             self._monitor._examine_path(dest_path)
 
-with Monitor() as m:
-    m.watch("/home/cube/Factorio/src", True)
-    m.watch("/home/cube/Factorio/libraries", True)
-    while True:
-        input()
-        print(m.update())
-
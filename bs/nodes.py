@@ -1,5 +1,7 @@
 from . import util
 import pathlib
+import contextlib
+import time
 
 class Node:
     """ Base class for node of the dependency graph. """
@@ -14,6 +16,14 @@ class Node:
         self.targets = None
         self.dirty = None
 
+    def __getstate__(self):
+        # Values used only by the backend are not transfered
+        state = self.__dict__.copy()
+        state["reverse_dependencies"] = None
+        state["targets"] = None
+        state["dirty"] = None
+        return state
+
     def add_dependency(self, other, name=None):
         if other in self.dependencies:
             raise RuntimeError("Dependency already existed")
@@ -36,11 +46,20 @@ class Node:
 
         self.dependencies.remove(other)
 
+    def replace_dependency(self, old, new):
+        """ Replace a dependency with another node, keeping its name. """
+        names = [k for k, v in self.named_dependencies.items() if v is old]
+        self.remove_dependency(old)
+        self.add_dependency(new, names[0] if names else None)
+
     def get_hash(self):
         raise NotImplementedError()
 
     def update(self, context):
-        """ Called when a change is detected on a node or its dependencies. """
+        """ Called when a change is detected on a node or its dependencies.
+        May return a concurrent.futures.Future instead of finishing the update,
+        its result is then a function that the scheduler calls in an update thread
+        to finish it. Nothing holds a thread while the future is pending. """
         pass
 
     def expand_variables(self, context, string):
@@ -68,9 +87,50 @@ class Node:
 
 
 class Builder(Node):
+    # Maximal number of ready applications of this builder that can be passed
+    # to a single build_batch call.
+    batch_size = 1
+
+    # Run build in a separate process instead of a backend thread.
+    # Useful for CPU heavy builders written in python. The builder is then
+    # pickled and its build only gets a reduced context (processpool.ProcessContext).
+    use_process_pool = False
+
+    # Outputs of this builder only combine its inputs (like unity build sources).
+    # Build times of applications using these outputs are attributed to the inputs.
+    transparent = False
+
     def build(self, context, input_paths, output_paths):
         raise NotImplementedError()
 
+    def submit_build(self, context, input_paths, output_paths):
+        """ Optional variant of build that doesn't wait for the result.
+        Returns a concurrent.futures.Future with what build would return, or None
+        if the builder only has the blocking build. Builders that wait for external
+        commands implement it with Context.submit_command, so that the waiting
+        doesn't hold an update thread. """
+        return None
+
+    def preprocess(self, context, input_paths, temp_directory):
+        """ Optional hook for builders whose results only depend on a normalized
+        form of their inputs (like preprocessor mode of ccache).
+        Returns None to use the default cache keys (hashes of inputs and implicit
+        dependencies), or a tuple (content_hash, preprocessed_input_paths,
+        implicit_dependencies). The content_hash is then used as a cache key
+        and build gets the preprocessed paths instead of the original inputs.
+        Preprocessed files can be created in temp_directory, which exists
+        until the build finishes. """
+        return None
+
+    def build_batch(self, context, jobs):
+        """ Build several applications of this builder at once.
+        jobs is a list of (input_paths, output_paths) tuples, returns a list
+        with implicit dependencies of each job (as returned by build()).
+        Only used when batch_size is larger than 1. Builders that set it should
+        override this to amortize the startup cost of their tool. """
+        return [self.build(context, input_paths, output_paths)
+                for input_paths, output_paths in jobs]
+
     def get_output_names(self, input_names):
         """ Return list of names for the output files.
         This list also specifies the number of outputs.
@@ -84,6 +144,41 @@ class Builder(Node):
         return self.__class__.__name__
 
 
+class WorkerBuilder(Builder):
+    """ Builder that runs its tool as a persistent worker process.
+    The worker is started once and then receives build requests over a pipe,
+    see worker.PersistentWorker for the protocol. """
+
+    def get_worker_command(self, context):
+        """ Return command line that starts the worker. """
+        raise NotImplementedError()
+
+    def get_arguments(self, context, input_paths, output_paths):
+        """ Return arguments of a single build request. """
+        raise NotImplementedError()
+
+    def get_implicit_dependencies(self, context, input_paths, output_paths, output):
+        """ Return implicit dependencies of a finished request.
+        output is the text output of the worker. """
+        return []
+
+    def build(self, context, input_paths, output_paths):
+        return self.build_batch(context, [(input_paths, output_paths)])[0]
+
+    def build_batch(self, context, jobs):
+        """ Sends all jobs to a single worker. """
+        with context.worker(self.get_worker_command(context)) as worker:
+            ret = []
+            for input_paths, output_paths in jobs:
+                output = worker.request(self.get_arguments(context, input_paths, output_paths))
+                if output:
+                    context.log("{}", output)
+                ret.append(self.get_implicit_dependencies(context,
+                                                          input_paths, output_paths,
+                                                          output))
+            return ret
+
+
 class Application(Node):
     """ A node that connects builder, inputs files and generated files. """
     def __init__(self, builder, inputs, output_names):
@@ -103,76 +198,166 @@ class Application(Node):
         self.timer = util.Timer()
 
         self.implicit_dependencies = None
+        self._known_dependencies = set() # Last implicit dependencies that were not None
+        self.content_hash = None # Set when the builder provides the cache key itself (Builder.preprocess)
 
-    def _find_cached_implicit_dependencies(self, context):
-        partial_hash = self._get_hash(None)
-        candidates = context.cache.get_candidate_implicit_dependencies(partial_hash)
+    def replace_dependency(self, old, new):
+        super().replace_dependency(old, new)
+        self.inputs = [new if input is old else input for input in self.inputs]
+        if self.implicit_dependencies is not None:
+            self.implicit_dependencies = [new if node is old else node
+                                          for node in self.implicit_dependencies]
 
-        for deps in candidates:
-            if self._try_implicit_dependencies(context, deps):
-                return True
+    def _find_cached_implicit_dependencies(self, context):
+        def get_hash(path):
+            try:
+                return context.file_by_path(path).get_hash()
+            except FileNotFoundError:
+                return None
 
-        self._set_implicit_dependencies(None)
-        return False
+        partial_hash = self._get_hash(None)
+        deps = context.cache.find_implicit_dependencies(partial_hash, get_hash)
+        if deps is None:
+            self._set_implicit_dependencies(None)
+            return False
 
-    def _try_implicit_dependencies(self, context, deps):
-        ret = []
-        for path, hash in deps:
-            node = context.file_by_path(path)
-            if node.get_hash() == hash:
-                ret.append(node)
-            else:
-                return False
-        self._set_implicit_dependencies(ret)
+        self._set_implicit_dependencies(context.files_by_paths([path for path, hash in deps]))
         return True
 
     def _set_implicit_dependencies(self, nodes):
         if self.implicit_dependencies is not None:
             for node in self.implicit_dependencies:
+                if node in self.inputs:
+                    continue # Explicit dependency too (e.g. source listed in a depfile)
                 self.remove_dependency(node)
+                if node.reverse_dependencies is not None:
+                    node.reverse_dependencies.discard(self)
         self.implicit_dependencies = nodes
         if nodes is not None:
+            if set(nodes) != self._known_dependencies:
+                # Precomputed views of the graph (impact.ImpactIndex) are outdated
+                self._known_dependencies = set(nodes)
+                for target in self.targets or ():
+                    target.version += 1
             for node in nodes:
                 if node not in self.dependencies:
                     self.add_dependency(node)
+                if node.reverse_dependencies is not None:
+                    # Needed for finding what to rebuild when the file changes
+                    node.reverse_dependencies.add(self)
 
     def update(self, context):
-        if self._find_cached_implicit_dependencies(context):
-            #print("Have cached resutls", str(self))
-            return
-
-        #print("Building", str(self))
-        with context.tempdir() as temp, \
-             self.timer:
-
-            input_paths = [input.get_path(context) for input in self.inputs]
-            output_paths = [temp/output.name for output in self.outputs]
-
-            computed_deps = self.builder.build(context, input_paths, output_paths)
-            if computed_deps is None:
-                computed_deps = []
-
-            implicit_dependencies = []
-            for path in computed_deps:
-                path = pathlib.Path(path)
-                if not path.is_absolute():
-                    raise Exception("Builder must return implicit dependencies as absolute paths.")
-                node = context.file_by_path(path)
-                node.targets.union(self.targets)
-                implicit_dependencies.append(node)
-
+        return self.update_batch(context, [self])
+
+    @staticmethod
+    def update_batch(context, applications):
+        """ Update several applications of a single builder using one call to
+        Builder.build_batch. Applications found in cache are skipped.
+        Returns a future if a single build was started by Builder.submit_build,
+        see Node.update. """
+        builder = applications[0].builder
+        assert all(application.builder is builder for application in applications)
+
+        with contextlib.ExitStack() as stack:
+            jobs = []
+            for application in applications:
+                job = application._prepare(context, stack)
+                if job is not None:
+                    jobs.append((application, job))
+            if not jobs:
+                return None
+
+            start_time = time.perf_counter()
+            if builder.use_process_pool:
+                results = context.build_in_processes(builder, [job for application, job in jobs])
+            elif len(jobs) == 1:
+                pending = builder.submit_build(context, *jobs[0][1])
+                if pending is not None:
+                    temporaries = stack.pop_all() # Kept until the build finishes
+                    def finish():
+                        with temporaries:
+                            Application._store_results(context, jobs, [pending.result()], start_time)
+                    return util.map_future(pending, lambda future: finish)
+                results = [builder.build(context, *jobs[0][1])]
+            else:
+                results = builder.build_batch(context, [job for application, job in jobs])
+            Application._store_results(context, jobs, results, start_time)
+        return None
+
+    @staticmethod
+    def _store_results(context, jobs, results, start_time):
+        elapsed = (time.perf_counter() - start_time) / len(jobs)
+        for (application, (input_paths, output_paths)), computed_deps in zip(jobs, results):
+            application._store_result(context, output_paths, computed_deps)
+            application.timer.add(elapsed)
+            context.record_statistics(application, elapsed)
+
+    def _prepare(self, context, stack):
+        """ Look for outputs of this application in cache.
+        Returns None if they are cached, or tuple (input_paths, output_paths)
+        for the build. Temporary directories are entered into stack. """
+        input_paths = [input.get_path(context) for input in self.inputs]
+        temp = stack.enter_context(context.tempdir())
+        output_directory = stack.enter_context(context.staging_directory())
+
+        preprocessed = self.builder.preprocess(context, input_paths, temp)
+        if preprocessed is None:
+            self.content_hash = None
+            if self._find_cached_implicit_dependencies(context):
+                return None
+        else:
+            self.content_hash, input_paths, computed_deps = preprocessed
+            self._set_implicit_dependencies(self._resolve_dependencies(context, computed_deps))
+            if self.get_hash() in context.cache:
+                self.accessed(context)
+                return None
+
+        return input_paths, [output_directory / output.name for output in self.outputs]
+
+    def _resolve_dependencies(self, context, computed_deps):
+        """ Convert implicit dependencies returned by a builder to nodes. """
+        if computed_deps is None:
+            computed_deps = []
+
+        paths = [path if isinstance(path, pathlib.Path) else pathlib.Path(path)
+                 for path in computed_deps]
+        if not all(path.is_absolute() for path in paths):
+            raise Exception("Builder must return implicit dependencies as absolute paths.")
+
+        implicit_dependencies = context.files_by_paths(paths)
+        for node in implicit_dependencies:
+            node.targets.union(self.targets)
+        return implicit_dependencies
+
+    def _store_result(self, context, output_paths, computed_deps):
+        """ Process implicit dependencies returned by the builder and
+        move the outputs to cache. """
+        implicit_dependencies = self._resolve_dependencies(context, computed_deps)
+
+        if self.content_hash is None:
             self._set_implicit_dependencies(implicit_dependencies)
-
-            context.cache.put(self.get_hash(), self._get_hash(None),
-                              output_paths,
-                              [(node.get_path(context), node.get_hash()) for node in self.implicit_dependencies])
-
-            for node in self.inputs:
-                node.accessed(context)
-            for node in self.implicit_dependencies:
-                node.accessed(context)
+            partial_hash = self._get_hash(None)
+        else:
+            # Dependencies were found by Builder.preprocess, the cache entry
+            # is only accessible by its final hash.
+            self._set_implicit_dependencies(self.implicit_dependencies +
+                                            [node for node in implicit_dependencies
+                                             if node not in self.implicit_dependencies])
+            partial_hash = self.get_hash()
+
+        context.cache.put(self.get_hash(), partial_hash,
+                          output_paths,
+                          [(node.get_path(context), node.get_hash()) for node in self.implicit_dependencies])
+
+        for node in self.inputs:
+            node.accessed(context)
+        for node in self.implicit_dependencies:
+            node.accessed(context)
 
     def get_hash(self):
+        if self.content_hash is not None:
+            return self.hash_helper([self.builder.get_hash()], [self.content_hash],
+                                    [output.name for output in self.outputs])
         return self._get_hash(self.implicit_dependencies)
 
     def _get_hash(self, implicit_dependencies):
@@ -180,9 +365,11 @@ class Application(Node):
             implicit_dependencies = (x.get_hash() for x in implicit_dependencies)
         else:
             implicit_dependencies = [None]
+        # Cache directories contain the outputs by name
         return self.hash_helper([self.builder.get_hash()],
                                 (x.get_hash() for x in self.inputs),
-                                implicit_dependencies)
+                                implicit_dependencies,
+                                [output.name for output in self.outputs])
 
     def accessed(self, context):
         """ Called after one of this application's files is used. """
@@ -210,12 +397,23 @@ class SourceFile(File):
     def __init__(self, path):
         super().__init__()
         self.path = util.make_absolute(path)
+        self._hash_cache = None # (stat signature, hash)
 
     def get_path(self, context):
         return self.path
 
     def get_hash(self):
-        return util.sha1_file(self.path)
+        """ Return hash of the file content.
+        The hash is only recalculated when size, mtime or inode of the file change. """
+        st = self.path.stat()
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+        cached = self._hash_cache
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        h = util.sha1_file(self.path)
+        self._hash_cache = (signature, h)
+        return h
 
     def __str__(self):
         return str(self.path)
@@ -0,0 +1,144 @@
+from . import cache
+from . import context
+from . import runner
+from . import staging
+
+import concurrent.futures
+import functools
+import hashlib
+import multiprocessing
+import pickle
+import subprocess
+import threading
+
+_builders = {} # key -> builder, set in every worker process
+
+def create_pool(builders, max_workers=None):
+    """ Create a process pool executor able to run the given builders.
+    builders is a dict mapping keys to builders, it is pickled only once when
+    starting each worker process, build() then refers to the builders by keys.
+    Classes of the builders must be importable by the worker processes. """
+    return concurrent.futures.ProcessPoolExecutor(max_workers,
+                                                  mp_context=multiprocessing.get_context("forkserver"),
+                                                  initializer=_initialize,
+                                                  initargs=(pickle.dumps(builders),))
+
+class ProcessPool:
+    """ Process pool for builders with use_process_pool set, shared by several
+    owners (backends), restarted only when the set of their builders changes.
+    Builders are identified by hash of their pickled state, so equal builders
+    uploaded by a new configuration keep using the running processes.
+    ProcessPool is a context manager, the processes are shut down on exit. """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._keys = {} # id(builder) -> key of the builder in the running pool
+        self._builders = {} # owner -> list of its builders, keeps the builders in _keys alive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+            self._keys = {}
+            self._builders = {}
+        if executor is not None:
+            executor.shutdown()
+
+    def set_builders(self, owner, builders):
+        """ Replace builders of the owner that are available in the pool.
+        A new pool is started if the builders of all owners are not equal to
+        builders of the running one, jobs running in the old pool are left to finish. """
+        with self._lock:
+            if builders:
+                self._builders[owner] = list(builders)
+            else:
+                self._builders.pop(owner, None)
+            builders = [builder for owner_builders in self._builders.values()
+                        for builder in owner_builders]
+            keys = {id(builder): hashlib.sha1(pickle.dumps(builder)).digest() for builder in builders}
+
+            old_executor = None
+            if set(keys.values()) != set(self._keys.values()):
+                old_executor = self._executor
+                self._executor = None
+                if builders:
+                    self._executor = create_pool({keys[id(builder)]: builder for builder in builders},
+                                                 self.max_workers)
+            self._keys = keys
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def submit(self, builder, cache_directory, temp_directory, input_paths, output_paths):
+        """ Run build of a builder in the pool, returns a concurrent.futures.Future
+        with the result of build(). """
+        with self._lock:
+            key = self._keys.get(id(builder))
+            if key is None:
+                raise RuntimeError("Builder {} is not available in the process pool".format(str(builder)))
+            return self._executor.submit(build, key, cache_directory, temp_directory,
+                                         input_paths, output_paths)
+
+    @property
+    def running(self):
+        """ True if the pool has processes for some builders. """
+        return self._executor is not None
+
+
+def _initialize(pickled_builders):
+    global _builders
+    _builders = pickle.loads(pickled_builders)
+
+def build(key, cache_directory, temp_directory, input_paths, output_paths):
+    """ Run build of a builder in a worker process.
+    Returns tuple of implicit dependencies returned by the builder and
+    list of messages it logged. """
+    c = ProcessContext(cache_directory, temp_directory)
+    dependencies = _builders[key].build(c, input_paths, output_paths)
+    if dependencies is not None:
+        dependencies = [str(path) for path in dependencies]
+    return dependencies, c.messages
+
+
+class ProcessContext:
+    """ Reduced version of context.Context available to builders running in
+    a worker process. Messages are collected and logged by the backend when
+    the build finishes. """
+
+    remote = None # Actions always run locally in worker processes
+
+    def __init__(self, cache_directory, temp_directory):
+        self.cache = cache.Cache(cache_directory)
+        self.temp_directory = temp_directory
+        self.staging = staging.StagingArea(temp_directory, max_idle=0)
+        self.messages = []
+
+    def log(self, fmt, *args, **kwargs):
+        self.messages.append(fmt.format(*args, **kwargs))
+
+    def run_command(self, command, timeout=600, limits=None, cwd=None):
+        command = [str(x) for x in command]
+        p = subprocess.run(command,
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE,
+                           universal_newlines=True,
+                           timeout=timeout,
+                           cwd=None if cwd is None else str(cwd),
+                           preexec_fn=functools.partial(runner.preexec, limits) if limits else None)
+        if p.returncode != 0:
+            raise Exception("Command failed", command, p.stdout, p.stderr, p.returncode)
+        return p.stdout
+
+    def run_action(self, command, input_paths, output_paths, timeout=600, cwd=None):
+        return self.run_command(command, timeout, cwd=cwd)
+
+    tempfile = context.Context.tempfile
+    tempdir = context.Context.tempdir
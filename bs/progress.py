@@ -0,0 +1,85 @@
+import collections
+import threading
+
+# Events sent from the backend to the client
+Log = collections.namedtuple("Log", "message")
+Status = collections.namedtuple("Status", "running done remaining") # Numbers of jobs
+Dropped = collections.namedtuple("Dropped", "count") # Number of messages dropped because the client was slow
+
+def format_event(event):
+    """ Return human readable text for an event. """
+    if isinstance(event, Log):
+        return event.message
+    elif isinstance(event, Status):
+        return "[{} running, {} done, {} remaining]".format(event.running, event.done, event.remaining)
+    elif isinstance(event, Dropped):
+        return "({} messages dropped)".format(event.count)
+    else:
+        return str(event)
+
+class Channel:
+    """ Bounded channel of progress events from build threads to a single reader.
+
+    At most max_events events are queued. When the queue is full, unimportant
+    events are dropped (the reader gets a Dropped event with their count) and
+    important ones block the writer until the reader catches up.
+    Status updates are not queued, only the latest one is delivered.
+    The reader gets events in batches. """
+
+    def __init__(self, max_events=1000):
+        self.max_events = max_events
+        self._condition = threading.Condition()
+        self._events = collections.deque()
+        self._status = None # Latest status not delivered yet
+        self._dropped = 0
+        self._closed = False
+
+    def put(self, event, important=False):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._events) >= self.max_events:
+                if not important:
+                    self._dropped += 1
+                    return
+                while len(self._events) >= self.max_events and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def set_status(self, status):
+        """ Replace the status event waiting for delivery. """
+        with self._condition:
+            if self._closed:
+                return
+            self._status = status
+            self._condition.notify_all()
+
+    def close(self):
+        """ No more events will be accepted, the reader gets the queued ones. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def get_batch(self, max_size=None):
+        """ Wait for events and return list of all that are available (at most max_size),
+        returns an empty list once the channel is closed and all events were read. """
+        with self._condition:
+            while not (self._events or self._status or self._dropped or self._closed):
+                self._condition.wait()
+
+            ret = []
+            if self._dropped:
+                ret.append(Dropped(self._dropped))
+                self._dropped = 0
+            count = len(self._events) if max_size is None else min(max_size, len(self._events))
+            for i in range(count):
+                ret.append(self._events.popleft())
+            if self._status is not None and not self._events:
+                ret.append(self._status)
+                self._status = None
+
+            self._condition.notify_all() # Wake up blocked writers
+            return ret
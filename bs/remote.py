@@ -0,0 +1,330 @@
+from . import service
+from . import runner
+from . import util
+
+import binascii
+import collections
+import contextlib
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# A command with explicitly listed files it reads and writes.
+# command -- list of arguments, run in an empty directory that contains only the inputs
+# inputs -- dict mapping relative paths to content hashes (util.sha1_file)
+# outputs -- list of relative paths of the files the command creates
+# timeout -- seconds
+Action = collections.namedtuple("Action", "command inputs outputs timeout")
+
+# stdout and stderr of the command, outputs maps relative paths to tuples
+# (content hash, True if the file is executable)
+ActionResult = collections.namedtuple("ActionResult", "stdout stderr outputs")
+
+class BlobStore:
+    """ Directory of read only files named by hashes of their content. """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, content_hash):
+        h = binascii.hexlify(content_hash).decode("ascii")
+        return self.directory / h[:2] / h[2:]
+
+    def __contains__(self, content_hash):
+        return self.get_path(content_hash).exists()
+
+    def new_upload(self):
+        """ Create an empty temporary file for an upload, return its path. """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=str(self.directory), prefix=".upload.")
+        os.close(fd)
+        return pathlib.Path(temp)
+
+    def add_upload(self, temp, content_hash):
+        """ Move a completely written upload to the store, it must have the given hash. """
+        try:
+            if util.sha1_file(temp) != content_hash:
+                raise Exception("Content hash mismatch")
+            path = self.get_path(content_hash)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(str(temp), 0o444) # Inputs are hardlinked, commands must not change them
+            os.replace(str(temp), str(path))
+        except:
+            temp.unlink()
+            raise
+
+    def remove_uploads(self):
+        """ Remove uploads left over by clients that didn't finish them. """
+        for path in self.directory.glob(".upload.*"):
+            path.unlink()
+
+    def add_file(self, source):
+        """ Copy a file to the store, return its content hash. """
+        content_hash = util.sha1_file(source)
+        if content_hash not in self:
+            with self._new_file(content_hash) as (fp, path):
+                with source.open("rb") as source_fp:
+                    shutil.copyfileobj(source_fp, fp)
+        return content_hash
+
+    @contextlib.contextmanager
+    def _new_file(self, content_hash):
+        """ Write to a temporary file that is atomically renamed to the final
+        location when the context manager ends. Yields (file object, final path). """
+        path = self.get_path(content_hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=str(path.parent), prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                yield fp, path
+            os.chmod(temp, 0o444) # Inputs are hardlinked, commands must not change them
+            os.replace(temp, str(path))
+        except:
+            os.unlink(temp)
+            raise
+
+
+class RemoteWorker(service.Service):
+    """ Daemon that executes actions for backends, possibly on another machine.
+    Inputs of actions must be uploaded to the worker's blob store before the action
+    is executed, outputs are stored there too and downloaded by the client.
+
+    Workers for local testing can be started by ServiceProxy, on other machines
+    use `python -m bs.remote control_file [host [port]]`.
+    Pickle protocol is used for communication, so anyone who can connect to the
+    worker can run code on it. """
+    _timeout = 60 * 60 # Shut down after an hour without any work
+    _jobs = os.cpu_count() or 1 # Number of commands running at the same time
+    _unlocked_methods = frozenset(["upload_chunk", "finish_upload", "download_blob", "execute"])
+
+    def __init__(self, control_file):
+        directory = control_file.parent / "remote_worker"
+        self._blobs = BlobStore(directory / "blobs")
+        self._work_directory = directory / "work"
+        self._runner = runner.ProcessRunner(self._jobs)
+        self._active = 0 # Number of running uploads, downloads and actions
+        self._uploads = {} # upload id -> temporary file in the blob store
+
+    def __enter__(self):
+        self._work_directory.mkdir(parents=True, exist_ok=True)
+        self._blobs.remove_uploads()
+        self._runner.__enter__()
+
+    def __exit__(self, *exc_info):
+        self._runner.__exit__(*exc_info)
+        shutil.rmtree(str(self._work_directory), ignore_errors=True)
+        return exc_info[0] == TimeoutError
+
+    def _periodic(self):
+        if self._active:
+            self._last_call_time = time.time() # Long actions don't count as inactivity
+
+    @contextlib.contextmanager
+    def _activity(self):
+        with self._lock:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def missing_blobs(self, content_hashes):
+        """ Return list of hashes that are not in the blob store. """
+        return [content_hash for content_hash in content_hashes
+                if content_hash not in self._blobs]
+
+    def begin_upload(self):
+        """ Start uploading a blob, return id of the upload.
+        The blob is then sent by upload_chunk calls and added by finish_upload. """
+        path = self._blobs.new_upload()
+        self._uploads[path.name] = path
+        return path.name
+
+    def upload_chunk(self, upload_id, data):
+        with self._activity(), self._uploads[upload_id].open("ab") as fp:
+            fp.write(data)
+
+    def finish_upload(self, upload_id, content_hash):
+        """ Add the uploaded blob to the store, it must have the given hash. """
+        with self._lock:
+            path = self._uploads.pop(upload_id)
+        with self._activity():
+            self._blobs.add_upload(path, content_hash)
+
+    def download_blob(self, content_hash, chunk_size):
+        """ Return an iterator over chunks of the blob. """
+        return service.IteratorWrapper(self._read_chunks(self._blobs.get_path(content_hash),
+                                                         chunk_size))
+
+    def _read_chunks(self, path, chunk_size):
+        with self._activity(), path.open("rb") as fp:
+            while True:
+                data = fp.read(chunk_size)
+                if not data:
+                    return
+                yield data
+
+    def execute(self, action):
+        """ Run the action, return ActionResult. Raises exception if the command fails. """
+        with self._activity(), \
+             tempfile.TemporaryDirectory(dir=str(self._work_directory)) as directory:
+            root = pathlib.Path(directory)
+
+            for path, content_hash in action.inputs.items():
+                path = _resolve(root, path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(str(self._blobs.get_path(content_hash)), str(path))
+                except FileNotFoundError:
+                    raise Exception("Input blob was not uploaded", path)
+            for path in action.outputs:
+                _resolve(root, path).parent.mkdir(parents=True, exist_ok=True)
+
+            stderr = []
+            def log(stream_name, line):
+                if stream_name == "stderr":
+                    stderr.append(line)
+
+            stdout = self._runner.run(action.command, log=log, timeout=action.timeout, cwd=root)
+            outputs = {}
+            for path in action.outputs:
+                path_on_disk = _resolve(root, path)
+                outputs[path] = (self._blobs.add_file(path_on_disk),
+                                 os.access(str(path_on_disk), os.X_OK))
+            return ActionResult(stdout, "\n".join(stderr), outputs)
+
+def _resolve(root, path):
+    """ Return absolute path of a file of an action, refuses paths outside of the root. """
+    path = pathlib.PurePosixPath(path)
+    if path.is_absolute() or ".." in path.parts:
+        raise ValueError("Paths of actions must be relative and inside the action directory")
+    return root / path
+
+
+class _WorkerConnections:
+    """ Idle connections to a single worker and number of actions running on it. """
+    def __init__(self, control_file):
+        self.control_file = control_file
+        self.active = 0
+        self.started = 0 # Total number of actions, to spread the load between idle workers
+        self.idle = []
+
+
+class RemoteExecutor:
+    """ Client side of remote execution. Sends actions to the least busy of
+    a set of running workers (identified by their control files), uploads
+    inputs the worker doesn't have and downloads the outputs.
+    Executor is thread safe, every concurrent action uses its own connection.
+
+    RemoteExecutor is a context manager, connections are closed on exit. """
+
+    _chunk_size = 1024 * 1024 # Blobs are transferred in messages of at most this size
+
+    def __init__(self, control_files, cache=None):
+        """ cache is an optional cache.Cache, outputs that are already in its blob
+        store are copied from there instead of being downloaded. """
+        self.cache = cache
+        self._workers = [_WorkerConnections(util.make_absolute(pathlib.Path(control_file)))
+                         for control_file in control_files]
+        if not self._workers:
+            raise ValueError("No remote workers given")
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for worker in self._workers:
+                for connection in worker.idle:
+                    connection.__exit__(None, None, None)
+                worker.idle = []
+
+    @contextlib.contextmanager
+    def _connection(self):
+        with self._lock:
+            worker = min(self._workers, key=lambda worker: (worker.active, worker.started))
+            worker.active += 1
+            worker.started += 1
+            connection = worker.idle.pop() if worker.idle else None
+
+        try:
+            if connection is None:
+                connection = service.ServiceProxy(RemoteWorker, worker.control_file,
+                                                  start=False).__enter__()
+            yield connection
+        except:
+            if connection is not None:
+                connection.__exit__(None, None, None) # The connection may be in an invalid state
+            connection = None
+            raise
+        finally:
+            with self._lock:
+                worker.active -= 1
+                if connection is not None and not self._closed:
+                    worker.idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.__exit__(None, None, None) # Returned after close()
+
+    def execute(self, command, input_paths, output_paths, timeout=600):
+        """ Run a command on a worker.
+        input_paths and output_paths are dicts mapping paths used by the command
+        (relative to its working directory) to local files.
+        Returns tuple (stdout, stderr). """
+        inputs = {path: util.sha1_file(local_path) for path, local_path in input_paths.items()}
+        with self._connection() as worker:
+            missing = set(worker.missing_blobs(list(set(inputs.values()))))
+            for path, content_hash in inputs.items():
+                if content_hash in missing:
+                    upload_id = worker.begin_upload()
+                    with input_paths[path].open("rb") as fp:
+                        for data in iter(lambda: fp.read(self._chunk_size), b""):
+                            worker.upload_chunk(upload_id, data)
+                    worker.finish_upload(upload_id, content_hash)
+                    missing.discard(content_hash)
+
+            result = worker.execute(Action(list(command), inputs, list(output_paths), timeout))
+
+            for path, local_path in output_paths.items():
+                content_hash, executable = result.outputs[path]
+                local_copy = None
+                if self.cache is not None:
+                    local_copy = self.cache.get_blob_path(content_hash)
+                if local_copy is not None and local_copy.exists():
+                    shutil.copyfile(str(local_copy), str(local_path))
+                else:
+                    with local_path.open("wb") as fp:
+                        for data in worker.download_blob(content_hash, self._chunk_size):
+                            fp.write(data)
+                if executable:
+                    mode = local_path.stat().st_mode
+                    local_path.chmod(mode | (mode & 0o444) >> 2) # Executable by whoever can read it
+
+        return result.stdout, result.stderr
+
+def main(argv):
+    """ Run a worker in foreground, listening on the given address. """
+    if not 1 <= len(argv) <= 3:
+        sys.exit("Usage: python -m bs.remote control_file [host [port]]")
+    host = argv[1] if len(argv) > 1 else "localhost"
+    port = int(argv[2]) if len(argv) > 2 else 0
+
+    class Worker(RemoteWorker):
+        _address = (host, port)
+    Worker.__name__ = RemoteWorker.__name__
+
+    service.serve(Worker, util.make_absolute(pathlib.Path(argv[0])))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,22 +1,28 @@
 from . import backend as backend_
 from . import nodes
+from . import progress
 from . import util
 
+import argparse
+import collections
+import os
 import pathlib
 import inspect
 
 class UserContext:
-    def __init__(self, root):
+    def __init__(self, root, backend=None):
         self.root = root
+        self._backend = backend
         self._files = {}
         self._targets = []
+        self._default_names = collections.Counter() # Used default output name -> count
 
     def apply(self, builder, inputs, output_names = None):
         inputs = [self._wrap_input(x) for x in util.maybe_iterable(inputs)]
         output_count = builder.get_output_count(len(inputs))
 
         if output_names is None:
-            output_names = [None] * output_count
+            output_names = self._default_output_names(builder, inputs, output_count)
         else:
             output_names = list(util.maybe_iterable(output_names))
             if len(output_names) != output_count:
@@ -27,6 +33,27 @@ class UserContext:
         application = nodes.Application(builder, inputs, output_names)
         return application.outputs
 
+    def _default_output_names(self, builder, inputs, output_count):
+        """ Names for outputs of an application that the user didn't name.
+        Based on Builder.get_output_names if the builder has it, names used
+        more than once get a numeric suffix. """
+        try:
+            names = list(builder.get_output_names([_default_target_name(input) for input in inputs]))
+        except NotImplementedError:
+            names = [None] * output_count
+        if len(names) != output_count:
+            raise Exception("Builder {} returned wrong number of output names".format(builder))
+
+        ret = []
+        for i, name in enumerate(names):
+            if name is None:
+                name = "output{:02d}".format(i)
+            self._default_names[name] += 1
+            if self._default_names[name] > 1:
+                name = "{}-{}".format(name, self._default_names[name])
+            ret.append(name)
+        return ret
+
     def _wrap_input(self, input):
         if isinstance(input, nodes.Node):
             return input
@@ -36,18 +63,83 @@ class UserContext:
                 self._files[path] = nodes.SourceFile(path)
             return self._files[path]
 
-    def add_target(self, target):
-        self._targets.extend(util.maybe_iterable(target))
+    def get_statistics(self, paths):
+        """ Return dict mapping paths of source files to tuples
+        (build time, change rate) from previous builds. """
+        if self._backend is None:
+            return {}
+        return self._backend.get_statistics([str(path) for path in paths])
+
+    def get_unity_batches(self, paths):
+        """ Return dict mapping paths of source files to names of the unity
+        sources (see gcc.unity_build) that included them in the previous builds. """
+        if self._backend is None:
+            return {}
+        return self._backend.get_unity_batches([str(path) for path in paths])
+
+    def add_target(self, target, name=None):
+        """ Mark nodes as targets of the build.
+        Targets can be selected by name on the command line. The default name
+        is the name of the output file, if the name is given for more than one
+        node, it is used as a prefix. Paths are targets of their source files. """
+        targets = [self._wrap_input(x) for x in util.maybe_iterable(target)]
+        for node in targets:
+            if name is None:
+                target_name = _default_target_name(node)
+            elif len(targets) > 1:
+                target_name = name + "/" + _default_target_name(node)
+            else:
+                target_name = name
+
+            if any(target_name == existing for existing, _ in self._targets):
+                raise Exception("Target name {} used more than once".format(target_name))
+            self._targets.append((target_name, node))
+
+def _default_target_name(node):
+    if isinstance(node, nodes.GeneratedFile):
+        return node.name
+    elif isinstance(node, nodes.SourceFile):
+        return node.path.name
+    else:
+        return str(node)
 
 def run(configure_callback,
         root_directory = None,
         build_directory = None,
-        output_directory = None):
+        output_directory = None,
+        argv = None,
+        remote_workers = None):
     """ Run the build.
     configure_callback is possibly invoked if necessary.
     build_directory sets the build directory. Default is location_of_caller / "build".
                     This location also holds a reference to the backend process,
-    output_directory sets where the built targets are placed. Deault is build_directory / "output"."""
+    output_directory sets where the built targets are placed. Deault is build_directory / "output".
+    argv are the command line arguments, default is sys.argv[1:].
+    remote_workers is a list of control files of remote workers that run the
+                   builders' actions (see Context.run_action)."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*", metavar="target",
+                        help="Names of targets to build (or prefixes followed by a slash), "
+                             "all targets are built by default")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--watch", action="store_true",
+                      help="Build the targets and then keep rebuilding them in background "
+                           "when the sources change")
+    mode.add_argument("--affected", action="store_true",
+                      help="Take paths of changed files instead of targets and print names "
+                           "of targets that depend on them")
+    parser.add_argument("--shared-backend", action="store_true",
+                        help="Use a single backend for all build directories of the user")
+    parser.add_argument("--restart-backend", action="store_true",
+                        help="Stop the running backend and start a new one, dropping its "
+                             "watched targets and cached state")
+    args = parser.parse_args(argv)
+    command = "build"
+    if args.affected:
+        command = "affected"
+    elif args.watch:
+        command = "watch"
 
     caller_frame = inspect.stack()[1]
     caller_filename = pathlib.Path(caller_frame[1])
@@ -59,7 +151,7 @@ def run(configure_callback,
         root_directory = caller_filename.parent
 
     if build_directory is not None:
-        build_directory = pathlib.Path(build_dir)
+        build_directory = pathlib.Path(build_directory)
     else:
         build_directory = root_directory / "build"
 
@@ -68,19 +160,44 @@ def run(configure_callback,
     else:
         output_directory = build_directory / "output"
 
-    with backend_.connect(build_directory, True) as backend:
-        if backend.need_run_config(caller_filename):
-            context = UserContext(root_directory)
+    # The running backend keeps the graph, hashes and watched targets between runs,
+    # it is only restarted on request. The shared backend may be running builds
+    # of other directories, it is never restarted.
+    force_restart = args.restart_backend and not args.shared_backend
+    with backend_.connect(build_directory, force_restart, args.shared_backend) as backend:
+        upload = command != "affected" or not backend.has_targets(caller_filename)
+        if upload and backend.need_run_config(caller_filename):
+            context = UserContext(root_directory, backend)
             configure_callback(context)
             backend.set_targets(caller_filename, context._targets)
 
+        if command == "affected":
+            paths = [str(util.make_absolute(pathlib.Path(path))) for path in args.targets]
+            targets, applications = backend.affected(caller_filename, paths)
+            for target in targets:
+                print(target)
+            return
+
         print("before update")
-        messages = backend.update(caller_filename, None, output_directory) # TODO: Always updating all targets
+        jobserver = None
+        if "MAKEFLAGS" in os.environ:
+            # The backend shares the jobserver of make that runs us
+            jobserver = (os.getpid(), os.environ["MAKEFLAGS"])
+        remote_workers = [str(util.make_absolute(pathlib.Path(path)))
+                          for path in remote_workers or []]
+        messages = backend.update(caller_filename, args.targets or None, output_directory,
+                                  jobserver, remote_workers)
         print("after update")
 
         try:
-            for message in messages:
-                print("Message from backend:", message)
+            for batch in messages:
+                for event in batch:
+                    print(progress.format_event(event))
         except KeyboardInterrupt:
             print("Interrupted")
             #TODO: First signal the other side to stop, then exit.
+            return
+
+        if command == "watch":
+            backend.watch(caller_filename)
+            print("Watching for changes")
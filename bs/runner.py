@@ -0,0 +1,301 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import os
+import resource
+import selectors
+import subprocess
+import threading
+import time
+
+class ProcessRunner:
+    """ Runs external processes for the builders.
+    All processes are supervised from a single thread using a selector, so
+    a running process doesn't need a thread of its own.
+    Output of the processes is streamed line by line to a log callback and
+    the number of concurrently running processes is limited by job tokens.
+
+    Runner is a context manager, the supervisor thread runs while it is entered. """
+
+    _read_size = 65536
+    _token_poll_interval = 0.05 # Seconds, how often to check tokens released by other processes
+
+    def __init__(self, tokens=4, default_limits=None):
+        """ tokens is either the number of processes allowed to run at the same
+        time, or an object with semaphore-like methods acquire(blocking) and release().
+        default_limits is a dict of resource limits applied to every process
+        (see run()).
+        If the tokens object has a method share_with_child(env) returning tuple
+        (environment, file descriptors), it is used to pass the tokens to the
+        processes (see jobserver.Client). """
+        # Tokens released outside of this runner must be polled
+        self._external_tokens = not isinstance(tokens, int)
+        if isinstance(tokens, int):
+            tokens = threading.BoundedSemaphore(tokens)
+        self.tokens = tokens
+        self.default_limits = dict(default_limits or {})
+
+        self._pending = collections.deque()
+        self._running = set()
+        self._exiting = set() # Jobs that closed their outputs, but didn't exit yet
+        self._stopping = False
+        self._thread = None
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._loop,
+                                        name="ProcessRunner",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopping = True
+        self._wakeup()
+        self._thread.join()
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def submit(self, command, log=None, timeout=None, limits=None, env=None, cwd=None, niceness=0,
+               tokens=None, background=False):
+        """ Start a command, return concurrent.futures.Future with its stdout.
+        log is called as log(stream_name, line) for every line of output as soon
+        as it is read.
+        timeout is in seconds, process is killed and the future fails with
+        subprocess.TimeoutExpired when it runs longer.
+        limits is a dict mapping resource.RLIMIT_* constants to either a single
+        value or a (soft, hard) tuple. These are added to default_limits.
+        niceness is added to the scheduling priority of the process (see os.nice).
+        tokens replaces the runner's tokens for this process (e.g. a jobserver
+        of the client that requested the build).
+        background processes get a token only when no other process waits for it. """
+        if self._stopping:
+            raise RuntimeError("Process runner is stopped")
+
+        all_limits = dict(self.default_limits)
+        all_limits.update(limits or {})
+
+        job = _Job(command, log, timeout, all_limits, env, cwd, niceness,
+                   self.tokens if tokens is None else tokens, background)
+        self._pending.append(job)
+        self._wakeup()
+        return job.future
+
+    def run(self, command, log=None, timeout=None, limits=None, env=None, cwd=None, niceness=0,
+            tokens=None):
+        """ Synchronous version of submit(), waits for the process and returns
+        its stdout. """
+        return self.submit(command, log, timeout, limits, env, cwd, niceness, tokens).result()
+
+    @contextlib.contextmanager
+    def token(self):
+        """ Context manager that holds one job token while work is done outside of
+        the runner (e.g. in a persistent worker). """
+        self.acquire_token()
+        try:
+            yield
+        finally:
+            self.release_token()
+
+    def acquire_token(self):
+        """ Take a job token for work outside of the runner, it must be returned
+        by release_token. Prefer token() where the work fits in a with block. """
+        self.tokens.acquire()
+
+    def release_token(self):
+        self.tokens.release()
+        self._wakeup() # Commands may be waiting for it
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b"\0")
+        except BlockingIOError:
+            pass # The loop will wake up anyway
+
+    def _loop(self):
+        while not self._stopping:
+            self._start_pending()
+
+            for key, events in self._selector.select(self._select_timeout()):
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_read, self._read_size):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._read(*key.data)
+
+            self._check_exiting()
+            self._check_timeouts()
+
+        for job in list(self._running):
+            job.process.kill()
+            self._finish(job, RuntimeError("Process runner stopped"))
+        while self._pending:
+            self._pending.popleft().future.cancel()
+
+    def _select_timeout(self):
+        if self._exiting:
+            return 0.01
+        timeouts = [max(0, job.deadline - time.monotonic())
+                    for job in self._running if job.deadline is not None]
+        if any(self._external_tokens or job.tokens is not self.tokens for job in self._pending):
+            timeouts.append(self._token_poll_interval)
+        if not timeouts:
+            return None
+        return min(timeouts)
+
+    def _start_pending(self):
+        exhausted = set() # ids of token sources that didn't have a free token
+        for job in sorted(self._pending, key=lambda job: job.background):
+            if id(job.tokens) in exhausted:
+                continue
+            if not job.tokens.acquire(blocking=False):
+                exhausted.add(id(job.tokens))
+                continue
+            self._pending.remove(job)
+
+            if not job.future.set_running_or_notify_cancel():
+                job.tokens.release()
+                continue
+
+            try:
+                job.start()
+            except Exception as e:
+                job.tokens.release()
+                job.future.set_exception(e)
+                continue
+
+            self._running.add(job)
+            for name, stream in (("stdout", job.process.stdout),
+                                 ("stderr", job.process.stderr)):
+                os.set_blocking(stream.fileno(), False)
+                self._selector.register(stream, selectors.EVENT_READ, (job, name))
+
+    def _read(self, job, name):
+        stream = getattr(job.process, name)
+        try:
+            data = os.read(stream.fileno(), self._read_size)
+        except BlockingIOError:
+            return
+
+        if data:
+            job.received(name, data)
+            return
+
+        self._selector.unregister(stream)
+        stream.close()
+        job.received(name, None)
+        if job.process.stdout.closed and job.process.stderr.closed:
+            self._exiting.add(job)
+
+    def _check_exiting(self):
+        for job in list(self._exiting):
+            if job.process.poll() is not None:
+                self._exiting.remove(job)
+                self._finish(job, None)
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        for job in list(self._running):
+            if job.deadline is not None and now >= job.deadline:
+                job.process.kill()
+                self._finish(job, subprocess.TimeoutExpired(job.command, job.timeout))
+
+    def _finish(self, job, exception):
+        for stream in (job.process.stdout, job.process.stderr):
+            if not stream.closed:
+                self._selector.unregister(stream)
+                stream.close()
+        job.process.wait()
+
+        self._running.discard(job)
+        self._exiting.discard(job)
+        job.tokens.release()
+
+        stdout, stderr = job.output()
+        if exception is None and job.process.returncode != 0:
+            exception = Exception("Command failed", job.command, stdout, stderr,
+                                  job.process.returncode)
+        if exception is None:
+            job.future.set_result(stdout)
+        else:
+            job.future.set_exception(exception)
+
+
+class _Job:
+    """ Single process supervised by ProcessRunner. """
+    def __init__(self, command, log, timeout, limits, env, cwd, niceness, tokens, background):
+        self.command = [str(x) for x in command]
+        self.log = log
+        self.timeout = timeout
+        self.limits = limits
+        self.env = env
+        self.cwd = cwd
+        self.niceness = niceness
+        self.tokens = tokens
+        self.background = background
+
+        self.future = concurrent.futures.Future()
+        self.process = None
+        self.deadline = None
+        self._chunks = {"stdout": [], "stderr": []}
+        self._partial_lines = {"stdout": b"", "stderr": b""}
+
+    def start(self):
+        preexec_fn = None
+        if self.limits or self.niceness:
+            preexec_fn = functools.partial(preexec, self.limits, self.niceness)
+        env = self.env
+        pass_fds = ()
+        share_with_child = getattr(self.tokens, "share_with_child", None)
+        if share_with_child is not None:
+            env, pass_fds = share_with_child(env)
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        env=env,
+                                        cwd=None if self.cwd is None else str(self.cwd),
+                                        preexec_fn=preexec_fn,
+                                        pass_fds=pass_fds)
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+
+    def received(self, name, data):
+        """ Store a chunk of output and pass complete lines to the log callback.
+        data is None at the end of the stream. """
+        if data is not None:
+            self._chunks[name].append(data)
+            data = self._partial_lines[name] + data
+            *lines, self._partial_lines[name] = data.split(b"\n")
+        else:
+            lines = [self._partial_lines[name]] if self._partial_lines[name] else []
+            self._partial_lines[name] = b""
+
+        if self.log is not None:
+            for line in lines:
+                self.log(name, line.decode("utf8", "replace").rstrip("\r"))
+
+    def output(self):
+        return tuple(b"".join(self._chunks[name]).decode("utf8", "replace").replace("\r\n", "\n")
+                     for name in ("stdout", "stderr"))
+
+
+def preexec(limits, niceness=0):
+    """ Apply resource limits and niceness as described in ProcessRunner.submit.
+    Meant to run in the child process before exec (as subprocess preexec_fn). """
+    if niceness:
+        os.nice(niceness)
+    for which, value in limits.items():
+        if not isinstance(value, tuple):
+            value = (value, value)
+        resource.setrlimit(which, value)
@@ -1,5 +1,7 @@
 from . import util
 
+import asyncio
+import concurrent.futures
 import json
 import os
 import sys
@@ -8,7 +10,7 @@ import time
 import threading
 import multiprocessing
 import socket
-import socketserver
+import struct
 import logging
 import traceback
 import pathlib
@@ -47,11 +49,29 @@ class Service:
     _clonnection -- Instance of _connection_class that corresponds to the client
                     making the current call.
     _last_call_time -- Time of last RPC call.
-    _server -- SocketServer subclass that handles the connection
-    _lock -- Lock that protects all method calls.
+    _server -- Server that handles the connections (asyncio based)
+    _lock -- Lock that protects all method calls. Iterators returned by the
+             methods (see IteratorWrapper) are advanced without holding it.
+    _max_calls -- May be set by subclass. Number of calls that can run at the same time,
+                  there is no limit on the number of connected clients.
+                  Iterators are advanced outside of this limit, each connection
+                  has a thread of its own for them.
+    _message_timeout -- Seconds to wait for the rest of a request once it started arriving.
+    _shutdown_timeout -- Seconds that running calls get to finish when the service stops.
+    _unlocked_methods -- May be set by subclass. Names of methods that are called
+                         without holding _lock, so that they can run concurrently.
+    _address -- May be set by subclass. Tuple (host, port) the server listens on.
+                Default is localhost with a random port. Anyone who can connect
+                can run any code in the service, only listen on trusted networks.
     """
 
     _connection_class = DefaultConnectionClass
+    _unlocked_methods = frozenset()
+    _address = ("localhost", 0)
+    _max_calls = 32
+    _message_timeout = 60
+    _shutdown_timeout = 5
+    _periodic_interval = 0.5
 
     def __init__(self, control_file):
         """ Initialize the server of this service.
@@ -64,22 +84,29 @@ class Service:
     def __exit__(self, *exc):
         """ To be overridden """
 
+    def _periodic(self):
+        """ To be overridden.
+        Called every _periodic_interval seconds with _lock held. """
+
     def _stop(self):
         """ Exit the main loop. Intended to be called by subclasses. """
         #logger.info("Service stop requested.")
         with open("/tmp/x", "w") as fp:
             fp.write("ASDF\n")
-        threading.Thread(target=self._server.shutdown, daemon=True).start()
+        self._server.shutdown()
 
 
 class ServiceProxy:
-    def __init__(self, cls, control_file, force_restart=False):
+    def __init__(self, cls, control_file, force_restart=False, start=True):
+        """ If start is False, the service is not started when it is not running,
+        entering the proxy fails instead. """
         self._cls = cls
         self._control_file = util.make_absolute(pathlib.Path(control_file))
         self._socket = None
         self._rfile = None
         self._wfile = None
         self._force_restart = force_restart
+        self._start = start
 
     def __enter__(self):
         """ Connect to the service, start it if not already running.
@@ -94,6 +121,9 @@ class ServiceProxy:
                 self._call("_stop")
                 self._close()
                 time.sleep(0.5)
+            if self._socket is None and not self._start:
+                raise Exception("Service {} with control file {} is not running".format(
+                                    self._cls.__name__, self._control_file))
             if self._socket is None:
                 logger.info("Starting service %s with control file %s",
                             self._cls.__name__,
@@ -124,8 +154,8 @@ class ServiceProxy:
         return func
 
     def _call(self, name, *args, **kwargs):
-        pickle.dump((name, args, kwargs), self._wfile)
-        result, exc_info = pickle.load(self._rfile)
+        self._wfile.write(_frame((name, args, kwargs)))
+        result, exc_info = _read_message(self._rfile)
         if exc_info is None:
             if isinstance(result, IteratorWrapper):
                 result._proxy = self
@@ -133,8 +163,8 @@ class ServiceProxy:
         else:
             raise exc_info[1] from Exception("Original traceback:\n" +"".join(traceback.format_list(exc_info[2])))
 
-    def _open(self, port):
-        self._socket = socket.create_connection(("localhost", port))
+    def _open(self, host, port):
+        self._socket = socket.create_connection((host, port))
         self._rfile = self._socket.makefile("rb", -1)
         self._wfile = self._socket.makefile("wb", 0)
 
@@ -168,7 +198,7 @@ class ServiceProxy:
             return False
 
         try:
-            self._open(loaded["port"])
+            self._open(loaded.get("host", "localhost"), loaded["port"])
         except ConnectionRefusedError:
             return False
 
@@ -192,100 +222,252 @@ class IteratorWrapper:
         return self._proxy._call(self.it)
 
 
-class _PickleRPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    allow_reuse_address = True
-    daemon_threads = True
+_header = struct.Struct("<Q") # Length of the pickled message that follows
 
-    def __init__(self, address, instance):
-        self.instance = instance
-        super().__init__(address, _PickleRPCRequestHandler)
+def _frame(obj):
+    data = pickle.dumps(obj)
+    return _header.pack(len(data)) + data
+
+def _read_message(fp):
+    """ Read a single message from a file object, raise EOFError if the connection
+    was closed. """
+    header = fp.read(_header.size)
+    if len(header) < _header.size:
+        raise EOFError("Connection closed")
+    size, = _header.unpack(header)
+    data = fp.read(size)
+    if len(data) < size:
+        raise EOFError("Connection closed")
+    return pickle.loads(data)
 
-    def service_actions(self):
-        super().service_actions()
 
-        with self.instance._lock:
-            if self.instance._timeout is None or \
-               time.time() <= self.instance._last_call_time + self.instance._timeout:
+class _Server:
+    """ Serves RPC calls of a service from a single asyncio event loop, so that
+    an idle client only costs a coroutine.
+    The calls themselves run in a pool of at most _max_calls threads, requests
+    of other clients are read and queued while the pool is busy.
+    Iterators may wait for a long time (e.g. for progress of an update), they are
+    advanced in a thread of the connection instead, so that they can't use up the pool. """
+
+    def __init__(self, instance, address):
+        self.instance = instance
+        self.socket = socket.create_server(address)
+        self._executor = concurrent.futures.ThreadPoolExecutor(instance._max_calls,
+                                                               thread_name_prefix="ServiceCall")
+        self._loop = None
+        self._stopping = None
+        self._tasks = set() # Tasks handling the connections
+        self._idle_tasks = set() # Tasks waiting for a request
+
+    def serve_forever(self):
+        """ Run until shutdown() is called. Raises TimeoutError when the service
+        didn't get any call for _timeout seconds. """
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        """ Stop serving, may be called from any thread. """
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        server = await asyncio.start_server(self._handle, sock=self.socket)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.instance._periodic_interval)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                # Not in the call pool, so that a busy pool doesn't delay the timeout check
+                await self._loop.run_in_executor(None, self._periodic)
+        finally:
+            server.close()
+            # Calls that are running get a chance to send their results
+            self._stopping.set()
+            for task in self._idle_tasks:
+                task.cancel()
+            if self._tasks:
+                done, pending = await asyncio.wait(self._tasks,
+                                                   timeout=self.instance._shutdown_timeout)
+                for task in pending:
+                    task.cancel()
+            self._executor.shutdown(wait=False)
+
+    def _periodic(self):
+        instance = self.instance
+        with instance._lock:
+            instance._periodic()
+            if instance._timeout is None or \
+               time.time() <= instance._last_call_time + instance._timeout:
                 return
             raise TimeoutError("Timed out waiting for RPC calls ({} > {} + {})".format(
                                  time.time(),
-                                 self.instance._last_call_time,
-                                 self.instance._timeout))
+                                 instance._last_call_time,
+                                 instance._timeout))
 
-class _PickleRPCRequestHandler(socketserver.StreamRequestHandler):
-    def handle(self):
-        instance = self.server.instance
-        iterators = {}
-        connection = None
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        connection = _Connection(self.instance, writer.get_extra_info("peername")[:2])
+        try:
+            while not self._stopping.is_set():
+                self._idle_tasks.add(task)
+                try:
+                    header = await reader.readexactly(_header.size)
+                finally:
+                    self._idle_tasks.discard(task)
+                size, = _header.unpack(header)
+                # Only waiting for the next request is unlimited
+                request = await asyncio.wait_for(reader.readexactly(size),
+                                                 self.instance._message_timeout)
 
-        with contextlib.ExitStack() as stack:
-            while True:
                 try:
-                    func_name, args, kwargs = pickle.load(self.rfile)
-
-                    with instance._lock:
-                        if connection is None:
-                            # Connection is initialised here so that we can pass
-                            # its exceptions to the caller.
-                            #try:
-                            connection = instance._connection_class(instance, self.client_address)
-                            #except Exception as e:
-                            #    raise Exception(repr(e)) #TODO: Why are these not caught directly?
-
-                            if connection is None:
-                                raise ValueError("_connection_class constructor returned None!")
-                            stack.enter_context(connection)
-
-                        instance._last_call_time = time.time()
-                        instance._connection = connection
-
-                        if func_name in iterators:
-                            assert len(args) == 0
-                            assert len(kwargs) == 0
-                            result = next(iterators[func_name])
-                        else:
-                            func = getattr(instance, func_name)
-                            result = func(*args, **kwargs)
-
-                        if isinstance(result, IteratorWrapper):
-                            iterator_id = "!" + str(id(result.it))
-                            iterators[iterator_id] = result.it # TODO: Now we are memory leaking exhausted iterators
-                            result.it = iterator_id
-
-                    data = pickle.dumps((result, None))
-                    self.wfile.write(data)
-                except:
-                    self.send_exception()
-
-    def send_exception(self, level = 1, max_level = 3):
+                    message = pickle.loads(request)
+                except Exception:
+                    response = _exception_response()
+                else:
+                    executor = self._executor
+                    if _is_iterator_call(message):
+                        executor = connection.get_iterator_executor()
+                    response = await self._loop.run_in_executor(executor, connection.call, message)
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                asyncio.CancelledError, ConnectionError):
+            pass # Client disconnected, sent an incomplete request or the server is stopping
+        finally:
+            self._tasks.discard(task)
+            connection.close()
+            writer.close()
+
+
+class _Connection:
+    """ State of a single client connection. """
+
+    def __init__(self, instance, address):
+        self.instance = instance
+        self.address = address
+        self.connection = None # Instance of the service's _connection_class
+        self.iterators = {}
+        self.iterator_executor = None
+        self.stack = contextlib.ExitStack()
+        # Iterators that were not exhausted are closed when the client disconnects
+        self.stack.callback(_close_iterators, self.iterators)
+
+    def close(self):
+        self.stack.close()
+
+    def get_iterator_executor(self):
+        """ Return executor with a single thread that advances iterators of this connection. """
+        if self.iterator_executor is None:
+            self.iterator_executor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix="ServiceIterator")
+            self.stack.callback(self.iterator_executor.shutdown, wait=False)
+        return self.iterator_executor
+
+    def call(self, message):
+        """ Handle a single unpickled request, return the framed response.
+        Runs in the call pool, or in the iterator executor for iterator calls. """
+        instance = self.instance
         try:
-            ex_type, ex_value, ex_tb = sys.exc_info()
-            data = pickle.dumps((None, (ex_type, ex_value, traceback.extract_tb(ex_tb))))
-                # TODO: Better way to pass traceback
-                # https://mail.python.org/pipermail/python-3000/2007-April/006604.html ?
-            self.wfile.write(data)
+            func_name, args, kwargs = message
+            unlocked = func_name in instance._unlocked_methods
+
+            with instance._lock:
+                if self.connection is None:
+                    # Connection is initialised here so that we can pass
+                    # its exceptions to the caller.
+                    self.connection = instance._connection_class(instance, self.address)
+                    if self.connection is None:
+                        raise ValueError("_connection_class constructor returned None!")
+                    self.stack.enter_context(self.connection)
+
+                instance._last_call_time = time.time()
+                instance._connection = self.connection
+
+                if not unlocked and not func_name.startswith("!"):
+                    func = getattr(instance, func_name)
+                    result = func(*args, **kwargs)
+
+            if func_name.startswith("!"):
+                # Iterators may block waiting for progress of other calls (e.g. an update),
+                # so they run without the lock. Iterators belong to this connection only,
+                # whose requests are handled one at a time.
+                assert len(args) == 0
+                assert len(kwargs) == 0
+                if func_name not in self.iterators:
+                    raise StopIteration() # Exhausted and already removed
+                try:
+                    result = next(self.iterators[func_name])
+                except StopIteration:
+                    del self.iterators[func_name]
+                    raise
+            elif unlocked:
+                func = getattr(instance, func_name)
+                result = func(*args, **kwargs)
+
+            if isinstance(result, IteratorWrapper):
+                iterator_id = "!" + str(id(result.it))
+                self.iterators[iterator_id] = result.it
+                result.it = iterator_id
+
+            return _frame((result, None))
         except:
-            if level < max_level:
-                self.send_exception(level + 1, max_level)
-            else:
-                pass # Nothing we can do :-(
+            return _exception_response()
 
+def _is_iterator_call(message):
+    """ Check if a request advances an iterator (see IteratorWrapper). """
+    try:
+        func_name, args, kwargs = message
+        return func_name.startswith("!")
+    except Exception:
+        return False
+
+def _exception_response(level = 1, max_level = 3):
+    try:
+        ex_type, ex_value, ex_tb = sys.exc_info()
+        return _frame((None, (ex_type, ex_value, traceback.extract_tb(ex_tb))))
+            # TODO: Better way to pass traceback
+            # https://mail.python.org/pipermail/python-3000/2007-April/006604.html ?
+    except:
+        if level < max_level:
+            return _exception_response(level + 1, max_level)
+        return _frame((None, (Exception, Exception("Exception could not be sent"), [])))
+
+
+def _close_iterators(iterators):
+    for it in iterators.values():
+        close = getattr(it, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+    iterators.clear()
 
 def _run(cls, control_file):
     """ The actual code run by the service.
     This always runs in another process. """
 
     _daemonize()
+    serve(cls, control_file)
 
+def serve(cls, control_file):
+    """ Run the service in the current process until it stops.
+    Used directly for services started by other means than ServiceProxy
+    (e.g. on another machine). """
     try:
         with control_file.open("w") as fp:
             instance = cls(control_file)
 
-            instance._server = _PickleRPCServer(("localhost", 0), instance)
+            instance._server = _Server(instance, cls._address)
             instance._last_call_time = time.time()
             instance._lock = threading.Lock()
 
+            host = cls._address[0] or socket.getfqdn() # Empty address listens everywhere
             json.dump({"pid": os.getpid(),
+                       "host": host,
                        "port": instance._server.socket.getsockname()[1]},
                       fp)
 
@@ -0,0 +1,106 @@
+import contextlib
+import hashlib
+import os
+import pathlib
+import shutil
+import stat
+import tempfile
+import threading
+
+_tmpfs_root = pathlib.Path("/dev/shm")
+
+def scratch_directory(build_directory):
+    """ Return directory for temporary files of builds in the build directory.
+    Uses tmpfs when it is available, so that intermediate files never get
+    written to the disk. The name in tmpfs is predictable, it is only used if
+    it is a directory that belongs to us and nobody else can access. """
+    if _tmpfs_root.is_dir() and os.access(str(_tmpfs_root), os.W_OK | os.X_OK):
+        key = hashlib.sha1(str(build_directory.resolve()).encode("utf-8")).hexdigest()[:16]
+        path = _tmpfs_root / "bs-{}-{}".format(os.getuid(), key)
+        try:
+            path.mkdir(mode=0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            return build_directory / "tmp"
+        if _is_private_directory(path):
+            return path
+    return build_directory / "tmp"
+
+def _is_private_directory(path):
+    try:
+        st = os.lstat(str(path))
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            stat.S_IMODE(st.st_mode) == 0o700)
+
+class StagingArea:
+    """ Pool of empty directories for temporary files of builds.
+    Directories are emptied and reused instead of being created and deleted
+    for every build.
+    StagingArea is a context manager, leftovers of previous runs are removed
+    on enter and the idle directories on exit. """
+
+    def __init__(self, directory, max_idle=16):
+        self.directory = directory
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        try:
+            _empty_directory(self.directory)
+        except FileNotFoundError:
+            pass
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for path in idle:
+            shutil.rmtree(str(path), ignore_errors=True)
+        try:
+            self.directory.rmdir()
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def tempdir(self):
+        """ Context manager returning path to an empty directory. """
+        with self._lock:
+            path = self._idle.pop() if self._idle else None
+
+        if path is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = pathlib.Path(tempfile.mkdtemp(prefix="", suffix="", dir=str(self.directory)))
+
+        try:
+            yield path
+        finally:
+            self._release(path)
+
+    def _release(self, path):
+        try:
+            _empty_directory(path)
+        except OSError:
+            shutil.rmtree(str(path), ignore_errors=True)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(path)
+                return
+        path.rmdir()
+
+def _empty_directory(path):
+    with os.scandir(str(path)) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
@@ -0,0 +1,82 @@
+from . import util
+
+import pickle
+import threading
+
+class Statistics:
+    """ History of build times and changes of source files and the unity batches
+    that built them. Kept by the backend across restarts and used for planning
+    unity builds.
+    Statistics is a context manager, loaded when entered and saved on exit. """
+
+    _change_decay = 0.8
+
+    def __init__(self, path):
+        self.path = path
+        self._times = {} # path -> util.Timer
+        self._changes = {} # path -> (last hash, decaying count of changes)
+        self._batches = {} # path -> name of the unity source that built it last
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        try:
+            with self.path.open("rb") as fp:
+                self._times, self._changes, self._batches = pickle.load(fp)
+        except (FileNotFoundError, pickle.PickleError, EOFError, ValueError):
+            pass
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+    def save(self):
+        with self._lock:
+            with self.path.open("wb") as fp:
+                pickle.dump((self._times, self._changes, self._batches), fp)
+
+    @util.synchronized
+    def record(self, path, elapsed=None, hash=None, batch=None):
+        """ Record a build that used a source file.
+        elapsed is the build time attributed to this file, hash is current hash
+        of the file (if changes of the file should be tracked), batch is name
+        of the unity source that included the file. """
+        path = str(path)
+        if elapsed is not None:
+            self._times.setdefault(path, util.Timer()).add(elapsed)
+        if hash is not None:
+            old_hash, changes = self._changes.get(path, (hash, 0))
+            if hash != old_hash:
+                changes += 1
+            self._changes[path] = (hash, changes)
+        if batch is not None:
+            self._batches[path] = batch
+
+    @util.synchronized
+    def decay_changes(self):
+        """ Called once per configuration of the targets. Counts of changes
+        decay even for files that are not rebuilt, so that a file that stopped
+        changing is eventually batched again. """
+        for path, (hash, changes) in self._changes.items():
+            self._changes[path] = (hash, changes * self._change_decay)
+
+    @util.synchronized
+    def get(self, paths):
+        """ Return dict mapping known paths (as strings) to (build time, change rate).
+        Change rate is a count of changes seen by the builds, decaying with every
+        configuration. None values mean that the value wasn't recorded yet. """
+        ret = {}
+        for path in paths:
+            path = str(path)
+            timer = self._times.get(path)
+            changes = self._changes.get(path)
+            if timer is None and changes is None:
+                continue
+            ret[path] = (timer.time if timer is not None else None,
+                         changes[1] if changes is not None else None)
+        return ret
+
+    @util.synchronized
+    def get_batches(self, paths):
+        """ Return dict mapping known paths (as strings) to names of the unity
+        sources that included them in their last builds. """
+        return {str(path): self._batches[str(path)] for path in paths if str(path) in self._batches}
@@ -1,64 +1,297 @@
+from . import nodes
+
 import collections
-import concurrent.futures
-import logging
-
-#logger = logging.getLogger(__name__)
-
-def update(context, targets, dirty, job_count = 1):
-    need_update = collections.Counter() # node: number of blockers
-
-    targets = set(targets)
-
-    class Head:
-        def __str__(self):
-            return "HEAD"
-    head = Head()
-    head.reverse_dependencies = list(dirty)[:]
-    to_check = collections.deque([head])
-
-    while to_check:
-        node = to_check.popleft()
-        for reverse_dependency in node.reverse_dependencies:
-            if not reverse_dependency.targets.isdisjoint(targets):
-                if reverse_dependency not in need_update:
-                    to_check.append(reverse_dependency)
-                need_update[reverse_dependency] += 1
-                #logger.debug("need update: %s caused by %s count %d", reverse_dependency, node, need_update[reverse_dependency])
-            new_dirty.add(reverse_dependency)
-
-    #logger.debug("need_update: %s", ", ".join("{}: {}".format(str(k), v) for k, v in need_update.items()))
-
-    with concurrent.futures.ThreadPoolExecutor(job_count) as executor:
-        waiting = set()
-
-        def maybe_submit(node):
-            def wrapper(node):
-                node.update(context)
-                return node
-
-            if node not in need_update:
-                #logger.debug("not in need_update: %s", node)
-                node.update(context)
-                return
-
-            need_update[node] -= 1
-            if need_update[node] == 0:
-                #logger.debug("submitting: %s", node)
-                del need_update[node]
-                waiting.add(executor.submit(wrapper, node))
-            #else:
-                #logger.debug("still blocked: %s (%d)", node, need_update[node])
-
-        # Remove dependency on the head node and run the initial updates
-        for node in head.reverse_dependencies:
-            maybe_submit(node)
-
-        while waiting:
-            done, waiting = concurrent.futures.wait(waiting,
-                                                    return_when=concurrent.futures.FIRST_COMPLETED)
-            for future in done:
-                node = future.result()
-                for reverse_dependency in node.reverse_dependencies:
-                    maybe_submit(reverse_dependency)
-
-        return new_dirty #TODO: What if build fails?
+import threading
+
+class _Request:
+    """ A single build request waiting for a set of nodes. """
+    def __init__(self, context, targets, target_done):
+        self.context = context
+        self.targets = set(targets)
+        self.target_done = target_done
+        self.remaining = 0 # Number of scheduled nodes this request waits for
+        self.running = 0 # Number of those that are being updated
+        self.done = 0 # Number of nodes updated for this request
+        self.failed = False
+
+    def report_status(self):
+        self.context.status(self.running, self.done, self.remaining - self.running)
+
+class Scheduler:
+    """ Updates dirty nodes of the graph in topological order.
+
+    Every scheduled node has a counter of its dirty dependencies that were not
+    updated yet, a node is submitted to the executor when its counter drops to zero.
+    A node is scheduled only once, even when several targets or concurrent build
+    requests need it, the requests are just notified when it finishes.
+    Ready applications of builders with batch_size > 1 are updated in batches.
+    Nodes needed only by background requests (context.background, e.g. rebuilds
+    of watched targets) are updated by the background executor, so that they
+    don't hold up threads needed by other requests.
+
+    Nodes are considered clean when their dirty attribute is false, a clean node
+    must only have clean dependencies. """
+
+    def __init__(self, executor, background_executor=None):
+        self.executor = executor
+        self.background_executor = executor if background_executor is None else background_executor
+        self._lock = threading.Lock()
+        self._pending = {} # scheduled node -> number of unfinished dirty dependencies
+        self._requests = {} # scheduled node -> list of _Request waiting for it
+        self._dependents = collections.defaultdict(set) # scheduled node -> scheduled nodes waiting for it
+        self._running = set()
+        self._invalidated = set() # Running nodes that were invalidated and must stay dirty
+
+    def build(self, context, targets, target_done=None):
+        """ Start updating all dirty nodes that the targets depend on.
+        target_done(node) is called for every target once it is up to date,
+        context.finish() when all targets are done and context.exception()
+        if any update fails. """
+        request = _Request(context, targets, target_done)
+        with self._lock:
+            ready, finished_targets = self._schedule(request)
+            if not request.remaining:
+                finished_targets = request.targets
+
+        for target in finished_targets:
+            self._notify_target(request, target)
+        if not request.remaining:
+            context.finish()
+        self._submit(ready)
+
+    def invalidate(self, changed):
+        """ Mark the nodes and everything that depends on them dirty. """
+        with self._lock:
+            to_visit = list(changed)
+            while to_visit:
+                node = to_visit.pop()
+                if node in self._running:
+                    self._invalidated.add(node)
+                if node.dirty:
+                    continue
+                node.dirty = True
+                to_visit.extend(node.reverse_dependencies or ())
+
+    def _schedule(self, request):
+        """ Add dirty dependencies of the request's targets to the schedule.
+        Returns list of nodes ready to be submitted and list of targets that are
+        already up to date. Must be called with the lock held. """
+        ready = []
+        finished_targets = []
+        visited = set()
+        to_visit = list(request.targets)
+        while to_visit:
+            node = to_visit.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+
+            if not node.dirty:
+                if node in request.targets:
+                    finished_targets.append(node)
+                continue
+
+            request.remaining += 1
+            if node in self._requests:
+                # Already scheduled by someone else
+                if not request.context.background and self._is_background(node):
+                    # Take over the nodes waiting for the background executor
+                    if not self._pending[node] and node not in self._running:
+                        ready.append(node)
+                    to_visit.extend(dep for dep in node.dependencies if dep.dirty)
+                self._requests[node].append(request)
+                continue
+            self._requests[node] = [request]
+
+            dirty_dependencies = [dep for dep in node.dependencies if dep.dirty]
+            self._pending[node] = len(dirty_dependencies)
+            for dep in dirty_dependencies:
+                self._dependents[dep].add(node)
+            to_visit.extend(dirty_dependencies)
+
+            if not dirty_dependencies:
+                ready.append(node)
+
+        return ready, finished_targets
+
+    def _is_background(self, node):
+        """ Must be called with the lock held. """
+        return all(request.context.background for request in self._requests[node])
+
+    def _submit(self, ready):
+        """ Submit jobs for nodes whose dependencies are all up to date.
+        Nodes with nothing to do are finished right away and the nodes they make
+        ready are submitted together with the rest, so that they can be batched. """
+        ready = collections.deque(ready)
+        jobs = []
+        while ready:
+            node = ready.popleft()
+            if type(node).update is nodes.Node.update:
+                ready.extend(self._run([node])) # Nothing to do, don't bother the executor
+            else:
+                jobs.append(node)
+
+        with self._lock:
+            executors = {node: self.background_executor if self._is_background(node) else self.executor
+                         for node in jobs}
+
+        batches = collections.defaultdict(list) # (builder, executor) -> [application]
+        for node in jobs:
+            if isinstance(node, nodes.Application) and node.builder.batch_size > 1:
+                batches[node.builder, executors[node]].append(node)
+            else:
+                executors[node].submit(self._run_and_submit, [node])
+
+        for (builder, executor), applications in batches.items():
+            for i in range(0, len(applications), builder.batch_size):
+                executor.submit(self._run_and_submit, applications[i:i + builder.batch_size])
+
+    def _run_and_submit(self, batch):
+        self._submit(self._run(batch))
+
+    def _run(self, batch):
+        """ Update a batch of nodes (all applications of one builder if there is more
+        than one) and release their dependents. Returns list of nodes that became
+        ready to be submitted. """
+        with self._lock:
+            # Nodes promoted from the background executor may have been updated already
+            batch = [node for node in batch
+                     if node in self._requests and not self._pending[node] and
+                        node not in self._running]
+            if not batch:
+                return []
+            requests = self._requests[batch[0]]
+            cancelled = all(request.failed or request.context.stop_flag for request in requests)
+            if not cancelled:
+                self._running.update(batch)
+                self._count_running(batch, 1)
+            context = next((request.context for request in requests if not request.failed),
+                           requests[0].context)
+
+        if cancelled:
+            self._fail(batch, None)
+            return []
+        for request in requests:
+            request.report_status()
+
+        try:
+            if len(batch) > 1:
+                context.log("Batch of {} x {}", len(batch), str(batch[0].builder))
+                pending = nodes.Application.update_batch(context, batch)
+            else:
+                context.log("{}", str(batch[0]))
+                pending = batch[0].update(context)
+        except Exception as e:
+            self._failed(batch, e)
+            return []
+
+        if pending is not None:
+            # The update finishes in a thread taken only once the future is done
+            pending.add_done_callback(lambda future: self._submit_finish(batch, future))
+            return []
+        return self._finish(batch)
+
+    def _submit_finish(self, batch, future):
+        with self._lock:
+            executor = self.background_executor if self._is_background(batch[0]) else self.executor
+        executor.submit(self._finish_and_submit, batch, future.result())
+
+    def _finish_and_submit(self, batch, finish):
+        """ Call the function finishing a pending update, then continue as _run_and_submit. """
+        try:
+            finish()
+        except Exception as e:
+            self._failed(batch, e)
+            return
+        self._submit(self._finish(batch))
+
+    def _failed(self, batch, e):
+        with self._lock:
+            self._running.difference_update(batch)
+            self._invalidated.difference_update(batch)
+            self._count_running(batch, -1)
+        self._fail(batch, e)
+
+    def _finish(self, batch):
+        """ Mark the batch updated, notify the requests. Returns list of nodes
+        that became ready. """
+        ready = []
+        notifications = []
+        finished = []
+        updated = set() # Requests that need a status update
+        with self._lock:
+            self._count_running(batch, -1)
+            for node in batch:
+                self._running.discard(node)
+                if node in self._invalidated:
+                    self._invalidated.discard(node)
+                else:
+                    node.dirty = False
+
+                del self._pending[node]
+                for request in self._requests.pop(node):
+                    request.remaining -= 1
+                    request.done += 1
+                    updated.add(request)
+                    if node in request.targets:
+                        notifications.append((request, node))
+                    if not request.remaining and not request.failed:
+                        finished.append(request)
+
+                for dependent in self._dependents.pop(node, ()):
+                    self._pending[dependent] -= 1
+                    if not self._pending[dependent]:
+                        ready.append(dependent)
+
+        for request, node in notifications:
+            if not request.failed:
+                self._notify_target(request, node)
+        for request in updated:
+            if not request.failed:
+                request.report_status()
+        for request in finished:
+            request.context.finish()
+        return ready
+
+    def _fail(self, batch, exception):
+        """ Remove the batch and everything waiting for it from the schedule,
+        report the exception to the affected requests. The nodes stay dirty. """
+        failed_requests = []
+        with self._lock:
+            to_remove = list(batch)
+            while to_remove:
+                node = to_remove.pop()
+                if node not in self._pending:
+                    continue
+                del self._pending[node]
+                for request in self._requests.pop(node):
+                    request.remaining -= 1
+                    if not request.failed:
+                        request.failed = True
+                        failed_requests.append(request)
+                to_remove.extend(self._dependents.pop(node, ()))
+
+            # Dependents may still be counted as waiting for other nodes
+            for dependents in self._dependents.values():
+                dependents.intersection_update(self._pending)
+
+        for request in failed_requests:
+            if exception is not None:
+                request.context.exception(exception)
+            else:
+                request.context.finish()
+
+    def _count_running(self, batch, delta):
+        """ Must be called with the lock held. """
+        for node in batch:
+            for request in self._requests[node]:
+                request.running += delta
+
+    def _notify_target(self, request, node):
+        if request.target_done is None:
+            return
+        try:
+            request.target_done(node)
+        except Exception as e:
+            request.failed = True
+            request.context.exception(e)
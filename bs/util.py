@@ -1,8 +1,12 @@
+import concurrent.futures
 import hashlib
 import mmap
 import contextlib
 import time
 import pathlib
+import functools
+import os
+import resource
 
 @contextlib.contextmanager
 def mmap_file(path):
@@ -58,11 +62,26 @@ class Timer:
 
     def __exit__(self, ex_type, ex_val, ex_tb):
         if ex_type is None or self._include_exceptions:
-            elapsed = time.perf_counter() - self._start_time
-            if self.time is None:
-                self.time = elapsed
-            else:
-                self.time = self._smoothing * self.time + (1 - self._smoothing) * elapsed
+            self.add(time.perf_counter() - self._start_time)
+
+    def add(self, elapsed):
+        """ Add a time measured elsewhere. """
+        if self.time is None:
+            self.time = elapsed
+        else:
+            self.time = self._smoothing * self.time + (1 - self._smoothing) * elapsed
+
+def map_future(future, fn):
+    """ Return a concurrent.futures.Future of fn(future), called when the future
+    is done by the thread that finished it (so fn should be quick). """
+    ret = concurrent.futures.Future()
+    def done(future):
+        try:
+            ret.set_result(fn(future))
+        except BaseException as e:
+            ret.set_exception(e)
+    future.add_done_callback(done)
+    return ret
 
 def synchronized(f):
     @functools.wraps(f)
@@ -76,3 +95,12 @@ def make_absolute(path):
         return pathlib.Path.cwd() / path
     else:
         return path
+
+def memory_usage():
+    """ Return resident set size of the current process in bytes. """
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak usage is the best we can get elsewhere
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,104 @@
+from . import context
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Watcher:
+    """ Rebuilds targets of build scripts in background when their source files
+    change, so that the next explicit update usually finds everything in cache.
+    Changes are debounced, the rebuild starts once no file changed for
+    `debounce` seconds. Rebuilds run in the background lane of the scheduler
+    and the runner, their commands with lowered priority. Nobody listens to their
+    progress, failures are logged.
+
+    Watcher is a context manager, watching runs while it is entered. """
+
+    niceness = 10
+
+    def __init__(self, backend, debounce=0.5):
+        from . import monitor # Imported here, watchdog is only needed in watch mode
+
+        self.backend = backend
+        self.debounce = debounce
+        self.build_scripts = set()
+
+        self._event = threading.Event()
+        self._monitor = monitor.Monitor(self._event.set)
+        self._watched_directories = set()
+        self._stopping = False
+        self._thread = None
+        self._context = None # Context of the running rebuild
+
+    def __enter__(self):
+        self._monitor.__enter__()
+        self._thread = threading.Thread(target=self._loop, name="Watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopping = True
+        self._event.set()
+        c = self._context
+        if c is not None:
+            c.stop_flag = True # Don't start any more jobs of the rebuild
+        self._thread.join()
+        self._monitor.__exit__(*exc_info)
+
+    def add(self, build_script):
+        """ Start rebuilding targets of the build script. """
+        self.build_scripts.add(build_script)
+        self._watch_new_directories()
+
+    def _watch_new_directories(self):
+        """ Watch directories of all source files known to the backend,
+        including implicit dependencies found by the previous builds. """
+        with self.backend._files_lock:
+            directories = {path.parent for path in self.backend.files.keys()}
+        for directory in directories - self._watched_directories:
+            if directory.is_dir():
+                self._monitor.watch(directory)
+            self._watched_directories.add(directory)
+
+    def _loop(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            # Wait until the files stop changing (editors often write in several steps)
+            while not self._stopping and self._event.wait(self.debounce):
+                self._event.clear()
+            if self._stopping:
+                return
+
+            changed = self._monitor.update()
+            if changed:
+                try:
+                    self._rebuild(changed)
+                except Exception:
+                    # The next explicit update reports the error to the user again
+                    logger.exception("Rebuild of watched targets failed")
+                self._watch_new_directories()
+
+    def _rebuild(self, changed_paths):
+        with self.backend._files_lock:
+            changed = [self.backend.files[path] for path in changed_paths
+                       if path in self.backend.files]
+        if not changed:
+            return
+
+        scheduler = self.backend.scheduler
+        scheduler.invalidate(changed)
+
+        # Not locking the backend here, unwatch() joins this thread while holding the lock
+        targets = [target for build_script in list(self.build_scripts)
+                   for target in self.backend.target_data.get(build_script, [])]
+
+        c = context.Context(self.backend, targets, None, niceness=self.niceness, background=True)
+        self._context = c
+        try:
+            scheduler.build(c, [target.node for target in targets])
+            for batch in c.iterate_progress():
+                pass # Nobody is listening
+        finally:
+            self._context = None
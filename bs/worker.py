@@ -0,0 +1,135 @@
+import collections
+import contextlib
+import json
+import subprocess
+import threading
+
+class PersistentWorker:
+    """ Long-lived tool process that accepts many build requests over a pipe.
+    The protocol is the JSON variant of Bazel persistent workers:
+    Each request is a single line with JSON object
+    {"arguments": [...], "requestId": 0} written to stdin of the worker,
+    the worker answers with a single line JSON object
+    {"exitCode": 0, "output": "...", "requestId": 0} on its stdout.
+    Requests are sent one at a time.
+    Lines the worker writes to stderr are passed to log("stderr", line), as
+    by ProcessRunner. log can be changed while the worker runs. """
+
+    def __init__(self, command, log=None):
+        self.command = [str(x) for x in command]
+        self.log = log
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        universal_newlines=True)
+        self._stderr_thread = threading.Thread(target=self._read_stderr,
+                                               name="Worker stderr", daemon=True)
+        self._stderr_thread.start()
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            log = self.log
+            if log is not None:
+                log("stderr", line.rstrip("\n"))
+
+    def request(self, arguments, timeout=600):
+        """ Send a single request, wait for the response and return its output.
+        Raises exception if the request fails. The worker is killed if it
+        doesn't respond in timeout seconds. """
+        arguments = [str(x) for x in arguments]
+
+        timer = threading.Timer(timeout, self.process.kill)
+        timer.start()
+        try:
+            self.process.stdin.write(json.dumps({"arguments": arguments,
+                                                 "requestId": 0}) + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except BrokenPipeError:
+            line = ""
+        finally:
+            timer.cancel()
+
+        if not line:
+            raise Exception("Worker exited", self.command, self.process.poll())
+
+        response = json.loads(line)
+        output = response.get("output", "")
+        exit_code = response.get("exitCode", 0)
+        if exit_code != 0:
+            raise Exception("Command failed", self.command + arguments, output, "", exit_code)
+        return output
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        """ Close stdin of the worker (which should make it exit) and wait for it. """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self._stderr_thread.join()
+        self.process.stderr.close()
+
+
+class WorkerPool:
+    """ Keeps idle persistent workers for reuse, workers are identified by
+    their command line.
+    Pool is a context manager, all idle workers are closed when it exits. """
+
+    def __init__(self, max_idle=4):
+        """ max_idle is the maximal number of idle workers kept for every command. """
+        self.max_idle = max_idle
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextlib.contextmanager
+    def worker(self, command, log=None):
+        """ Context manager that borrows an idle worker with the given command
+        or starts a new one. Workers that raised an exception are not reused.
+        log receives the worker's stderr while it is borrowed. """
+        key = tuple(str(x) for x in command)
+
+        with self._lock:
+            idle = self._idle[key]
+            worker = idle.pop() if idle else None
+
+        if worker is None or not worker.alive():
+            worker = PersistentWorker(key)
+        worker.log = log
+
+        try:
+            yield worker
+        except:
+            worker.close()
+            raise
+        finally:
+            worker.log = None
+
+        with self._lock:
+            if worker.alive() and len(self._idle[key]) < self.max_idle:
+                self._idle[key].append(worker)
+                worker = None
+        if worker is not None:
+            worker.close()
+
+    def close(self):
+        with self._lock:
+            workers = [worker for idle in self._idle.values() for worker in idle]
+            self._idle.clear()
+        for worker in workers:
+            worker.close()
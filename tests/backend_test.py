@@ -0,0 +1,271 @@
+from nose.tools import *
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+
+from bs import backend
+from bs import nodes
+from bs import progress
+from bs.run import UserContext
+from bs import service
+
+@nottest
+class LocalBackend:
+    """ Backend running in the test process, with build directory inside
+    the given directory. """
+    def __init__(self, directory):
+        self.directory = directory
+        (directory / "build").mkdir(exist_ok=True)
+        self.backend = backend.Backend(directory / "build" / "control")
+        self.backend._lock = threading.Lock()
+        self.backend._server = None
+
+    def __enter__(self):
+        self.backend.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.backend.__exit__(*exc_info)
+
+    def build(self, configure=None, target_names=None, remote_workers=None):
+        """ Upload targets created by configure(user_context) if it is given
+        and update them. Returns list of the progress messages. """
+        if configure is not None:
+            user_context = UserContext(self.directory, self.backend)
+            configure(user_context)
+            self.backend.set_targets("script", user_context._targets)
+        messages = []
+        for batch in self.backend.update("script", target_names, self.directory / "output",
+                                         remote_workers=remote_workers).it:
+            messages.extend(progress.format_event(event) for event in batch)
+        return messages
+
+@nottest
+class FakeFile:
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, context):
+        return self.path
+
+@nottest
+class FakeTarget:
+    def __init__(self, name, path):
+        self.name = name
+        self.node = FakeFile(path)
+
+def link_output_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        b = backend.Backend(d / "control")
+        try:
+            output_directory = d / "output"
+            target = FakeTarget("a", d / "cache" / "x" / "a")
+
+            assert b._link_output(target, output_directory)
+            eq_(os.readlink(str(output_directory / "a")), "../cache/x/a")
+            assert not b._link_output(target, output_directory) # Unchanged
+
+            target.node.path = d / "cache" / "y" / "a"
+            assert b._link_output(target, output_directory)
+            eq_(os.readlink(str(output_directory / "a")), "../cache/y/a")
+            eq_(os.listdir(str(output_directory)), ["a"])
+
+            # Output directory removed by the user between builds
+            shutil.rmtree(str(output_directory))
+            assert b._link_output(target, output_directory)
+            eq_(os.readlink(str(output_directory / "a")), "../cache/y/a")
+
+            # Names with slashes are linked in subdirectories
+            assert b._link_output(FakeTarget("x/b", d / "cache" / "y" / "b"), output_directory)
+            eq_(os.readlink(str(output_directory / "x" / "b")), "../../cache/y/b")
+        finally:
+            b.stack.close()
+
+def target_names_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        (d / "a").write_text("a")
+        (d / "b").write_text("b")
+
+        def configure(c):
+            # Both outputs are named "out"
+            c.add_target(c.apply(Concatenate(), d / "a", "out"), "first/out")
+            c.add_target(c.apply(Concatenate(), d / "b", "out"), "second")
+            c.add_target(d / "a", "source")
+
+        with LocalBackend(d) as b:
+            b.build(configure)
+        eq_((d / "output" / "first" / "out").read_text(), "a")
+        eq_((d / "output" / "second").read_text(), "b")
+        eq_((d / "output" / "source").read_text(), "a")
+
+@nottest
+class FakeTargetData:
+    def __init__(self, name):
+        self.name = name
+
+def select_targets_test():
+    available = [FakeTargetData(name) for name in ["a", "tests/foo", "tests/foo/x", "tests/foobar"]]
+    def select(*names):
+        return [target.name for target in backend.Backend._select_targets(available, names)]
+
+    eq_(select("a"), ["a"])
+    eq_(select("tests/foo"), ["tests/foo", "tests/foo/x"])
+    eq_(select("tests/", "tests/foo"), ["tests/foo", "tests/foo/x", "tests/foobar"])
+    with assert_raises(KeyError):
+        select("b")
+
+def expire_targets_test():
+    with tempfile.TemporaryDirectory() as d:
+        b = backend.Backend(pathlib.Path(d) / "control")
+        try:
+            b._max_build_scripts = 2
+            b._target_lifetime = 1000
+            for i, script in enumerate(["a", "b", "c", "d"]):
+                b.target_data[script] = []
+                b._last_used[script] = i * 1000
+
+            assert b._expire_targets(now=3500)
+            eq_(sorted(b.target_data), ["d"]) # c is too old, a and b over the limit
+            assert not b._expire_targets(now=3500)
+        finally:
+            b.stack.close()
+
+def shared_backend_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        shared = backend.SharedBackend(d / "control")
+        shared._lock = threading.Lock()
+        shared._server = None
+        shared.__enter__()
+        try:
+            eq_(shared.call_backend(str(d / "a"), "get_statistics", []), {})
+            eq_(shared.call_backend(str(d / "b"), "get_statistics", []), {})
+            a = shared.backends[d / "a"]
+            b = shared.backends[d / "b"]
+            assert a.files is b.files
+            assert a.runner is b.runner
+            assert a.cache is not b.cache
+            eq_(a.cache.directory, d / "a" / "cache")
+
+            with assert_raises(AttributeError):
+                shared.call_backend(str(d / "a"), "_stop")
+
+            shared._last_used[d / "a"] -= 2 * a._timeout
+            shared._periodic()
+            eq_(list(shared.backends), [d / "b"])
+
+            # Backend over its memory limit is closed, the service keeps running
+            b._memory_limit = 0
+            b._last_maintenance -= b._maintenance_interval
+            shared._periodic()
+            eq_(shared.backends, {})
+            eq_(shared.call_backend(str(d / "b"), "get_statistics", []), {})
+            assert shared.backends[d / "b"] is not b
+        finally:
+            shared.__exit__(None, None, None)
+        eq_(shared.backends, {})
+
+@nottest
+class Concatenate(nodes.Builder):
+    """ Builder that concatenates its inputs after a delay. """
+    def __init__(self, delay=0):
+        super().__init__()
+        self.delay = delay
+
+    def build(self, context, input_paths, output_paths):
+        time.sleep(self.delay)
+        output_paths[0].write_bytes(b"".join(path.read_bytes() for path in input_paths))
+
+    def get_output_names(self, input_names):
+        return ["out"]
+
+    def get_output_count(self, input_count):
+        return 1
+
+    def get_hash(self):
+        return self.hash_helper([])
+
+@nottest
+class Include(Concatenate):
+    """ Files named on lines "include path" of the input are implicit dependencies. """
+    def build(self, context, input_paths, output_paths):
+        super().build(context, input_paths, output_paths)
+        return [line.split(" ", 1)[1] for line in input_paths[0].read_text().splitlines()
+                if line.startswith("include ")]
+
+@nottest
+class SharedBackend(backend.SharedBackend):
+    _jobs = 4 # Independent of the machine, the test builds in parallel
+
+def shared_backend_service_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        source = d / "source"
+        source.write_text("abc")
+
+        proxy1 = service.ServiceProxy(SharedBackend, d / "control")
+        with proxy1, service.ServiceProxy(SharedBackend, d / "control") as proxy2:
+            try:
+                a = backend._BuildDirectoryProxy(proxy1, d / "a")
+                b = backend._BuildDirectoryProxy(proxy2, d / "b")
+                for build, delay in ((a, 1), (b, 0)):
+                    application = nodes.Application(Concatenate(delay),
+                                                    [nodes.SourceFile(source)], ["out"])
+                    build.set_targets("script", [("out", application.outputs[0])])
+
+                # Progress of a's slow build is waited for while b builds
+                messages = a.update("script", None, d / "a" / "output")
+                thread = threading.Thread(target=lambda: list(messages))
+                thread.start()
+                time.sleep(0.2)
+                start = time.monotonic()
+                list(b.update("script", None, d / "b" / "output"))
+                assert time.monotonic() - start < 0.5
+                thread.join()
+
+                eq_((d / "a" / "output" / "out").read_text(), "abc")
+                eq_((d / "b" / "output" / "out").read_text(), "abc")
+            finally:
+                proxy1._call("_stop")
+        for i in range(50):
+            if not (d / "control").exists():
+                break # The service finished writing to the directory
+            time.sleep(0.1)
+
+def affected_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        source = d / "source"
+        source.write_text("include {}\n".format(d / "a.h"))
+        for header in ["a.h", "b.h"]:
+            (d / header).write_text("")
+
+        with LocalBackend(d) as b:
+            def configure(c):
+                c.add_target(c.apply(Include(), source, "out"))
+                c.add_target(c.apply(Concatenate(), d / "b.h", "other"))
+            b.build(configure)
+
+            def affected(name):
+                return sorted(b.backend.affected("script", [str(d / name)])[0])
+            eq_(affected("a.h"), ["out"])
+            eq_(affected("b.h"), ["other"])
+            index = b.backend._impact_indexes["script"]
+
+            # Updates that don't change implicit dependencies keep the index
+            source.write_text("include {}\n\n".format(d / "a.h"))
+            b.backend.scheduler.invalidate([b.backend.files[source]])
+            b.build()
+            eq_(affected("a.h"), ["out"])
+            assert b.backend._impact_indexes["script"] is index
+
+            source.write_text("include {}\n".format(d / "b.h"))
+            b.backend.scheduler.invalidate([b.backend.files[source]])
+            b.build()
+            eq_(affected("a.h"), [])
+            eq_(affected("b.h"), ["other", "out"])
@@ -1,8 +1,12 @@
 from nose.tools import *
 import contextlib
+import hashlib
+import itertools
 import tempfile
 import shutil
+import stat
 import pathlib
+import threading
 
 from bs import cache
 
@@ -27,17 +31,20 @@ def cache_fixture():
 def file_name(i):
     return "file{:04d}".format(i)
 
+_contents = itertools.count()
+
 @nottest
 @contextlib.contextmanager
-def make_files(count):
+def make_files(count, content=None):
+    """ Create count single byte files, with different contents unless content is given """
     files = []
     directory = pathlib.Path(tempfile.mkdtemp(prefix="test_file_creation_area.", suffix=""))
 
     try:
         for i in range(count):
             path = directory / file_name(i)
-            with path.open("w") as fp:
-                fp.write("X")
+            with path.open("wb") as fp:
+                fp.write(content if content is not None else bytes([next(_contents) % 256]))
             files.append(path)
         yield files
     finally:
@@ -47,10 +54,11 @@ def make_files(count):
 def check_files(directory, count):
     """ Check that the directory contains exactly files created by make_files(count) """
 
-    for i, path in enumerate(sorted(directory.iterdir())):
+    paths = sorted(directory.iterdir())
+    eq_(len(paths), count)
+    for i, path in enumerate(paths):
         eq_(path.name, file_name(i))
-        with path.open("r") as fp:
-            eq_(fp.read(), "X")
+        eq_(path.stat().st_size, 1)
 
 def simple_test():
     with cache_fixture() as c:
@@ -84,6 +92,42 @@ def check_data(c):
         [[("file1", b"version1"), ("file2", b"version1")],
          [("file1", b"version2"), ("file2", b"version1")]])
 
+def find_implicit_deps_test():
+    with cache_fixture() as c:
+        create_data(c)
+
+        calls = []
+        def get_hash(versions):
+            def f(path):
+                calls.append(path)
+                return versions.get(path)
+            return f
+
+        eq_(c.find_implicit_dependencies(b"partial-1", get_hash({"file1": b"version1"})),
+            [("file1", b"version1")])
+        eq_(c.find_implicit_dependencies(b"partial-1", get_hash({"file1": b"version2", "file2": b"version2"})),
+            [("file1", b"version2"), ("file2", b"version2")])
+        eq_(c.find_implicit_dependencies(b"partial-2", get_hash({"file1": b"version2", "file2": b"version1"})),
+            [("file1", b"version2"), ("file2", b"version1")])
+
+        del calls[:]
+        eq_(c.find_implicit_dependencies(b"partial-1", get_hash({"file1": b"version3", "file2": b"version1"})),
+            None)
+        eq_(calls, ["file1"]) # Mismatch of file1 prunes all candidates
+
+        del calls[:]
+        eq_(c.find_implicit_dependencies(b"partial-2", get_hash({"file1": b"version1", "file2": b"version2"})),
+            None)
+        eq_(calls, ["file1", "file2"]) # Every file is hashed once only
+
+        eq_(c.find_implicit_dependencies(b"unknown", get_hash({})), None)
+
+        # Index is updated after put
+        with make_files(2) as files:
+            c.put(b"final-1-d", b"partial-1", files, [("file1", b"version3")])
+        eq_(c.find_implicit_dependencies(b"partial-1", get_hash({"file1": b"version3"})),
+            [("file1", b"version3")])
+
 def clear_test():
     """ Test clearing the cache and clearing it twice """
     with cache_fixture() as c:
@@ -106,20 +150,171 @@ def dropping_test():
                 c.put("final-{}".format(i).encode("ascii"),
                       b"partial",
                       files,
-                      i) # It's slightly hacky to add just an integer instead of the list of dependencies, but the cache shouldn't care
+                      [("file", i)])
 
-        eq_(set(c.get_candidate_implicit_dependencies(b"partial")), set(range(5)))
+        def versions():
+            return {deps[0][1] for deps in c.get_candidate_implicit_dependencies(b"partial")}
+
+        eq_(versions(), set(range(5)))
         c.accessed(b"final-0")
-        eq_(set(c.get_candidate_implicit_dependencies(b"partial")), set(range(5)))
+        eq_(versions(), set(range(5)))
 
         for i in range(5, 9):
             with make_files(2) as files:
                 c.put("final-{}".format(i).encode("ascii"),
                       b"partial",
                       files,
-                      i)
+                      [("file", i)])
+
+        eq_(versions(), {0, 8, 7, 6, 5})
+
+def shared_dependencies_test():
+    """ Equal dependency lists are stored once and released with their last item """
+    with cache_fixture() as c:
+        for i in range(4):
+            with make_files(2) as files:
+                c.put("final-{}".format(i).encode("ascii"),
+                      "partial-{}".format(i % 2).encode("ascii"),
+                      files,
+                      [("file1", b"version1"), ("file{}".format(2 + i % 2), b"version1")])
+
+        eq_(len(c._dependency_sets), 2)
+        deps = [c._dependency_sets[item.dependency_set][0] for item in c._data.values()]
+        assert deps[0] is deps[2]
+        assert deps[0][0] is deps[1][0] # Pairs are shared between different lists
+
+        with make_files(2) as files:
+            c.put(b"final-4", b"partial-0", files, []) # Discards final-0
+        eq_(len(c._dependency_sets), 3)
 
-        eq_(set(c.get_candidate_implicit_dependencies(b"partial")), {0, 8, 7, 6, 5})
+        with make_files(2) as files:
+            c.put(b"final-5", b"partial-0", files, []) # Discards final-1
+        eq_(len(c._dependency_sets), 3)
+        eq_(c.get_candidate_implicit_dependencies(b"partial-0"),
+            [[("file1", b"version1"), ("file2", b"version1")], [], []])
+
+        for i in range(4):
+            c._discard_one()
+        eq_(c._dependency_pairs, {}) # Pairs are released with their last list
+
+def background_deletion_test():
+    with cache_fixture() as c:
+        c.delete_rate = 2 # Bytes per second, slow enough to observe pending items
+        for i in range(6):
+            with make_files(2) as files:
+                c.put("final-{}".format(i).encode("ascii"), b"partial", files, [])
+
+        assert not c.get_directory(b"final-0").exists() # Removed from the cache immediately
+        assert c.verify_state()
+        assert c.pending_free > 0
+
+        c.delete_rate = None
+        c.wait_for_deletion()
+        eq_(c.pending_free, 0)
+        eq_(list((c.directory / c._trash_dirname).iterdir()), [])
+
+def failed_deletion_test():
+    with cache_fixture() as c:
+        original_delete = c._delete
+        failed = []
+        def delete(path, throttle):
+            if not failed:
+                failed.append(path)
+                raise OSError("Simulated failure")
+            original_delete(path, throttle)
+        c._delete = delete
+
+        for i in range(7):
+            with make_files(2) as files:
+                c.put("final-{}".format(i).encode("ascii"), b"partial", files, [])
+
+        waiting = threading.Thread(target=c.wait_for_deletion)
+        waiting.start()
+        waiting.join(5)
+        assert not waiting.is_alive()
+
+        eq_(c.pending_free, 0)
+        # Only the failed entry is left in the trash
+        eq_(list((c.directory / c._trash_dirname).iterdir()), failed)
+
+def deduplication_test():
+    with cache_fixture() as c:
+        with make_files(2, b"A") as files:
+            c.put(b"final-1", b"partial", files, [])
+        eq_(c.size_used, 1) # Both files have the same content
+        with make_files(1, b"A") as files:
+            c.put(b"final-2", b"partial", files, [])
+        with make_files(1, b"B") as files:
+            c.put(b"final-3", b"partial", files, [])
+        eq_(c.size_used, 2)
+
+        path = c.get_directory(b"final-2") / file_name(0)
+        eq_(path.stat().st_ino, (c.get_directory(b"final-1") / file_name(1)).stat().st_ino)
+
+        c._discard_one() # Blob A is still used by final-2
+        eq_(c.size_used, 2)
+        with path.open("rb") as fp:
+            eq_(fp.read(), b"A")
+
+        c._discard_one()
+        eq_(c.size_used, 1)
+        eq_(len(c._blobs), 1)
+
+def read_only_test():
+    """ Blobs shared by several items can't be modified through one of them """
+    with cache_fixture() as c:
+        with make_files(2) as files:
+            files[1].chmod(0o755)
+            c.put(b"final-1", b"partial", files, [])
+        with c.staging_directory() as staging:
+            (staging / "a").write_bytes(b"A")
+            c.put(b"final-2", b"partial", [staging / "a"], [])
+
+        modes = [stat.S_IMODE(path.stat().st_mode)
+                 for path in [c.get_directory(b"final-1") / file_name(0),
+                              c.get_directory(b"final-1") / file_name(1),
+                              c.get_directory(b"final-2") / "a"]]
+        eq_([mode & 0o222 for mode in modes], [0, 0, 0])
+        eq_(modes[1], 0o555) # Executables stay executable
+
+def staged_put_test():
+    with cache_fixture() as c:
+        with make_files(1, b"A") as files:
+            c.put(b"final-1", b"partial", files, [])
+
+        with c.staging_directory() as staging:
+            paths = [staging / "a", staging / "b"]
+            for path, content in zip(paths, [b"A", b"B"]):
+                with path.open("wb") as fp:
+                    fp.write(content)
+            inode = paths[1].stat().st_ino
+
+            c.put(b"final-2", b"partial", paths, [])
+            assert not staging.exists() # Moved as a whole
+
+        directory = c.get_directory(b"final-2")
+        eq_((directory / "b").stat().st_ino, inode)
+        eq_((directory / "a").stat().st_ino, (c.get_directory(b"final-1") / file_name(0)).stat().st_ino)
+        eq_(c.size_used, 2)
+
+        with c.staging_directory() as staging:
+            (staging / "unused").touch()
+        assert not staging.exists()
+
+def repeated_put_test():
+    """ Item built concurrently by two applications is only stored once """
+    with cache_fixture() as c:
+        with make_files(1, b"A") as files:
+            c.put(b"final-1", b"partial", files, [])
+        with make_files(1, b"A") as files:
+            c.put(b"final-1", b"partial", files, [])
+            assert not files[0].exists()
+        with c.staging_directory() as staging:
+            (staging / file_name(0)).write_bytes(b"A")
+            c.put(b"final-1", b"partial", [staging / file_name(0)], [])
+        eq_(c.size_used, 1)
+        eq_(c._partial_hashes[b"partial"], [b"final-1"])
+        check_files(c.get_directory(b"final-1"), 1)
 
 def too_large_test():
     """ Test cache item larger than cache itself. """
@@ -153,6 +348,39 @@ def save_load_test():
 
         # c will be implicitly saved, this will do nothing
 
+def disk_index_test():
+    def h(name):
+        return hashlib.sha1(name).digest() # The index needs hashes of the full size
+
+    with tempfile.TemporaryDirectory() as d:
+        directory = pathlib.Path(d) / "cache"
+        with cache.Cache(directory, size_limit=4, disk_index=True) as c:
+            with make_files(2) as files:
+                c.put(h(b"final-1"), h(b"partial"), files, [("file1", b"version1")])
+            with make_files(2, b"A") as files:
+                c.put(h(b"final-2"), h(b"partial"), files, [("file1", b"version2")])
+            eq_(c.size_used, 3)
+            eq_(c.find_implicit_dependencies(h(b"partial"), {"file1": b"version2"}.get),
+                [("file1", b"version2")])
+            check_files(c.get_directory(h(b"final-2")), 2)
+            assert c.verify_state()
+
+        # Items are loaded from the index, not from the pickled metadata
+        with cache.Cache(directory, size_limit=4, disk_index=True) as c:
+            assert h(b"final-1") in c
+            eq_(sorted(c.get_candidate_implicit_dependencies(h(b"partial"))),
+                [[("file1", b"version1")], [("file1", b"version2")]])
+            c.accessed(h(b"final-1"))
+            with make_files(2) as files:
+                c.put(h(b"final-3"), h(b"other"), files, [])
+            assert h(b"final-2") not in c # Least recently used
+            assert h(b"final-1") in c
+            eq_(c.size_used, 4)
+            assert c.verify_state()
+
+        with cache.Cache(directory) as c: # Can't use the index, starts empty
+            eq_(len(c._data), 0)
+
 def load_error_test():
     """ Test loading damaged save file. """
     with cache_fixture() as c:
@@ -197,7 +425,7 @@ def verify_state_test():
 
     with cache_fixture() as c:
         create_data(c)
-        c._data[b"x"] = cache._Item(0, b"y", [])
+        c._data[b"x"] = cache._Item(0, b"y", 0, ())
         assert not c.verify_state() # 5
         c.clear()
 
@@ -225,5 +453,36 @@ def verify_state_test():
         with (c.get_directory(b"final-1-a") / "extra-size").open("w") as fp:
             fp.write("abc")
         c.size_used += 3
+        c.size_limit = c.size_used - 1
         assert not c.verify_state() # 8
         c.clear()
+
+    with cache_fixture() as c:
+        create_data(c)
+        c._dependency_sets[0][1] += 1
+        assert not c.verify_state() # 9
+        c.clear()
+
+    with cache_fixture() as c:
+        create_data(c)
+        c._dependency_set_ids.clear()
+        assert not c.verify_state() # 10
+        c.clear()
+
+    with cache_fixture() as c:
+        create_data(c)
+        c._data[b"final-1-a"] = c._data[b"final-1-a"]._replace(dependency_set=100)
+        assert not c.verify_state() # 11
+        c.clear()
+
+    with cache_fixture() as c:
+        create_data(c)
+        c._blobs[c._data[b"final-1-a"].blobs[0]][1] += 1
+        assert not c.verify_state() # 12
+        c.clear()
+
+    with cache_fixture() as c:
+        create_data(c)
+        c.get_blob_path(c._data[b"final-1-a"].blobs[0]).unlink()
+        assert not c.verify_state() # 13
+        c.clear()
@@ -0,0 +1,69 @@
+from nose.tools import *
+import hashlib
+import pathlib
+import random
+import tempfile
+
+from bs import diskindex
+
+@nottest
+def h(*args):
+    return hashlib.sha1(repr(args).encode("ascii")).digest()
+
+def basic_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        with diskindex.DiskIndex(d, initial_capacity=4) as index:
+            for i in range(100): # Grows several times
+                index.put(h("final", i), h("partial", i % 3), i)
+
+            eq_(len(index), 100)
+            eq_(index.get(h("final", 5)).partial_hash, h("partial", 2))
+            eq_(index.get(h("final", 5)).size, 5)
+            eq_(index.get(h("unknown")), None)
+            eq_(set(index.final_hashes(h("partial", 1))), {h("final", i) for i in range(1, 100, 3)})
+
+            with assert_raises(KeyError):
+                index.put(h("final", 5), h("partial", 0), 0)
+
+            index.put(h("blobs"), h("partial", 0), 2, dependency_set=7,
+                      blobs=[h("content", 1), h("content", 0), h("content", 1)])
+            eq_(index.get(h("blobs")).dependency_set, 7)
+            eq_(index.blobs(h("blobs")), (h("content", 1), h("content", 0), h("content", 1)))
+            eq_(index.blobs(h("final", 5)), ())
+            index.remove(h("blobs"))
+            eq_(index.blobs(h("blobs")), ())
+
+            for i in range(0, 100, 2):
+                eq_(index.remove(h("final", i)).size, i)
+            assert h("final", 2) not in index
+            assert h("final", 3) in index
+            eq_(set(index.final_hashes(h("partial", 1))), {h("final", i) for i in range(1, 100, 6)})
+
+        with diskindex.DiskIndex(d) as index: # Reopen
+            eq_(len(index), 50)
+            eq_({record.size for record in index}, set(range(1, 100, 2)))
+            index.put(h("final", 2), h("partial", 2), 2)
+            eq_(index.get(h("final", 2)).size, 2)
+
+def eviction_candidate_test():
+    with tempfile.TemporaryDirectory() as d:
+        with diskindex.DiskIndex(pathlib.Path(d)) as index:
+            eq_(index.eviction_candidate(), None)
+            for i in range(10):
+                index.put(h("final", i), h("partial"), i)
+            for i in range(1, 10):
+                index.accessed(h("final", i))
+
+            # Sampling everything finds the exact LRU item
+            eq_(index.eviction_candidate(samples=10, rng=random.Random(0)).final_hash, h("final", 0))
+            index.accessed(h("final", 0))
+            eq_(index.eviction_candidate(samples=10, rng=random.Random(0)).final_hash, h("final", 1))
+
+def invalid_file_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        with (d / "final.index").open("wb") as fp:
+            fp.write(b"damaged!" * 100)
+        with assert_raises(ValueError):
+            diskindex.DiskIndex(d)
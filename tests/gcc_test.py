@@ -0,0 +1,278 @@
+from nose.tools import *
+import concurrent.futures
+import contextlib
+import os
+import pathlib
+import subprocess
+import tempfile
+
+from bs import gcc
+from bs import util
+
+from backend_test import LocalBackend
+
+def parse_depfile_simple_test():
+    eq_(gcc.parse_depfile("main.o: main.c /usr/include/stdio.h \\\n /usr/include/features.h\n"),
+        ["main.c", "/usr/include/stdio.h", "/usr/include/features.h"])
+
+def parse_depfile_empty_test():
+    eq_(gcc.parse_depfile(""), [])
+    eq_(gcc.parse_depfile("\n"), [])
+
+def parse_depfile_escapes_test():
+    eq_(gcc.parse_depfile("my\\ file.o: my\\ file.c dir\\ with\\ spaces/a.h \\\r\n b\\#c.h $$d.h\n"),
+        ["my file.c", "dir with spaces/a.h", "b#c.h", "$d.h"])
+
+def parse_depfile_phony_test():
+    """ Rules generated by -MP and duplicate prerequisites """
+    eq_(gcc.parse_depfile("a.o: a.c a.h b.h\na.h:\nb.h:\nc.o: c.c a.h\n"),
+        ["a.c", "a.h", "b.h", "c.c"])
+
+def parse_depfile_error_test():
+    with assert_raises(Exception):
+        gcc.parse_depfile("garbage garbage\n")
+
+def parse_dependencies_test():
+    deps = gcc.GccCompiler._parse_dependencies("a.o: /x/a.c /x/b.h /x/a.h \\\n /x/b.h\n")
+    eq_(deps, [pathlib.Path("/x/a.c"), pathlib.Path("/x/a.h"), pathlib.Path("/x/b.h")])
+
+def parse_linker_trace_test():
+    trace = "\n".join(["/usr/bin/ld: mode elf_x86_64",
+                       "/usr/lib/crt1.o",
+                       "main.o",
+                       "-lm (/usr/lib/libm.so)",
+                       "/usr/lib/libfoo.a(foo.o)",
+                       "/usr/lib/libfoo.a(bar.o)",
+                       "/lib/libc.so.6",
+                       "/usr/lib/crt1.o",
+                       ""])
+    eq_(gcc.parse_linker_trace(trace),
+        ["/usr/lib/crt1.o", "main.o", "/usr/lib/libm.so", "/usr/lib/libfoo.a", "/lib/libc.so.6"])
+
+@nottest
+class FakeLinkContext:
+    """ Runs the linker "remotely", returning the given trace """
+    remote = True
+
+    def __init__(self, directory, trace):
+        self.directory = directory
+        self.trace = trace
+        self.cwd = None
+
+    @contextlib.contextmanager
+    def tempfile(self, suffix):
+        yield self.directory / ("temp." + suffix)
+
+    def submit_action(self, command, input_paths, output_paths, timeout=600, cwd=None):
+        self.cwd = cwd
+        future = concurrent.futures.Future()
+        future.set_result(self.trace)
+        return future
+
+def linker_relative_paths_test():
+    d = pathlib.Path("/build/staging")
+    context = FakeLinkContext(d, "/usr/bin/ld: mode elf_x86_64\n/src/main.o\nlibfoo.a(foo.o)\n/lib/libc.so.6\n")
+    deps = gcc.GccLinker().build(context, [pathlib.Path("/src/main.o")], [d / "main"])
+    eq_(context.cwd, d)
+    eq_(deps, [pathlib.Path("/build/staging/libfoo.a"), pathlib.Path("/lib/libc.so.6")])
+
+def linker_library_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        (d / "a.c").write_text("int a(void) { return 0; }\n")
+        (d / "main.c").write_text("int a(void);\nint main(void) { return a(); }\n")
+
+        built = []
+        def configure(c):
+            objects = [c.apply(gcc.GccCompiler(), d / source, source + ".o")[0] for source in ["a.c", "main.c"]]
+            built.extend(c.apply(gcc.GccLinker(), objects, "main"))
+            c.add_target(built[0])
+
+        with LocalBackend(d) as b:
+            messages = b.build(configure)
+        eq_([message for message in messages if message.startswith("stderr")], [])
+        subprocess.check_call([str(d / "output" / "main")])
+        # The C library is linked implicitly
+        paths = [node.path for node in built[0].application.implicit_dependencies]
+        assert any(path.name.startswith("libc.") for path in paths), paths
+        assert all(path.is_absolute() and path.exists() for path in paths), paths
+
+@nottest
+class FakeUserContext:
+    """ Records applications created by unity_build """
+    def __init__(self, statistics, batches={}):
+        self.statistics = statistics
+        self.batches = batches
+        self.applications = []
+
+    def get_statistics(self, paths):
+        return {path: self.statistics[path] for path in paths if path in self.statistics}
+
+    def get_unity_batches(self, paths):
+        return {path: self.batches[path] for path in paths if path in self.batches}
+
+    def apply(self, builder, inputs, output_names=None):
+        inputs = list(util.maybe_iterable(inputs))
+        outputs = ["out{}".format(len(self.applications))]
+        self.applications.append((builder, inputs, output_names, outputs))
+        return outputs
+
+def unity_build_test():
+    statistics = {"/src/a.c": (2.0, 0.0),
+                  "/src/b.c": (2.0, 0.5),
+                  "/src/c.c": (7.0, 0.0),
+                  "/src/d.c": (1.0, 3.0), # Changes too often
+                  "/src/f.c": (9.5, 0.0)}
+    sources = ["/src/" + name for name in ["f.c", "e.c", "d.c", "c.c", "b.c", "a.c"]]
+
+    context = FakeUserContext(statistics)
+    compiler = gcc.GccCompiler()
+    objects = gcc.unity_build(context, compiler, sources, batch_time=10)
+
+    generated = {} # Output of unity generator -> its inputs
+    compiled = []
+    for builder, inputs, output_names, outputs in context.applications:
+        if builder is compiler:
+            eq_(len(inputs), 1)
+            compiled.append(generated.get(inputs[0], inputs[0]))
+        else:
+            assert isinstance(builder, gcc.UnityGenerator)
+            eq_(output_names[-2:], ".c")
+            generated[outputs[0]] = inputs
+
+    eq_(len(objects), 4)
+    eq_(compiled, ["/src/d.c", # Separately, before the batches
+                   ["/src/a.c", "/src/b.c"], # 2 + 2 + 7 would be over the limit
+                   ["/src/c.c", "/src/e.c"], # 7 + default 1
+                   "/src/f.c"]) # Alone, 9.5 + anything is too much
+
+@nottest
+def unity_batches(statistics, batches, sources, **kwargs):
+    """ Run unity_build, return list of (unity source name or None, inputs). """
+    context = FakeUserContext(statistics, batches)
+    compiler = gcc.GccCompiler()
+    gcc.unity_build(context, compiler, sources, **kwargs)
+    generated = {}
+    ret = []
+    for builder, inputs, output_names, outputs in context.applications:
+        if builder is compiler:
+            ret.append(generated.get(inputs[0], (None, inputs)))
+        else:
+            generated[outputs[0]] = (output_names, inputs)
+    return ret
+
+def unity_build_stable_test():
+    sources = ["/src/" + name for name in ["a.c", "b.c", "c.c", "d.c", "e.c"]]
+    statistics = {path: (4.0, 0.0) for path in sources}
+    first = unity_batches(statistics, {}, sources, batch_time=10)
+    eq_([inputs for name, inputs in first],
+        [["/src/a.c", "/src/b.c"], ["/src/c.c", "/src/d.c"], ["/src/e.c"]])
+    batches = {path: name for name, inputs in first if name is not None for path in inputs}
+
+    # Noise in the times doesn't move the sources or rename the batches
+    statistics["/src/a.c"] = (7.0, 0.0)
+    statistics["/src/e.c"] = (1.0, 0.0)
+    eq_(unity_batches(statistics, batches, sources, batch_time=10), first)
+
+    # A new source is packed with the sources outside of batches
+    second = unity_batches(statistics, batches, sources + ["/src/ab.c"], batch_time=10)
+    eq_([second[0], second[2]], first[:2])
+    eq_(second[1][1], ["/src/ab.c", "/src/e.c"])
+
+    # Batch far over the budget is packed again
+    statistics["/src/a.c"] = (20.0, 0.0)
+    eq_([inputs for name, inputs in unity_batches(statistics, batches, sources, batch_time=10)],
+        [["/src/a.c"], ["/src/b.c", "/src/e.c"], ["/src/c.c", "/src/d.c"]])
+
+    # Source that changes often leaves its batch, single remaining source is packed again
+    statistics["/src/a.c"] = (4.0, 0.0)
+    statistics["/src/c.c"] = (4.0, 2.0)
+    third = unity_batches(statistics, batches, sources, batch_time=10)
+    eq_(third[1], first[0])
+    eq_([inputs for name, inputs in third],
+        [["/src/c.c"], ["/src/a.c", "/src/b.c"], ["/src/d.c", "/src/e.c"]])
+
+def hash_preprocessed_test():
+    def h(text, **kwargs):
+        with tempfile.TemporaryDirectory() as d:
+            path = pathlib.Path(d) / "x.i"
+            with path.open("w") as fp:
+                fp.write(text)
+            return gcc.hash_preprocessed(path, **kwargs)
+
+    original = '# 1 "/checkout1/a.c"\n# 1 "/checkout1/a.h" 1\nint f(void);\n\n# 2 "/checkout1/a.c" 2\nint x = 1;\n'
+    moved = '# 1 "/checkout2/a.c"\n# 1 "/checkout2/a.h" 1\n\n\n  int f(void);  \n# 5 "/checkout2/a.c" 2\nint x = 1;\n'
+    changed = '# 1 "/checkout1/a.c"\n# 1 "/checkout1/a.h" 1\nint f(void);\n\n# 2 "/checkout1/a.c" 2\nint x = 2;\n'
+
+    eq_(h(original, strip=True), h(moved, strip=True))
+    assert h(original) != h(moved) # Whitespace inside lines is kept by default
+    assert h(original, strip=True) != h(changed, strip=True)
+    assert h(original, keep_lines=True) != h(moved, keep_lines=True)
+    eq_(h(original, keep_lines=True), h(original.replace("checkout1", "checkout2"), keep_lines=True))
+    assert (h(original, keep_lines=True, keep_names=True) !=
+            h(original.replace("checkout1", "checkout2"), keep_lines=True, keep_names=True))
+
+def precompiled_header_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        (d / "common.h").write_text("#ifndef COMMON_H\n#define COMMON_H\n"
+                                    "static inline int one(void) { return 1; }\n#endif\n")
+        (d / "a.c").write_text('#include "common.h"\nint a(void) { return one(); }\n')
+        (d / "b.cpp").write_text('#include "common.h"\nint b() { return one(); }\n')
+
+        def configure(c):
+            for executable, source in (("gcc", "a.c"), ("g++", "b.cpp")):
+                compiler = gcc.GccCompiler()
+                compiler.executable = executable
+                compiler.add_precompiled_header(c, d / "common.h")
+                c.add_target(c.apply(compiler, d / source, source + ".o"))
+
+            # C header precompiled by gcc is not used for C++ sources
+            mixed = gcc.GccCompiler()
+            mixed.add_precompiled_header(c, d / "common.h")
+            c.add_target(c.apply(mixed, d / "b.cpp", "mixed.o"))
+
+        with LocalBackend(d) as b:
+            messages = b.build(configure)
+            # Files in the cache are not tracked as sources
+            cache_directory = b.backend.cache.directory
+            eq_([path for path in b.backend.files.keys() if cache_directory in path.parents], [])
+        eq_([message for message in messages if "stderr" in message], [])
+        for name in ["a.c.o", "b.cpp.o", "mixed.o"]:
+            assert (d / "output" / name).exists()
+
+def preprocessor_mode_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        for name in ["a.c", "b.c"]:
+            (d / name).write_text("int f(void) { return 1; }\n")
+        (d / "c.i").write_text("int g(void) { return 2; }\n")
+
+        objects = {}
+        def configure(c):
+            preprocessing = gcc.GccCompiler()
+            preprocessing.preprocessor_mode = True
+            debug = gcc.GccCompiler()
+            debug.preprocessor_mode = True
+            debug.cflags = ["-g"]
+            for source in ["a.c", "b.c"]:
+                for compiler, name in ((preprocessing, source + ".o"), (debug, source + ".g.o")):
+                    objects[name] = c.apply(compiler, d / source, name)[0]
+                    c.add_target(objects[name])
+            # Preprocessed source given by the user, compiled normally
+            c.add_target(c.apply(gcc.GccCompiler(), d / "c.i", "c.i.o"))
+
+        with LocalBackend(d) as b:
+            messages = b.build(configure)
+        eq_([message for message in messages if "stderr" in message], [])
+        for name in ["a.c.o", "b.c.o", "a.c.g.o", "b.c.g.o", "c.i.o"]:
+            assert (d / "output" / name).exists()
+
+        def content_hash(name):
+            return objects[name].application.content_hash
+        eq_(content_hash("a.c.o"), content_hash("b.c.o"))
+        assert content_hash("a.c.g.o") != content_hash("b.c.g.o") # Debug info has the file names
+        # Compiled in the source directory, not in the directory of the backend
+        debug_object = (d / "output" / "a.c.g.o").read_bytes()
+        assert b"\0" + str(d).encode() + b"\0" in debug_object
+        assert b"\0" + os.getcwd().encode() + b"\0" not in debug_object
@@ -0,0 +1,40 @@
+from nose.tools import *
+import pathlib
+
+from bs import impact
+from bs import nodes
+
+@nottest
+class FakeBuilder(nodes.Builder):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+@nottest
+class FakeTarget:
+    def __init__(self, name, node):
+        self.name = name
+        self.node = node
+
+def query_test():
+    a, b, c = (nodes.SourceFile(pathlib.Path("/src") / name) for name in ["a.c", "b.c", "c.h"])
+    compile_a = nodes.Application(FakeBuilder("compile_a"), [a, c], [None])
+    compile_b = nodes.Application(FakeBuilder("compile_b"), [b], [None])
+    link = nodes.Application(FakeBuilder("link"), compile_a.outputs + compile_b.outputs, [None])
+    test = nodes.Application(FakeBuilder("test"), compile_b.outputs, [None])
+
+    index = impact.ImpactIndex([FakeTarget("program", link.outputs[0]),
+                                FakeTarget("test", test.outputs[0]),
+                                FakeTarget("object", compile_b.outputs[0])])
+
+    def query(*names):
+        targets, applications = index.query(pathlib.Path("/src") / name for name in names)
+        return sorted(targets), sorted(str(application.builder) for application in applications)
+
+    eq_(query("a.c"), (["program"], ["compile_a", "link"]))
+    eq_(query("b.c"), (["object", "program", "test"], ["compile_b", "link", "test"]))
+    eq_(query("c.h", "unknown.c"), (["program"], ["compile_a", "link"]))
+    eq_(query(), ([], []))
@@ -0,0 +1,69 @@
+from nose.tools import *
+import sys
+import tempfile
+
+from bs import jobserver
+from bs import runner
+
+def tokens_test():
+    with jobserver.Server(2) as server:
+        assert server.acquire(blocking=False) # The implicit token
+        assert server.acquire(blocking=False)
+        assert not server.acquire(blocking=False)
+        server.release()
+        assert server.acquire(blocking=False)
+
+def from_makeflags_test():
+    eq_(jobserver.from_makeflags(None), None)
+    eq_(jobserver.from_makeflags("k -j"), None)
+    eq_(jobserver.from_makeflags("-j --jobserver-auth=-2,-2"), None)
+
+    with jobserver.Server(3) as outer:
+        env, fds = outer.share_with_child({"MAKEFLAGS": "k -j4"})
+        assert env["MAKEFLAGS"].startswith("k -j --jobserver-fds=")
+
+        # The file descriptors are valid in this process
+        with jobserver.from_makeflags(env["MAKEFLAGS"]) as client:
+            for i in range(3):
+                assert client.acquire(blocking=False)
+            assert not client.acquire(blocking=False)
+            assert outer.acquire(blocking=False) # Implicit token of the outer process
+            assert not outer.acquire(blocking=False)
+            client.release()
+            assert outer.acquire(blocking=False)
+        # Jobs of the closed client still hold their tokens until they finish
+        assert not outer.acquire(blocking=False)
+        assert client.acquire(blocking=False) # Not counted anymore
+        client.release()
+        assert not outer.acquire(blocking=False)
+        client.release()
+        assert outer.acquire(blocking=False)
+
+def from_makeflags_not_fifo_test():
+    with tempfile.TemporaryFile() as fp:
+        fd = fp.fileno()
+        eq_(jobserver.from_makeflags("-j --jobserver-auth={},{}".format(fd, fd)), None)
+        eq_(jobserver.from_makeflags("-j --jobserver-auth=fifo:/proc/self/fd/{}".format(fd)), None)
+
+# Takes a token from the jobserver in MAKEFLAGS like make would and prints how many it got
+child_command = [sys.executable, "-c", """
+import os, sys
+auth = [flag for flag in os.environ["MAKEFLAGS"].split() if flag.startswith("--jobserver-auth=")]
+read_fd, write_fd = [int(fd) for fd in auth[0].split("=")[1].split(",")]
+os.set_blocking(read_fd, False)
+tokens = b""
+try:
+    tokens += os.read(read_fd, 10)
+except BlockingIOError:
+    pass
+os.write(write_fd, tokens)
+print(len(tokens))
+"""]
+
+def child_test():
+    with jobserver.Server(3) as server, runner.ProcessRunner(server) as r:
+        # The child runs with our implicit token and can take the other two
+        eq_(r.run(child_command), "2\n")
+
+        assert server.acquire(blocking=False)
+        eq_(r.run(child_command), "1\n")
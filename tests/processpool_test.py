@@ -0,0 +1,154 @@
+from nose.tools import *
+import contextlib
+import os
+import pathlib
+import resource
+import sys
+import tempfile
+import threading
+import weakref
+
+from bs import backend
+from bs import nodes
+from bs import processpool
+
+from backend_test import LocalBackend
+
+@nottest
+class UpperBuilder(nodes.Builder):
+    use_process_pool = True
+
+    def build(self, context, input_paths, output_paths):
+        with input_paths[0].open("r") as fp:
+            text = fp.read()
+        with output_paths[0].open("w") as fp:
+            fp.write(text.upper())
+        context.log("pid {}", os.getpid())
+        return [input_paths[0].parent / "implicit"]
+
+    def get_hash(self):
+        return self.hash_helper([])
+
+def build_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        with (d / "input").open("w") as fp:
+            fp.write("abc")
+
+        builder = UpperBuilder()
+        # Simulate state of a node in backend, this must not get pickled
+        builder.targets = weakref.WeakSet()
+        builder.reverse_dependencies = weakref.WeakSet()
+
+        with processpool.create_pool({1: builder}, 1) as pool:
+            future = pool.submit(processpool.build, 1, d / "cache", d / "tmp",
+                                 [d / "input"], [d / "output"])
+            dependencies, messages = future.result()
+
+        eq_(dependencies, [str(d / "implicit")])
+        eq_(len(messages), 1)
+        assert messages[0] != "pid {}".format(os.getpid())
+        with (d / "output").open("r") as fp:
+            eq_(fp.read(), "ABC")
+
+@nottest
+class MainBuilder(UpperBuilder):
+    """ Pretends to come from the build script """
+    def get_output_count(self, input_count):
+        return 1
+MainBuilder.__module__ = "__main__"
+
+def main_module_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        with (d / "input").open("w") as fp:
+            fp.write("abc")
+        (d / "implicit").touch()
+
+        def configure(c):
+            c.add_target(c.apply(MainBuilder(), d / "input", "output"))
+
+        with LocalBackend(d) as b:
+            messages = b.build(configure)
+            assert not b.backend.process_pool.running
+        assert any("defined in __main__" in message for message in messages), messages
+        assert "pid {}".format(os.getpid()) in messages # Built in the backend
+        with (d / "output" / "output").open("r") as fp:
+            eq_(fp.read(), "ABC")
+
+def run_command_limits_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        c = processpool.ProcessContext(d / "cache", d / "tmp")
+        command = [sys.executable, "-c",
+                   "import resource; print(resource.getrlimit(resource.RLIMIT_NOFILE)[0])"]
+        eq_(c.run_command(command, limits={resource.RLIMIT_NOFILE: 64}), "64\n")
+
+@nottest
+class LowerBuilder(UpperBuilder):
+    pass
+
+def pool_reuse_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        with (d / "input").open("w") as fp:
+            fp.write("abc")
+
+        with processpool.ProcessPool(1) as pool:
+            assert not pool.running
+            builder = UpperBuilder()
+            pool.set_builders("a", [builder])
+            executor = pool._executor
+            dependencies, messages = pool.submit(builder, d / "cache", d / "tmp",
+                                                 [d / "input"], [d / "output"]).result()
+
+            # Equal builder of a new configuration
+            builder = UpperBuilder()
+            pool.set_builders("a", [builder])
+            assert pool._executor is executor
+            eq_(pool.submit(builder, d / "cache", d / "tmp",
+                            [d / "input"], [d / "output"]).result()[1], messages)
+
+            # Builders of another owner (backend) share the pool
+            pool.set_builders("b", [UpperBuilder()])
+            assert pool._executor is executor
+            pool.set_builders("b", [LowerBuilder()])
+            assert pool._executor is not executor
+            with assert_raises(RuntimeError):
+                pool.submit(UpperBuilder(), d / "cache", d / "tmp", [d / "input"], [d / "output"])
+
+            pool.set_builders("a", [])
+            assert pool.running
+            pool.set_builders("b", [])
+            assert not pool.running
+
+def shared_pool_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        with (d / "input").open("w") as fp:
+            fp.write("abc")
+        (d / "implicit").touch()
+
+        with backend.BackendResources(jobs=2) as resources:
+            backends = []
+            with contextlib.ExitStack() as stack:
+                for name in ["a", "b"]:
+                    (d / name).mkdir()
+                    b = backend.Backend(d / name / "control", resources)
+                    b._lock = threading.Lock()
+                    b._server = None
+                    stack.enter_context(b)
+                    backends.append(b)
+                pids = set()
+                for b in backends:
+                    application = nodes.Application(UpperBuilder(), [nodes.SourceFile(d / "input")], ["out"])
+                    b.set_targets("script", [("out", application.outputs[0])])
+                    output_directory = d / b.build_directory.name / "output"
+                    for batch in b.update("script", None, output_directory).it:
+                        pids.update(event.message for event in batch if "pid" in getattr(event, "message", ""))
+                    eq_((output_directory / "out").read_text(), "ABC")
+                # Both backends use the same processes, sized by the jobs
+                assert backends[0].process_pool is backends[1].process_pool
+                eq_(resources.process_pool.max_workers, 2)
+                assert pids and "pid {}".format(os.getpid()) not in pids
+            assert not resources.process_pool.running
@@ -0,0 +1,45 @@
+from nose.tools import *
+import threading
+
+from bs import progress
+
+def coalesce_test():
+    channel = progress.Channel()
+    channel.put(progress.Log("a"))
+    for i in range(10):
+        channel.set_status(progress.Status(1, i, 10 - i))
+    channel.put(progress.Log("b"))
+    eq_(channel.get_batch(), [progress.Log("a"), progress.Log("b"), progress.Status(1, 9, 1)])
+
+    channel.close()
+    channel.put(progress.Log("c")) # Ignored
+    eq_(channel.get_batch(), [])
+
+def drop_test():
+    channel = progress.Channel(max_events=3)
+    for i in range(5):
+        channel.put(progress.Log(i))
+    eq_(channel.get_batch(2), [progress.Dropped(2), progress.Log(0), progress.Log(1)])
+    eq_(channel.get_batch(), [progress.Log(2)])
+
+def backpressure_test():
+    channel = progress.Channel(max_events=2)
+
+    def writer():
+        for i in range(10):
+            channel.put(progress.Log(i), important=True)
+        channel.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+
+    received = []
+    while True:
+        batch = channel.get_batch()
+        if not batch:
+            break
+        assert_less_equal(len(batch), 2)
+        received.extend(batch)
+    thread.join()
+
+    eq_(received, [progress.Log(i) for i in range(10)])
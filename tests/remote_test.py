@@ -0,0 +1,120 @@
+from nose.tools import *
+import contextlib
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+from bs import gcc
+from bs import remote
+from bs import service
+from bs import util
+
+from backend_test import LocalBackend
+
+concatenate = [sys.executable, "-c", """
+import sys
+with open(sys.argv[1], "w") as fp:
+    for path in sys.argv[2:]:
+        fp.write(open(path).read())
+print("done")
+"""]
+
+@nottest
+@contextlib.contextmanager
+def local_workers(directory, count):
+    """ Start workers in subdirectories of the directory, yield their control files. """
+    proxies = []
+    try:
+        for i in range(count):
+            worker_directory = directory / "worker{}".format(i)
+            worker_directory.mkdir()
+            proxy = service.ServiceProxy(remote.RemoteWorker, worker_directory / "worker.json")
+            proxies.append(proxy.__enter__())
+        yield [proxy._control_file for proxy in proxies]
+    finally:
+        for proxy in proxies:
+            proxy._call("_stop")
+            proxy.__exit__(None, None, None)
+
+def execute_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        a = d / "a"
+        b = d / "b"
+        a.write_text("abc")
+        b.write_text("def")
+
+        with local_workers(d, 2) as control_files, \
+             remote.RemoteExecutor(control_files) as executor:
+            executor._chunk_size = 2 # Files are transferred in several messages
+            for i in range(2):
+                output = d / "output{}".format(i)
+                stdout, stderr = executor.execute(concatenate + ["out/x", "in/a", "in/b", "in/a"],
+                                                  {"in/a": a, "in/b": b},
+                                                  {"out/x": output})
+                eq_(stdout, "done\n")
+                eq_(output.read_text(), "abcdefabc")
+
+            # Both workers were used and have the inputs now
+            for control_file in control_files:
+                with service.ServiceProxy(remote.RemoteWorker, control_file, start=False) as worker:
+                    eq_(worker.missing_blobs([util.sha1_file(a), util.sha1_file(b)]), [])
+
+            with assert_raises(Exception) as cm:
+                executor.execute(concatenate + ["out/x", "in/missing"], {}, {"out/x": d / "c"})
+            eq_(cm.exception.args[0], "Command failed")
+
+            with assert_raises(ValueError):
+                executor.execute(concatenate + ["x", "../a"], {"../a": a}, {})
+
+            # Connections returned after close are closed too
+            executor.close()
+            executor.execute(concatenate + ["out/x", "in/a"], {"in/a": a}, {"out/x": d / "c"})
+            eq_([worker.idle for worker in executor._workers], [[], []])
+
+def remote_build_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        (d / "a.c").write_text("int a(void) { return 1; }\n")
+        (d / "main.c").write_text("int a(void);\nint main(void) { return a() - 1; }\n")
+
+        built = []
+        def configure(c):
+            compiler = gcc.GccCompiler()
+            compiler.preprocessor_mode = True
+            objects = [c.apply(compiler, d / source, source + ".o")[0] for source in ["a.c", "main.c"]]
+            built.extend(objects)
+            built.extend(c.apply(gcc.GccLinker(), objects, "main"))
+            c.add_target(built[-1])
+
+        with local_workers(d, 1) as control_files, LocalBackend(d) as b:
+            messages = b.build(configure, remote_workers=control_files)
+            eq_([message for message in messages if "stderr" in message], [])
+            subprocess.check_call([str(d / "output" / "main")])
+
+            # The objects and the program were built on the worker
+            with service.ServiceProxy(remote.RemoteWorker, control_files[0], start=False) as worker:
+                hashes = [util.sha1_file(node.get_path(b.backend)) for node in built]
+                eq_(worker.missing_blobs(hashes), [])
+
+            # Libraries found in the remote linker's trace are implicit dependencies
+            assert any(node.path.name.startswith("libc.")
+                       for node in built[-1].application.implicit_dependencies)
+
+def blob_store_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        store = remote.BlobStore(d / "blobs")
+        content_hash = util.sha1_iterable([]) # Anything that is not the hash of the data
+        upload = store.new_upload()
+        upload.write_bytes(b"x")
+        with assert_raises(Exception):
+            store.add_upload(upload, content_hash)
+        assert content_hash not in store
+        assert not upload.exists()
+
+        (d / "f").write_bytes(b"x")
+        content_hash = store.add_file(d / "f")
+        assert content_hash in store
+        eq_(store.get_path(content_hash).read_bytes(), b"x")
@@ -0,0 +1,57 @@
+from nose.tools import *
+import contextlib
+import io
+import pathlib
+import tempfile
+import time
+
+from bs import backend
+from bs import gcc
+from bs import service
+from bs.run import run, UserContext
+
+from backend_test import Concatenate, Include
+
+def affected_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        source = d / "source"
+        source.write_text("include {}\n".format(d / "a.h"))
+        (d / "a.h").write_text("")
+        control_file = d / "build" / "backend_handle.json"
+
+        def configure(c):
+            c.add_target(c.apply(Include(), source, "out"))
+            c.add_target(c.apply(Concatenate(), source, "watch")) # Not mistaken for --watch
+
+        def run_output(*argv):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                run(configure, root_directory=d, argv=list(argv))
+            return output.getvalue().splitlines()
+
+        try:
+            run_output("watch")
+            assert (d / "build" / "output" / "watch").exists()
+            assert not (d / "build" / "output" / "out").exists()
+            handle = control_file.read_text()
+            run_output()
+            eq_(control_file.read_text(), handle) # The running backend is reused
+            # Implicit dependencies found by the build are kept
+            eq_(run_output("--affected", str(d / "a.h")), ["out"])
+            run_output("--restart-backend")
+            assert control_file.read_text() != handle
+        finally:
+            with service.ServiceProxy(backend.Backend, control_file, start=False) as proxy:
+                proxy._call("_stop")
+            for i in range(50):
+                if not control_file.exists():
+                    break
+                time.sleep(0.1)
+
+def default_output_names_test():
+    c = UserContext(pathlib.Path("/src"))
+    names = [node.name for node in c.apply(Concatenate(), "a") + c.apply(Concatenate(), "b")]
+    eq_(names, ["out", "out-2"])
+    names = [node.name for node in c.apply(gcc.GccCompiler(), "a.c") + c.apply(gcc.GccCompiler(), "b.c")]
+    eq_(names, ["output00", "output00-2"])
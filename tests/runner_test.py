@@ -0,0 +1,91 @@
+from nose.tools import *
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+
+from bs import runner
+
+def simple_test():
+    with runner.ProcessRunner(2) as r:
+        eq_(r.run(["echo", "hello", 1]), "hello 1\n")
+
+def log_test():
+    lines = []
+    with runner.ProcessRunner(2) as r:
+        r.run(["sh", "-c", "echo a; echo b >&2; printf c"],
+              log=lambda stream, line: lines.append((stream, line)))
+
+    eq_(sorted(lines), [("stderr", "b"), ("stdout", "a"), ("stdout", "c")])
+
+def failure_test():
+    with runner.ProcessRunner(2) as r:
+        with assert_raises(Exception) as cm:
+            r.run(["sh", "-c", "echo out; echo err >&2; exit 3"])
+
+    eq_(cm.exception.args[1:], (["sh", "-c", "echo out; echo err >&2; exit 3"],
+                                "out\n", "err\n", 3))
+
+def missing_executable_test():
+    with runner.ProcessRunner(2) as r:
+        with assert_raises(FileNotFoundError):
+            r.run(["/nonexistent/executable"])
+        eq_(r.run(["echo", "still working"]), "still working\n")
+
+def timeout_test():
+    with runner.ProcessRunner(2) as r:
+        start = time.monotonic()
+        with assert_raises(subprocess.TimeoutExpired):
+            r.run(["sleep", "10"], timeout=0.2)
+        assert time.monotonic() - start < 5
+
+def limits_test():
+    with runner.ProcessRunner(2) as r, \
+         tempfile.TemporaryDirectory() as d:
+        command = ["sh", "-c", "head -c 1000 /dev/zero > " + d + "/x"]
+        r.run(command)
+        with assert_raises(Exception):
+            r.run(command, limits={resource.RLIMIT_FSIZE: 100})
+
+def niceness_test():
+    with runner.ProcessRunner(2) as r:
+        base = int(r.run(["nice"]))
+        eq_(int(r.run(["nice"], niceness=5)), min(base + 5, 19))
+
+def tokens_test():
+    """ Check that no more processes than tokens are running at the same time. """
+    class CountingTokens:
+        def __init__(self, count):
+            self.semaphore = threading.BoundedSemaphore(count)
+            self.used = 0
+            self.max_used = 0
+
+        def acquire(self, blocking=True):
+            ret = self.semaphore.acquire(blocking)
+            if ret:
+                self.used += 1
+                self.max_used = max(self.max_used, self.used)
+            return ret
+
+        def release(self):
+            self.used -= 1
+            self.semaphore.release()
+
+    tokens = CountingTokens(3)
+    with runner.ProcessRunner(tokens) as r:
+        futures = [r.submit(["sh", "-c", "sleep 0.05; echo {}".format(i)]) for i in range(20)]
+        eq_([f.result() for f in futures], ["{}\n".format(i) for i in range(20)])
+
+    eq_(tokens.max_used, 3)
+    eq_(tokens.used, 0)
+
+def background_test():
+    """ Waiting processes get the token before background ones. """
+    with runner.ProcessRunner(1) as r:
+        with r.token():
+            background = r.submit(["sh", "-c", "sleep 0.5"], background=True)
+            foreground = r.submit(["true"])
+        foreground.result()
+        assert not background.done()
+        background.result()
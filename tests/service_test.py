@@ -8,6 +8,7 @@ import signal
 import time
 import multiprocessing
 import pickle
+import threading
 
 @nottest
 class FunkyException(Exception):
@@ -61,6 +62,16 @@ class S(service.Service):
                 self._value += 1
         return service.IteratorWrapper(x())
 
+    def blocking_iterate(self):
+        """ Iterator that waits until unblock() is called, like progress of an update. """
+        self._unblocked = threading.Event()
+        def x():
+            yield self._unblocked.wait(5)
+        return service.IteratorWrapper(x())
+
+    def unblock(self):
+        self._unblocked.set()
+
 @nottest
 class T(S):
     _timeout = 1.5
@@ -75,6 +86,10 @@ class T(S):
             return True # Supress exception
 
 
+@nottest
+class W(S):
+    _max_calls = 1
+
 @nottest
 class U(S):
     @staticmethod
@@ -309,3 +324,67 @@ def exception_in_exception_test():
         with service.ServiceProxy(V, control_file) as s:
             with assert_raises(FunkyException):
                 s.get_pid()
+
+def many_clients_test():
+    with contextlib.ExitStack() as stack:
+        tmp = pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        control_file = tmp / "ctrl"
+
+        s = stack.enter_context(service.ServiceProxy(S, control_file))
+        stack.enter_context(connection_helper(s))
+        s.set_value(7)
+
+        # Idle clients don't use up threads of the service
+        clients = [stack.enter_context(service.ServiceProxy(S, control_file, start=False))
+                   for i in range(2 * S._max_calls)]
+        for client in clients:
+            eq_(client.get_value(), 7)
+        eq_(len(s.get_connections()), len(clients) + 1)
+
+def blocking_iterator_test():
+    with contextlib.ExitStack() as stack:
+        tmp = pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        control_file = tmp / "ctrl"
+
+        s1 = stack.enter_context(service.ServiceProxy(S, control_file))
+        stack.enter_context(connection_helper(s1))
+        s2 = stack.enter_context(service.ServiceProxy(S, control_file))
+
+        iterator = s1.blocking_iterate()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(next(iterator)))
+        thread.start()
+        time.sleep(0.2) # Let the iterator block in the service
+
+        # Calls of other clients are not stuck behind the waiting iterator
+        s2.set_value(3)
+        eq_(s2.get_value(), 3)
+        s2.unblock()
+
+        thread.join()
+        eq_(results, [True])
+
+def blocking_iterator_call_limit_test():
+    with contextlib.ExitStack() as stack:
+        tmp = pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        control_file = tmp / "ctrl"
+
+        s1 = stack.enter_context(service.ServiceProxy(W, control_file))
+        stack.enter_context(connection_helper(s1))
+        s2 = stack.enter_context(service.ServiceProxy(W, control_file))
+
+        iterator = s1.blocking_iterate()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(next(iterator)))
+        thread.start()
+        time.sleep(0.2) # Let the iterator block in the service
+
+        # The waiting iterator doesn't take the only call thread
+        start_time = time.time()
+        s2.unblock()
+        thread.join()
+        eq_(results, [True])
+        assert time.time() - start_time < 2
@@ -0,0 +1,56 @@
+from nose.tools import *
+import pathlib
+import stat
+import tempfile
+
+from bs import staging
+
+def recycle_test():
+    with tempfile.TemporaryDirectory() as d:
+        root = pathlib.Path(d) / "staging"
+        with staging.StagingArea(root, max_idle=1) as area:
+            with area.tempdir() as path1:
+                (path1 / "file").touch()
+                (path1 / "subdir").mkdir()
+                (path1 / "subdir" / "file").touch()
+
+            with area.tempdir() as path2:
+                eq_(path2, path1) # Reused
+                eq_(list(path2.iterdir()), []) # and empty
+                with area.tempdir() as path3:
+                    assert path3 != path2
+
+            eq_(len(list(root.iterdir())), 1) # Only one is kept idle
+
+        assert not root.exists()
+
+def scratch_directory_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        build_directory = d / "build"
+        original_root = staging._tmpfs_root
+        staging._tmpfs_root = d / "shm"
+        staging._tmpfs_root.mkdir()
+        try:
+            path = staging.scratch_directory(build_directory)
+            eq_(path.parent, d / "shm")
+            eq_(stat.S_IMODE(path.stat().st_mode), 0o700)
+            eq_(staging.scratch_directory(build_directory), path)
+
+            # Directory prepared by someone else is not used
+            path.chmod(0o755)
+            eq_(staging.scratch_directory(build_directory), build_directory / "tmp")
+            path.rmdir()
+            path.symlink_to(d)
+            eq_(staging.scratch_directory(build_directory), build_directory / "tmp")
+        finally:
+            staging._tmpfs_root = original_root
+
+def leftovers_test():
+    with tempfile.TemporaryDirectory() as d:
+        root = pathlib.Path(d) / "staging"
+        (root / "crashed").mkdir(parents=True)
+        (root / "crashed" / "file").touch()
+        (root / "tempfile").touch()
+        with staging.StagingArea(root):
+            eq_(list(root.iterdir()), [])
@@ -0,0 +1,20 @@
+from nose.tools import *
+import pathlib
+import tempfile
+
+from bs import statistics
+
+def change_decay_test():
+    with tempfile.TemporaryDirectory() as d:
+        with statistics.Statistics(pathlib.Path(d) / "statistics.pickle") as s:
+            s.record("/src/a.c", 1.0, hash=b"1")
+            s.record("/src/a.c", 1.0, hash=b"2", batch="unity-x.c")
+            eq_(s.get(["/src/a.c"]), {"/src/a.c": (1.0, 1)})
+
+            # Changes decay with configurations, not only when the file is built
+            s.decay_changes()
+            s.decay_changes()
+            eq_(s.get(["/src/a.c"])["/src/a.c"][1], s._change_decay ** 2)
+
+        with statistics.Statistics(pathlib.Path(d) / "statistics.pickle") as s:
+            eq_(s.get_batches(["/src/a.c", "/src/b.c"]), {"/src/a.c": "unity-x.c"})
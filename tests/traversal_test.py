@@ -0,0 +1,181 @@
+from nose.tools import *
+import concurrent.futures
+import threading
+
+from bs import nodes
+from bs import traversal
+
+@nottest
+class FakeContext:
+    def __init__(self, background=False):
+        self.background = background
+        self.stop_flag = False
+        self.done = threading.Event()
+        self.error = None
+        self.published = []
+
+    def log(self, fmt, *args, **kwargs):
+        fmt.format(*args, **kwargs) # Formatting nodes raises an exception
+
+    def status(self, running, done, remaining):
+        self.last_status = (running, done, remaining)
+
+    def finish(self):
+        self.done.set()
+
+    def exception(self, e):
+        self.stop_flag = True
+        self.error = e
+        self.done.set()
+
+@nottest
+class CountingNode(nodes.Node):
+    def __init__(self, name, *dependencies, fail=False):
+        super().__init__()
+        self.name = name
+        self.updates = 0
+        self.fail = fail
+        self.dirty = True
+        self.reverse_dependencies = set()
+        for dep in dependencies:
+            self.add_dependency(dep)
+            dep.reverse_dependencies.add(self)
+
+    def update(self, context):
+        for dep in self.dependencies:
+            assert not dep.dirty
+        self.updates += 1
+        if self.fail:
+            raise Exception("Failed")
+
+    def __repr__(self):
+        return self.name
+
+@nottest
+def build(scheduler, targets):
+    context = FakeContext()
+    scheduler.build(context, targets, context.published.append)
+    assert context.done.wait(10)
+    return context
+
+def diamond_test():
+    a = CountingNode("a")
+    b = CountingNode("b", a)
+    c = CountingNode("c", a)
+    d = CountingNode("d", b, c)
+    e = CountingNode("e", c)
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        scheduler = traversal.Scheduler(executor)
+        context = build(scheduler, [d, e])
+        eq_(context.error, None)
+        eq_(set(context.published), {d, e})
+        eq_([n.updates for n in [a, b, c, d, e]], [1, 1, 1, 1, 1])
+        eq_(context.last_status, (0, 5, 0))
+
+        context = build(scheduler, [d]) # Everything is clean
+        eq_(context.published, [d])
+        eq_(d.updates, 1)
+
+        scheduler.invalidate([b])
+        assert b.dirty and d.dirty and not c.dirty and not e.dirty
+        build(scheduler, [d, e])
+        eq_([n.updates for n in [a, b, c, d, e]], [1, 2, 1, 2, 1])
+
+def failure_test():
+    a = CountingNode("a", fail=True)
+    b = CountingNode("b", a)
+    c = CountingNode("c")
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        scheduler = traversal.Scheduler(executor)
+        context = build(scheduler, [b, c])
+        eq_(context.error.args, ("Failed",))
+        eq_(b.updates, 0)
+        assert a.dirty and b.dirty
+
+        a.fail = False
+        context = build(scheduler, [b])
+        eq_(context.error, None)
+        eq_((a.updates, b.updates), (2, 1))
+
+@nottest
+class QueueingExecutor:
+    """ Executor that only collects the submitted jobs. """
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+def background_test():
+    a = CountingNode("a")
+    b = CountingNode("b", a)
+    background_executor = QueueingExecutor()
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        scheduler = traversal.Scheduler(executor, background_executor)
+        background = FakeContext(background=True)
+        scheduler.build(background, [b])
+        eq_(len(background_executor.jobs), 1)
+        eq_(a.updates, 0)
+
+        # Waiting node is taken over by a normal request, b follows in the normal lane
+        context = build(scheduler, [b])
+        eq_(context.error, None)
+        assert background.done.is_set()
+        eq_((a.updates, b.updates), (1, 1))
+
+        fn, args = background_executor.jobs.pop()
+        fn(*args) # Already updated, does nothing
+        eq_((a.updates, b.updates), (1, 1))
+        eq_(background_executor.jobs, [])
+
+@nottest
+class PendingNode(CountingNode):
+    """ Node whose update returns a future that the test completes. """
+    def __init__(self, name, *dependencies, fail=False):
+        super().__init__(name, *dependencies, fail=fail)
+        self.pending = concurrent.futures.Future()
+        self.finished = False
+
+    def update(self, context):
+        self.updates += 1
+        return self.pending
+
+    def finish(self):
+        if self.fail:
+            raise Exception("Failed")
+        self.finished = True
+
+def pending_update_test():
+    a, b, c = (PendingNode(name) for name in "abc")
+    d = CountingNode("d", a, b, c)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        scheduler = traversal.Scheduler(executor)
+        context = FakeContext()
+        scheduler.build(context, [d], context.published.append)
+        for i in range(100):
+            if all(node.updates for node in (a, b, c)):
+                break
+            threading.Event().wait(0.01)
+        # Pending updates don't hold the only thread
+        eq_([node.updates for node in (a, b, c)], [1, 1, 1])
+        eq_(d.updates, 0)
+
+        for node in (a, b, c):
+            node.pending.set_result(node.finish)
+        assert context.done.wait(10)
+        eq_(context.error, None)
+        assert all(node.finished for node in (a, b, c))
+        eq_(d.updates, 1)
+
+        # Failure of the function finishing the update fails the build
+        a.fail = True
+        a.pending = concurrent.futures.Future()
+        a.pending.set_result(a.finish)
+        scheduler.invalidate([a])
+        context = build(scheduler, [d])
+        eq_(context.error.args, ("Failed",))
+        assert a.dirty and d.dirty
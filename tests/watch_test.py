@@ -0,0 +1,32 @@
+from nose.tools import *
+import pathlib
+import tempfile
+import time
+
+from backend_test import Concatenate, LocalBackend
+
+def rebuild_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        source = d / "source"
+        source.write_text("abc")
+
+        built = []
+        def configure(c):
+            built.extend(c.apply(Concatenate(), source, "out"))
+            c.add_target(built[0])
+
+        with LocalBackend(d) as b:
+            b.build(configure)
+            b.backend.watch("script", debounce=0.1)
+            try:
+                source.write_text("def")
+                for i in range(100):
+                    time.sleep(0.1)
+                    path = built[0].get_path(b.backend)
+                    if path.exists() and path.read_text() == "def":
+                        break
+                else:
+                    assert False, "Target was not rebuilt"
+            finally:
+                b.backend.unwatch()
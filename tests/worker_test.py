@@ -0,0 +1,133 @@
+from nose.tools import *
+import pathlib
+import sys
+import tempfile
+
+from bs import nodes
+from bs import worker
+
+from backend_test import LocalBackend
+
+# Worker that answers with its pid and arguments, fails on "fail" and exits on "exit"
+worker_command = [sys.executable, "-c", """
+import json, os, sys
+for line in sys.stdin:
+    request = json.loads(line)
+    arguments = request["arguments"]
+    if arguments == ["exit"]:
+        break
+    response = {"exitCode": 1 if arguments == ["fail"] else 0,
+                "output": " ".join([str(os.getpid())] + arguments),
+                "requestId": request["requestId"]}
+    sys.stdout.write(json.dumps(response) + "\\n")
+    sys.stdout.flush()
+"""]
+
+def request_test():
+    w = worker.PersistentWorker(worker_command)
+    try:
+        pid = w.process.pid
+        eq_(w.request(["a", 1]), "{} a 1".format(pid))
+        eq_(w.request(["b"]), "{} b".format(pid))
+
+        with assert_raises(Exception) as cm:
+            w.request(["fail"])
+        eq_(cm.exception.args[0], "Command failed")
+
+        assert w.alive()
+        eq_(w.request(["c"]), "{} c".format(pid))
+
+        with assert_raises(Exception) as cm:
+            w.request(["exit"])
+        eq_(cm.exception.args[0], "Worker exited")
+    finally:
+        w.close()
+    assert not w.alive()
+
+def pool_reuse_test():
+    with worker.WorkerPool() as pool:
+        with pool.worker(worker_command) as w1:
+            pid1 = w1.process.pid
+            w1.request(["x"])
+
+        with pool.worker(worker_command) as w2:
+            eq_(w2.process.pid, pid1)
+            with pool.worker(worker_command) as w3:
+                # The only idle worker is taken, new one gets started
+                assert w3.process.pid != pid1
+
+    assert not w1.alive()
+    assert not w3.alive()
+
+def pool_broken_worker_test():
+    with worker.WorkerPool() as pool:
+        with assert_raises(Exception):
+            with pool.worker(worker_command) as w1:
+                w1.request(["exit"])
+        assert not w1.alive()
+
+        with pool.worker(worker_command) as w2:
+            assert w2 is not w1
+            w2.request(["x"])
+
+def worker_stderr_test():
+    lines = []
+    command = [sys.executable, "-c", "import sys; sys.stderr.write('starting\\nready\\n')"]
+    w = worker.PersistentWorker(command, lambda stream_name, line: lines.append((stream_name, line)))
+    w.process.wait()
+    w.close()
+    eq_(lines, [("stderr", "starting"), ("stderr", "ready")])
+
+@nottest
+class CopyingBuilder(nodes.WorkerBuilder):
+    """ Worker builder that prefixes its input with pid of the worker """
+    batch_size = 4
+
+    def get_worker_command(self, context):
+        return [sys.executable, "-c", """
+import json, os, sys
+sys.stderr.write("worker started\\n")
+sys.stderr.flush()
+for line in sys.stdin:
+    request = json.loads(line)
+    source, target = request["arguments"]
+    with open(source) as fp:
+        text = fp.read()
+    with open(target, "w") as fp:
+        fp.write("{} {}".format(os.getpid(), text))
+    response = {"exitCode": 0, "output": "", "requestId": request["requestId"]}
+    sys.stdout.write(json.dumps(response) + "\\n")
+    sys.stdout.flush()
+"""]
+
+    def get_arguments(self, context, input_paths, output_paths):
+        return [input_paths[0], output_paths[0]]
+
+    def get_output_count(self, input_count):
+        return 1
+
+    def get_hash(self):
+        return self.hash_helper([])
+
+def batched_worker_test():
+    with tempfile.TemporaryDirectory() as d:
+        d = pathlib.Path(d)
+        for i in range(8):
+            (d / "in{}".format(i)).write_text(str(i))
+
+        def configure(c):
+            builder = CopyingBuilder()
+            for i in range(8):
+                c.add_target(c.apply(builder, d / "in{}".format(i), "out{}".format(i)))
+
+        with LocalBackend(d) as b:
+            messages = b.build(configure)
+        # Every application has its own source, they still become ready together
+        eq_(len([message for message in messages if message.startswith("Batch of 4 x")]), 2)
+        assert "stderr: worker started" in messages, messages
+        pids = set()
+        for i in range(8):
+            pid, text = (d / "output" / "out{}".format(i)).read_text().split(" ")
+            eq_(text, str(i))
+            pids.add(pid)
+        assert len(pids) <= 2 # One worker per batch